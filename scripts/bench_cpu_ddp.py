@@ -0,0 +1,152 @@
+"""
+Smoke test of data-parallel training on the CPU with the gloo backend: trains
+a stack of E_GCL layers on synthetic events with 1, 2 and 4 processes started
+by torchrun (--threads threads each), checks that the replicas stay identical
+and compares the throughput (events/s over all processes).
+Run from the repository root: python scripts/bench_cpu_ddp.py --nprocs 1,2,4
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../"))
+
+parser = argparse.ArgumentParser(description="Args")
+parser.add_argument("--nprocs", type=str, default="1,2,4")
+parser.add_argument("--threads", type=int, default=1, help="threads per process")
+parser.add_argument("--batch-size", type=int, default=8, help="events per process")
+parser.add_argument("--n-hits", type=int, default=300)
+parser.add_argument("--k", type=int, default=11)
+parser.add_argument("--hidden", type=int, default=64)
+parser.add_argument("--layers", type=int, default=3)
+parser.add_argument("--steps", type=int, default=30)
+parser.add_argument("--warmup", type=int, default=5)
+parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+
+def worker():
+    import dgl
+    import torch.distributed as dist
+    from src.models.EGNN_dgl import E_GCL
+    from src.utils.nn.tools_condensation import all_reduce_sum
+
+    class Net(torch.nn.Module):
+        def __init__(self, hidden, n_layers):
+            super().__init__()
+            self.embed = torch.nn.Linear(3, hidden)
+            self.layers = torch.nn.ModuleList(
+                [E_GCL(hidden, hidden, hidden) for _ in range(n_layers)]
+            )
+            self.head = torch.nn.Linear(hidden, 1)
+
+        def forward(self, g):
+            g = g.local_var()
+            target = g.ndata["x"].norm(dim=1)
+            g.ndata["hh"] = self.embed(g.ndata["x"])
+            for layer in self.layers:
+                g = layer(g)
+            pred = self.head(g.ndata["hh"]).squeeze(1)
+            return torch.nn.functional.mse_loss(pred, target)
+
+    dist.init_process_group(backend="gloo")
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    torch.manual_seed(0)
+    model = torch.nn.parallel.DistributedDataParallel(
+        Net(args.hidden, args.layers), find_unused_parameters=True
+    )
+    opt = torch.optim.SGD(model.parameters(), lr=1e-3)
+
+    # different events on every process, made before the timing
+    gen = torch.Generator().manual_seed(1 + rank)
+    batches = []
+    for _ in range(args.warmup + args.steps):
+        graphs = []
+        for _ in range(args.batch_size):
+            x = torch.randn(args.n_hits, 3, generator=gen)
+            g = dgl.knn_graph(x, args.k, exclude_self=True)
+            g.ndata["x"] = x
+            graphs.append(g)
+        batches.append(dgl.batch(graphs))
+
+    loss_sum = 0.0
+    for step, g in enumerate(batches):
+        if step == args.warmup:
+            dist.barrier()
+            start = time.time()
+        loss = model(g)
+        opt.zero_grad()
+        loss.backward()
+        opt.step()
+        if step >= args.warmup:
+            loss_sum += loss.item()
+    dist.barrier()
+    elapsed = time.time() - start
+    loss_sum, n_events = all_reduce_sum(
+        [loss_sum, args.steps * args.batch_size], torch.device("cpu")
+    )
+
+    # the replicas must not drift apart
+    params = torch.cat([p.detach().flatten() for p in model.parameters()])
+    params_max, params_min = params.clone(), params.clone()
+    dist.all_reduce(params_max, op=dist.ReduceOp.MAX)
+    dist.all_reduce(params_min, op=dist.ReduceOp.MIN)
+    drift = (params_max - params_min).abs().max().item()
+    if rank == 0:
+        print(
+            "RESULT %d %.3f %.6f %.3g"
+            % (
+                world_size,
+                n_events / elapsed,
+                loss_sum / (args.steps * world_size),
+                drift,
+            )
+        )
+    dist.destroy_process_group()
+
+
+def launch(nprocs):
+    env = dict(os.environ, OMP_NUM_THREADS=str(args.threads))
+    cmd = [
+        sys.executable,
+        "-m",
+        "torch.distributed.run",
+        "--standalone",
+        "--nproc_per_node",
+        str(nprocs),
+        os.path.abspath(__file__),
+        "--worker",
+    ] + sys.argv[1:]
+    out = subprocess.run(cmd, env=env, capture_output=True, text=True)
+    if out.returncode != 0:
+        print(out.stdout)
+        print(out.stderr)
+        raise RuntimeError("torchrun with %d processes failed" % nprocs)
+    line = [l for l in out.stdout.splitlines() if l.startswith("RESULT")][-1]
+    _, world_size, events_per_s, avg_loss, drift = line.split()
+    return float(events_per_s), float(avg_loss), float(drift)
+
+
+if args.worker:
+    worker()
+else:
+    results = {}
+    for nprocs in [int(n) for n in args.nprocs.split(",")]:
+        results[nprocs] = launch(nprocs)
+        events_per_s, avg_loss, drift = results[nprocs]
+        assert drift < 1e-6, "replicas differ by %g with %d processes" % (drift, nprocs)
+        assert avg_loss == avg_loss, "loss is nan with %d processes" % nprocs
+    base = min(results)
+    print(
+        "%d thread(s) per process, %d events per process and step"
+        % (args.threads, args.batch_size)
+    )
+    for nprocs, (events_per_s, avg_loss, _) in results.items():
+        speedup = events_per_s / results[base][0]
+        print(
+            "%d processes: %.1f events/s, speed-up x%.2f (efficiency %.0f%%), avg loss %.4f"
+            % (nprocs, events_per_s, speedup, 100 * speedup * base / nprocs, avg_loss)
+        )
@@ -0,0 +1,107 @@
+"""
+Checks that the terms calc_LV_Lbeta computes with a reduced set of regression
+terms (plan_regression_terms) are the same as with all terms, and compares the
+speed of the configurations on CPU.
+Run from the repository root: python scripts/bench_loss_terms.py
+"""
+import argparse
+import time
+import dgl
+import torch
+from src.layers.object_cond import (
+    calc_LV_Lbeta,
+    plan_regression_terms,
+    REGRESSION_TERMS,
+)
+
+parser = argparse.ArgumentParser(description="Args")
+parser.add_argument("--n-events", type=int, default=20)
+parser.add_argument("--n-hits", type=int, default=1000)
+parser.add_argument("--n-particles", type=int, default=10)
+parser.add_argument("--repeat", type=int, default=10)
+args = parser.parse_args()
+
+torch.manual_seed(0)
+graphs = []
+for _ in range(args.n_events):
+    g = dgl.graph(([], []), num_nodes=args.n_hits)
+    g.ndata["pos_hits_norm"] = torch.randn(args.n_hits, 3)
+    g.ndata["e_hits"] = torch.rand(args.n_hits, 1)
+    # every particle has at least one hit, 0 is noise
+    particle_number = torch.randint(0, args.n_particles + 1, (args.n_hits,))
+    particle_number[: args.n_particles + 1] = torch.arange(args.n_particles + 1)
+    g.ndata["particle_number"] = particle_number.float()
+    graphs.append(g)
+g = dgl.batch(graphs)
+n_hits = g.num_nodes()
+n_objects = args.n_events * args.n_particles
+y = torch.cat(
+    (
+        torch.randn(n_objects, 3),
+        torch.rand(n_objects, 3) + 0.5,
+        torch.tensor([22.0, 211.0, 2112.0, 11.0]).repeat(n_objects)[:n_objects, None],
+    ),
+    dim=1,
+)
+batch = torch.repeat_interleave(
+    torch.arange(args.n_events), g.batch_num_nodes()
+)
+post_pid_pool_module = torch.nn.Sequential(torch.nn.Linear(22, 22), torch.nn.Sigmoid())
+inputs = dict(
+    original_coords=torch.randn(n_hits, 3),
+    g=g,
+    y=y,
+    distance_threshold=torch.randn(n_hits, 3),
+    energy_correction=torch.rand(n_hits, 1),
+    momentum=torch.rand(n_hits, 1),
+    beta=torch.sigmoid(torch.randn(n_hits)),
+    cluster_space_coords=torch.randn(n_hits, 3),
+    cluster_index_per_event=g.ndata["particle_number"].long(),
+    batch=batch,
+    predicted_pid=torch.randn(n_hits, 22),
+    post_pid_pool_module=post_pid_pool_module,
+)
+loss_terms = {
+    "E": "loss_E",
+    "x": "loss_x",
+    "PID": "loss_particle_ids",
+    "momentum": "loss_momentum",
+    "mass": "loss_mass",
+}
+
+
+def run(regression_terms):
+    with torch.no_grad():
+        return calc_LV_Lbeta(**inputs, regression_terms=regression_terms)
+
+
+def timeit(regression_terms):
+    times = []
+    for _ in range(args.repeat):
+        start = time.time()
+        run(regression_terms)
+        times.append(time.time() - start)
+    return 1000 * sum(times[1:]) / (len(times) - 1)
+
+
+configurations = {
+    "full": plan_regression_terms(clust_loss_only=False),
+    "clustering + energy": plan_regression_terms(True, add_energy_loss=True),
+    "clustering only": plan_regression_terms(True),
+}
+reference = run(REGRESSION_TERMS)
+for name, regression_terms in configurations.items():
+    result = run(regression_terms)
+    for key in ("L_V", "L_beta", "L_V_attractive", "L_V_repulsive", "L_exp"):
+        assert torch.allclose(getattr(result, key), getattr(reference, key)), key
+    for term, key in loss_terms.items():
+        if term in regression_terms:
+            assert torch.allclose(getattr(result, key), getattr(reference, key)), key
+        else:
+            assert getattr(result, key) == 0, key
+print("all enabled terms match the full computation")
+
+print("%d events x %d hits" % (args.n_events, args.n_hits))
+times = {name: timeit(terms) for name, terms in configurations.items()}
+for name, t in times.items():
+    print("%-20s %.1f ms (x%.2f)" % (name + ":", t, times["full"] / t))
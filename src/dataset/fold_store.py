@@ -0,0 +1,177 @@
+"""
+Events decoded once for k-fold cross-validation (--cross-validation-store):
+every training file is read, selected, preprocessed and turned into graphs
+once, into an indexed store that all folds share:
+    graphs_NNNNN.bin: the graphs of file NNNNN (dgl.save_graphs)
+    targets_NNNNN.npz: their particle targets, concatenated, with offsets
+    index.npz: file, position in the graphs file, fold and relative position
+        in the input file of every event
+    config.pkl: the data config the events were preprocessed with
+A fold is a subset of the rows of the index, so the folds can be trained at
+the same time by separate processes reading the same store.
+"""
+import os
+import pickle
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+import awkward as ak
+import dgl
+import torch
+from src.logger.logger import _logger
+from src.data.fileio import _read_files
+from src.data.preprocess import _build_new_variables
+from src.data.tools import _eval_expr, _get_variable_names
+from src.dataset.dataset import _finalize_inputs
+from src.dataset.functions_graph import create_graph
+
+
+def _graphs_file(path, chunk):
+    return os.path.join(path, "graphs_%05d.bin" % chunk)
+
+
+def _targets_file(path, chunk):
+    return os.path.join(path, "targets_%05d.npz" % chunk)
+
+
+def _decode_file(path, chunk, filepath, data_config, fold_expr, n_noise):
+    """
+    Decodes one input file into graphs_/targets_<chunk>, returns the fold and
+    the relative position in the file of the events written
+    """
+    branches = set(data_config.load_branches) | set(_get_variable_names(fold_expr))
+    table = _read_files([filepath], branches, treename=data_config.treename)
+    n_entries = len(table)
+    if data_config.selection is None:
+        selected = np.ones(n_entries, dtype=bool)
+    else:
+        selected = ak.to_numpy(
+            ak.values_astype(_eval_expr(data_config.selection, table), "bool")
+        )
+    table = table[selected]
+    if len(table) == 0:
+        _logger.info("No events of %s pass the selection" % filepath)
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    # the fold is computed like the --cross-validation selection, on the inputs
+    folds = ak.to_numpy(_eval_expr(fold_expr, table)).astype(np.int64)
+    positions = (np.flatnonzero(selected) / n_entries).astype(np.float32)
+    table = _build_new_variables(table, data_config.var_funcs)
+    table = _finalize_inputs(table, data_config)
+    graphs, targets, kept = [], [], []
+    for i in range(len(folds)):
+        X = {k: table["_" + k][i].copy() for k in data_config.input_names}
+        [g, y], graph_empty = create_graph(X, data_config, n_noise=n_noise)
+        if graph_empty:
+            continue
+        graphs.append(g)
+        targets.append(y.numpy().astype(np.float32))
+        kept.append(i)
+    if len(graphs):
+        dgl.save_graphs(_graphs_file(path, chunk), graphs)
+        offsets = np.zeros(len(targets) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(y) for y in targets])
+        np.savez(
+            _targets_file(path, chunk), values=np.concatenate(targets), offsets=offsets
+        )
+    _logger.info("Decoded %d events of %s" % (len(kept), filepath))
+    return folds[kept], positions[kept]
+
+
+def build_fold_store(
+    path, file_dict, data_config, fold_expr, n_noise=0, num_workers=1
+):
+    """
+    Decodes all events of file_dict into a new store at path, one input file
+    per worker process at a time. fold_expr gives the fold of every event,
+    e.g. `event%5`.
+    """
+    os.makedirs(path, exist_ok=True)
+    files = sum(file_dict.values(), [])
+    args = [
+        (path, chunk, filepath, data_config, fold_expr, n_noise)
+        for chunk, filepath in enumerate(files)
+    ]
+    if num_workers > 1:
+        with ProcessPoolExecutor(
+            num_workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            decoded = list(executor.map(_decode_file, *zip(*args)))
+    else:
+        decoded = [_decode_file(*a) for a in args]
+    chunks = [
+        np.full(len(f), chunk, dtype=np.int32) for chunk, (f, _) in enumerate(decoded)
+    ]
+    items = [np.arange(len(f), dtype=np.int32) for f, _ in decoded]
+    np.savez(
+        os.path.join(path, "index.npz"),
+        chunk=np.concatenate(chunks),
+        item=np.concatenate(items),
+        fold=np.concatenate([f for f, _ in decoded]),
+        position=np.concatenate([p for _, p in decoded]),
+    )
+    with open(os.path.join(path, "config.pkl"), "wb") as f:
+        pickle.dump(data_config, f)
+    # written last: the store is complete
+    with open(os.path.join(path, "done"), "w") as f:
+        f.write(str(sum(len(c) for c in chunks)))
+
+
+class FoldStore(object):
+    def __init__(self, path):
+        self.path = path
+        index = np.load(os.path.join(path, "index.npz"))
+        self.chunk = index["chunk"]
+        self.item = index["item"]
+        self.fold = index["fold"]
+        self.position = index["position"]
+        with open(os.path.join(path, "config.pkl"), "rb") as f:
+            self.config = pickle.load(f)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, "done"))
+
+    def __len__(self):
+        return len(self.chunk)
+
+
+class FoldDataset(torch.utils.data.Dataset):
+    """
+    The events of the store in `rows` of its index, as [graph, targets] like
+    SimpleIterDataset. The graphs of a batch are read with one
+    dgl.load_graphs per input file.
+    """
+
+    def __init__(self, store, rows):
+        self.path = store.path
+        self.chunk = store.chunk[rows]
+        self.item = store.item[rows]
+        self.config = store.config
+        self._targets = {}
+
+    def __len__(self):
+        return len(self.chunk)
+
+    def _chunk_targets(self, chunk):
+        if chunk not in self._targets:
+            targets = np.load(_targets_file(self.path, chunk))
+            self._targets[chunk] = (targets["values"], targets["offsets"])
+        return self._targets[chunk]
+
+    def __getitems__(self, indices):
+        events = [None] * len(indices)
+        by_chunk = defaultdict(list)
+        for j, i in enumerate(indices):
+            by_chunk[int(self.chunk[i])].append(j)
+        for chunk, js in by_chunk.items():
+            items = [int(self.item[indices[j]]) for j in js]
+            graphs, _ = dgl.load_graphs(_graphs_file(self.path, chunk), items)
+            values, offsets = self._chunk_targets(chunk)
+            for j, item, g in zip(js, items, graphs):
+                y = torch.from_numpy(values[offsets[item] : offsets[item + 1]])
+                events[j] = [g, y]
+        return events
+
+    def __getitem__(self, i):
+        return self.__getitems__([i])[0]
@@ -1,8 +1,10 @@
+import time
 import numpy as np
 import torch
 import dgl
 from torch_scatter import scatter_add
 from sklearn.preprocessing import StandardScaler
+from src.layers.truth_index import get_truth_index
 
 
 def find_mask_no_energy(hit_particle_link, hit_type_a):
@@ -222,18 +224,33 @@ def to_hetero(g, all_hit_types=[2, 3]):
     # We probably won't be using this
     hit_types = g.ndata["hit_type"]
     hit_types = torch.argmax(hit_types, dim=1)
-    ht_idx = [all_hit_types.index(i) for i in hit_types]
-    edges = g.edges()
+    # index of the hit type in all_hit_types (-1 if not in it) and index of
+    # every node among the nodes of its type
+    type_lookup = -torch.ones(
+        max(max(all_hit_types), int(hit_types.max())) + 1, dtype=torch.long
+    )
+    type_lookup[all_hit_types] = torch.arange(len(all_hit_types))
+    ht_idx = type_lookup[hit_types]
+    one_hot = torch.nn.functional.one_hot(ht_idx.clamp(min=0), len(all_hit_types))
+    one_hot = one_hot * (ht_idx >= 0).view(-1, 1)
+    local_idx = (one_hot.cumsum(dim=0) - 1).gather(1, ht_idx.clamp(min=0).view(-1, 1))
+    local_idx = local_idx.view(-1)
+    src, dst = g.edges()
     graph_data = {}
-    for i in all_hit_types:
-        for j in all_hit_types:
-            edge_mask = hit_types[edges[0]] == i
-            edge_mask = edge_mask & (hit_types[edges[1]] == j)
-            graph_data[(str(i), "-", str(j))] = (edges[0][edge_mask], edges[1][edge_mask])
+    for i, ht_i in enumerate(all_hit_types):
+        for j, ht_j in enumerate(all_hit_types):
+            edge_mask = (ht_idx[src] == i) & (ht_idx[dst] == j)
+            graph_data[(str(ht_i), "-", str(ht_j))] = (
+                local_idx[src[edge_mask]],
+                local_idx[dst[edge_mask]],
+            )
+    num_nodes = {str(ht): int((ht_idx == i).sum()) for i, ht in enumerate(all_hit_types)}
     old_g = g
-    g = dgl.heterograph(graph_data)
-    g.nodes["2"].data = {key: old_g.ndata[key][ht_idx == 2] for key in old_g.ndata}
-    g.nodes["3"].data = {key: old_g.ndata[key][ht_idx == 3] for key in old_g.ndata}
+    g = dgl.heterograph(graph_data, num_nodes_dict=num_nodes)
+    for i, ht in enumerate(all_hit_types):
+        g.nodes[str(ht)].data.update(
+            {key: old_g.ndata[key][ht_idx == i] for key in old_g.ndata}
+        )
     return g
 
 
@@ -358,12 +375,16 @@ def graph_batch_func(list_graphs):
     Returns:
         batch dgl: dgl batch of graphs
     """
+    start = time.perf_counter()
     list_graphs_g = [el[0] for el in list_graphs]
     list_y = [el[1] for el in list_graphs]
     ys = torch.cat(list_y, dim=0)
     ys = torch.reshape(ys, [-1, list_y[0].shape[1]])
     bg = dgl.batch(list_graphs_g)
-    # reindex particle number
+    # truth-side index for the losses, built here so it runs in the loader workers
+    bg.truth_index = get_truth_index(bg)
+    # reported by the stage timers of the training loop
+    bg.collate_time = time.perf_counter() - start
     return bg, ys
 
 
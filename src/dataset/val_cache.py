@@ -0,0 +1,130 @@
+"""
+Frozen validation set: the collated validation batches are kept by the first
+validation epoch, and later epochs iterate over them instead of reading,
+preprocessing and building the graphs again. The batches are kept in memory or
+written to a directory named after a hash of the data config, the files and
+the loading options, so changing any of them starts a new cache.
+"""
+import hashlib
+import json
+import os
+import shutil
+import torch
+from src.data.config import _md5
+from src.logger.logger import _logger
+from src.utils.checkpoint import atomic_save
+
+
+def cache_key(data_config_file, file_dict, options):
+    """
+    Hash of the data config (and the preprocessing information generated for
+    it), the files (path, size and modification time) and the loading options
+    """
+    h = hashlib.md5()
+    config_md5 = _md5(data_config_file)
+    h.update(config_md5.encode())
+    autogen_file = data_config_file.replace(".yaml", ".%s.auto.yaml" % config_md5)
+    if os.path.exists(autogen_file):
+        h.update(_md5(autogen_file).encode())
+    for name in sorted(file_dict):
+        for path in file_dict[name]:
+            stat = os.stat(path)
+            h.update(
+                (
+                    "%s:%s:%d:%d"
+                    % (name, os.path.abspath(path), stat.st_size, stat.st_mtime)
+                ).encode()
+            )
+    h.update(json.dumps(options, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+class CachedLoader(object):
+    """
+    Iterates over `loader` the first time, keeping the batches (in memory, or
+    in cache_dir/<key> with cache_dir), and over the kept batches afterwards.
+    The cache is only kept if the first pass runs through the loader or stops
+    after `n_steps` batches (--steps-per-epoch-val); a pass interrupted before
+    (e.g. by an error in the evaluation) is discarded.
+    The graphs are handed out as local copies, so the models writing into
+    their input graph don't change the cached batches.
+    """
+
+    def __init__(self, loader, key, cache_dir=None, n_steps=None):
+        self.loader = loader
+        self.n_steps = n_steps
+        self.dataset = loader.dataset
+        self.path = os.path.join(cache_dir, "val-" + key) if cache_dir else None
+        self.batches = []
+        self.n_batches = None
+        if self.path is not None and os.path.exists(self._done_file()):
+            with open(self._done_file()) as f:
+                self.n_batches = int(f.read())
+            _logger.info(
+                "Using the validation cache %s (%d batches)"
+                % (self.path, self.n_batches)
+            )
+
+    def _done_file(self):
+        return os.path.join(self.path, "done")
+
+    def _batch_file(self, i):
+        return os.path.join(self.path, "batch_%06d.pt" % i)
+
+    def _commit(self, n_batches):
+        self.n_batches = n_batches
+        if self.path is not None:
+            with open(self._done_file(), "w") as f:
+                f.write(str(n_batches))
+        _logger.info(
+            "Cached %d validation batches%s"
+            % (n_batches, "" if self.path is None else " in %s" % self.path)
+        )
+
+    def _discard(self, n_batches):
+        _logger.warning(
+            "Validation pass stopped after %d batches, not caching it" % n_batches
+        )
+        self.batches = []
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    @staticmethod
+    def _local(batch):
+        g, y = batch
+        return g.local_var(), y
+
+    def _fill(self):
+        if self.path is not None:
+            os.makedirs(self.path, exist_ok=True)
+        self.batches = []
+        n_batches = 0
+        try:
+            for batch in self.loader:
+                if self.path is not None:
+                    atomic_save(batch, self._batch_file(n_batches))
+                else:
+                    self.batches.append(batch)
+                n_batches += 1
+                yield self._local(batch)
+        except GeneratorExit:
+            if n_batches == self.n_steps:
+                # the consumer stopped after the batches it needs
+                self._commit(n_batches)
+            else:
+                self._discard(n_batches)
+            raise
+        self._commit(n_batches)
+
+    def _read(self):
+        if self.path is None:
+            for batch in self.batches:
+                yield self._local(batch)
+            return
+        for i in range(self.n_batches):
+            yield torch.load(self._batch_file(i), weights_only=False)
+
+    def __iter__(self):
+        if self.n_batches is None:
+            return self._fill()
+        return self._read()
@@ -2,6 +2,7 @@ from typing import Optional, Union
 from torch_geometric.typing import OptTensor, PairTensor, PairOptTensor
 
 import torch
+from torch.profiler import record_function
 from torch import Tensor
 from torch.nn import Linear
 from torch_scatter import scatter
@@ -99,6 +100,36 @@ class GravNetConv(MessagePassing):
 
         return self.lin(torch.cat([out, x], dim=-1)), graph, s_l
 
+    def forward_flat(self, x: Tensor, batch: Tensor) -> Tensor:
+        """
+        Same as `forward`, but takes the per-hit event index instead of a
+        DGLGraph and only uses ops that can be exported to ONNX: the kNN is
+        done with TopK (see `knn_topk`) and the mean/max aggregation with
+        scatter_add/scatter_reduce instead of torch_scatter.
+        """
+        h_l: Tensor = self.lin_h(x)
+        s_l: Tensor = self.lin_s(x)
+        # row: neighbour, col: the hit that selected it (as in knn_per_graph)
+        row, col = knn_topk(s_l, batch, self.k)
+
+        edge_weight = (s_l[row] - s_l[col]).pow(2).sum(-1)
+        edge_weight = torch.exp(-10.0 * edge_weight)
+        messages = h_l[col] * edge_weight.unsqueeze(1)
+
+        # target_to_source flow: messages are aggregated on the neighbour
+        index = row.unsqueeze(1).expand_as(messages)
+        n_hits = x.size(0)
+        counts = torch.zeros(n_hits, dtype=x.dtype, device=x.device).scatter_add(
+            0, row, torch.ones_like(edge_weight)
+        )
+        out_sum = torch.zeros_like(h_l).scatter_add(0, index, messages)
+        out_mean = out_sum / counts.clamp(min=1).unsqueeze(1)
+        out_max = torch.zeros_like(h_l).scatter_reduce(
+            0, index, messages, reduce="amax", include_self=False
+        )
+        out = torch.cat([out_mean, out_max], dim=-1)
+        return self.lin(torch.cat([out, x], dim=-1))
+
     def message(self, x_j: Tensor, edge_weight: Tensor) -> Tensor:
         return x_j * edge_weight.unsqueeze(1)
 
@@ -120,6 +151,7 @@ class GravNetConv(MessagePassing):
         )
 
 
+@record_function("knn_per_graph")
 def knn_per_graph(g, sl, k):
     graphs_list = dgl.unbatch(g)
     node_counter = 0
@@ -131,3 +163,28 @@ def knn_per_graph(g, sl, k):
         new_graphs.append(new_graph)
         node_counter = node_counter + non
     return dgl.batch(new_graphs)
+
+
+def knn_topk(s: Tensor, batch: Tensor, k: int):
+    """
+    kNN graph of a whole batch built with TopK on the dense distance matrix,
+    so that it can be exported to ONNX. Hits are only connected within their
+    own event and never to themselves. Returns (neighbour, hit) index pairs,
+    the same edge direction as `dgl.knn_graph`.
+    The distance matrix is (n_hits x n_hits): export and run with a few events
+    per batch.
+    """
+    n_hits = s.size(0)
+    dist = (s.unsqueeze(1) - s.unsqueeze(0)).pow(2).sum(-1)
+    other_event = batch.unsqueeze(1) != batch.unsqueeze(0)
+    self_loop = torch.eye(n_hits, dtype=torch.bool, device=s.device)
+    dist = dist.masked_fill(other_event | self_loop, float("inf"))
+    # pad with k unreachable columns so that TopK also works for events with
+    # fewer than k + 1 hits; those neighbours are dropped below
+    padding = torch.full((n_hits, k), float("inf"), dtype=s.dtype, device=s.device)
+    dist_k, neighbours = torch.topk(
+        torch.cat([dist, padding], dim=1), k, dim=1, largest=False
+    )
+    hits = torch.arange(n_hits, device=s.device).unsqueeze(1).expand_as(neighbours)
+    valid = torch.isfinite(dist_k)
+    return neighbours[valid], hits[valid]
@@ -2,6 +2,7 @@ from typing import Optional, Union
 from torch_geometric.typing import OptTensor, PairTensor, PairOptTensor
 
 import torch
+from torch.profiler import record_function
 from torch import Tensor
 from torch.nn import Linear
 from torch_scatter import scatter
@@ -168,6 +169,7 @@ class GravNetConv(MessagePassing):
         )
 
 
+@record_function("knn_per_graph")
 def knn_per_graph(g, sl, k):
     graphs_list = dgl.unbatch(g)
     node_counter = 0
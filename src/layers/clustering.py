@@ -0,0 +1,90 @@
+import numpy as np
+
+
+def greedy_assignment(X, condpoints, td, batch=None, chunk_size=1024):
+    """
+    Greedy assignment of points to condensation points: going through
+    condpoints in the given order, every condensation point takes all points
+    closer than td (d < td) that are not assigned yet. Candidates are found
+    with a KD-tree radius query instead of computing the distances to all
+    unassigned points.
+    :param X: coordinates (n_points x dim)
+    :param condpoints: indices of the condensation points, in assignment order
+    :param batch: event index of every point; points of different events are
+        never assigned to each other, so all events are clustered in one call
+    :return: index into condpoints for every point, -1 for unassigned points
+    """
+    from scipy.spatial import cKDTree
+
+    X = np.asarray(X)
+    n_points = X.shape[0]
+    assignment = -1 * np.ones(n_points, dtype=np.int64)
+    if len(condpoints) == 0 or n_points == 0:
+        return assignment
+    tree_coords = X
+    if batch is not None:
+        # an extra coordinate 2 * td apart per event keeps the events out of
+        # each other's reach
+        tree_coords = np.concatenate(
+            (X, (2.0 * td * np.asarray(batch)).reshape(-1, 1)), axis=1
+        )
+    tree = cKDTree(tree_coords)
+    # slightly larger radius for the query, the exact d < td cut is done below
+    radius = td * (1 + 1e-5)
+    for start in range(0, len(condpoints), chunk_size):
+        chunk = condpoints[start : start + chunk_size]
+        candidates = tree.query_ball_point(tree_coords[chunk], r=radius)
+        for i, (index_condpoint, neighbours) in enumerate(zip(chunk, candidates)):
+            neighbours = np.asarray(neighbours, dtype=np.int64)
+            neighbours = neighbours[assignment[neighbours] == -1]
+            d = np.linalg.norm(X[neighbours] - X[index_condpoint], axis=-1)
+            assignment[neighbours[d < td]] = start + i
+    return assignment
+
+
+def get_clustering_np(
+    betas: np.array, X: np.array, tbeta: float = 0.1, td: float = 1.0
+) -> np.array:
+    """
+    Returns a clustering of hits -> cluster_index, based on the GravNet model
+    output (predicted betas and cluster space coordinates) and the clustering
+    parameters tbeta and td.
+    Takes numpy arrays as input.
+    """
+    select_condpoints = betas > tbeta
+    # Get indices passing the threshold
+    indices_condpoints = np.nonzero(select_condpoints)[0]
+    # Order them by decreasing beta value
+    indices_condpoints = indices_condpoints[np.argsort(-betas[select_condpoints])]
+    # Assign points to condensation points
+    # Only assign previously unassigned points (no overwriting)
+    # Points unassigned at the end are bkg (-1)
+    assignment = greedy_assignment(X, indices_condpoints, td)
+    clustering = -1 * np.ones(betas.shape[0], dtype=np.int32)
+    assigned = assignment >= 0
+    clustering[assigned] = indices_condpoints[assignment[assigned]]
+    return clustering
+
+
+def get_clustering_batch_np(
+    betas: np.array, X: np.array, batch: np.array, tbeta: float = 0.1, td: float = 1.0
+) -> np.array:
+    """
+    get_clustering_np for all events of a batch in one call. The events are
+    independent, so ordering all condensation points of the batch by beta
+    gives the same clustering as running every event separately. Returns the
+    index of the condensation point within its event (batch must be sorted),
+    -1 for unassigned hits.
+    """
+    select_condpoints = betas > tbeta
+    indices_condpoints = np.nonzero(select_condpoints)[0]
+    indices_condpoints = indices_condpoints[np.argsort(-betas[select_condpoints])]
+    assignment = greedy_assignment(X, indices_condpoints, td, batch=batch)
+    # first hit of the event of every hit
+    event_start = np.searchsorted(batch, batch, side="left")
+    clustering = -1 * np.ones(betas.shape[0], dtype=np.int32)
+    assigned = assignment >= 0
+    clustering[assigned] = (
+        indices_condpoints[assignment[assigned]] - event_start[assigned]
+    )
+    return clustering
@@ -0,0 +1,25 @@
+"""
+Message passing on an edge list (src, dst) without DGL user-defined
+functions, shared by the E_GCL layers of the EGNN models.
+"""
+import torch
+from torch_scatter import scatter_add
+
+
+def propagate(message, agg, x, hh, src, dst, in_degrees):
+    """
+    Vectorized version of g.update_all(message, agg) on the edge list:
+    gathers the endpoints by index, runs the edge MLPs of message (its
+    messages()) on all edges at once, aggregates the coordinate updates and
+    edge features with a single scatter and applies agg.update().
+    """
+    _, trans, edge_feature = message.messages(x[src], x[dst], hh[src], hh[dst])
+    n_coords = trans.shape[1]
+    aggregated = scatter_add(
+        torch.cat((trans, edge_feature), dim=1), dst, dim=0, dim_size=x.shape[0]
+    )
+    has_messages = (in_degrees > 0).unsqueeze(1)
+    trans = aggregated[:, :n_coords] / in_degrees.clamp(min=1).unsqueeze(1)
+    x, hh = agg.update(x, hh, trans, aggregated[:, n_coords:])
+    # like update_all, nodes without incoming edges get zeros
+    return x * has_messages, hh * has_messages
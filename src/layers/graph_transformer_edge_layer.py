@@ -55,11 +55,12 @@ def exp(field):
 """
 
 class MultiHeadAttentionLayer(nn.Module):
-    def __init__(self, in_dim, out_dim, num_heads, use_bias):
+    def __init__(self, in_dim, out_dim, num_heads, use_bias, fused_attention=False):
         super().__init__()
         
         self.out_dim = out_dim
         self.num_heads = num_heads
+        self.fused_attention = fused_attention
         
         if use_bias:
             self.Q = nn.Linear(in_dim, out_dim * num_heads, bias=True)
@@ -92,6 +93,17 @@ class MultiHeadAttentionLayer(nn.Module):
         eids = g.edges()
         g.send_and_recv(eids, fn.src_mul_edge('V_h', 'score', 'V_h'), fn.sum('V_h', 'wV'))
         g.send_and_recv(eids, fn.copy_edge('score', 'score'), fn.sum('score', 'z'))
+
+    def propagate_attention_fused(self, g):
+        # Same computation as propagate_attention, with DGL built-in message
+        # functions (no python UDFs) so that the kernels can be fused
+        g.apply_edges(fn.u_mul_v('K_h', 'Q_h', 'score'))
+        score = g.edata['score'] / np.sqrt(self.out_dim) * g.edata['proj_e']
+        g.edata['e_out'] = score
+        # softmax, clamp for numerical stability
+        g.edata['score'] = torch.exp(score.sum(-1, keepdim=True).clamp(-5, 5))
+        g.update_all(fn.u_mul_e('V_h', 'score', 'm'), fn.sum('m', 'wV'))
+        g.update_all(fn.copy_e('score', 'm'), fn.sum('m', 'z'))
     
     def forward(self, g, h, e):
 
@@ -107,7 +119,10 @@ class MultiHeadAttentionLayer(nn.Module):
         g.ndata['V_h'] = V_h.view(-1, self.num_heads, self.out_dim)
         g.edata['proj_e'] = proj_e.view(-1, self.num_heads, self.out_dim)
         
-        self.propagate_attention(g)
+        if self.fused_attention:
+            self.propagate_attention_fused(g)
+        else:
+            self.propagate_attention(g)
         
         h_out = g.ndata['wV'] / (g.ndata['z'] + torch.full_like(g.ndata['z'], 1e-6)) # adding eps to all values here
         e_out = g.edata['e_out']
@@ -119,7 +134,7 @@ class GraphTransformerLayer(nn.Module):
     """
         Param: 
     """
-    def __init__(self, in_dim, out_dim, num_heads, dropout=0.0, layer_norm=False, batch_norm=True, residual=True, use_bias=False):
+    def __init__(self, in_dim, out_dim, num_heads, dropout=0.0, layer_norm=False, batch_norm=True, residual=True, use_bias=False, fused_attention=False):
         super().__init__()
 
         self.in_channels = in_dim
@@ -130,7 +145,7 @@ class GraphTransformerLayer(nn.Module):
         self.layer_norm = layer_norm     
         self.batch_norm = batch_norm
         
-        self.attention = MultiHeadAttentionLayer(in_dim, out_dim//num_heads, num_heads, use_bias)
+        self.attention = MultiHeadAttentionLayer(in_dim, out_dim//num_heads, num_heads, use_bias, fused_attention)
         
         self.O_h = nn.Linear(out_dim, out_dim)
         self.O_e = nn.Linear(out_dim, out_dim)
@@ -1,4 +1,5 @@
 import torch
+from src.layers.segment import batch_to_offsets, segment_count, segment_mean
 
 
 
@@ -21,38 +22,43 @@ class LLFillSpace(torch.nn.Module):
         base_config = super(LLFillSpace, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
 
-    def _rs_loop(self, coords):
-        # only select a few hits to keep memory managable
-        nhits = coords.shape[0]
-        maxhits = self.maxhits
-        sel = None
-        if nhits > maxhits:
-            sel = torch.randint(low=0, high=coords.shape[0] - 1, size=(maxhits,), dtype=torch.int32)
-        else:
-            sel = torch.arange(coords.shape[0], dtype=torch.int32)
-        sel = sel.to(coords.device)
-        sel = torch.unsqueeze(sel, dim=1).flatten()
-        coords_selected = torch.index_select(coords, 0, sel).clone()  # V' x C
-        # print('coords',coords.shape)
-        means = torch.mean(coords_selected, axis=0)  # 1 x C
-        coords_selected = coords_selected - means  # V' x C
+    def _raw_loss(self, coords, batch_idx):
+        # All events at once; hits are sorted by event
+        device = coords.device
+        offsets = batch_to_offsets(batch_idx)
+        n_hits = segment_count(offsets)
+        n_events = n_hits.size(0)
+        # only select a few hits per event to keep memory managable
+        n_selected = n_hits.clamp(max=self.maxhits)
+        selected_offsets = torch.zeros(n_events + 1, dtype=torch.long, device=device)
+        selected_offsets[1:] = torch.cumsum(n_selected, dim=0)
+        event = torch.repeat_interleave(
+            torch.arange(n_events, device=device), n_selected
+        )
+        position = (
+            torch.arange(event.size(0), device=device) - selected_offsets[:-1][event]
+        )
+        n_hits_event = n_hits[event]
+        random = (torch.rand(event.size(0), device=device) * (n_hits_event - 1)).long()
+        sel = offsets[:-1][event] + torch.where(
+            n_hits_event > self.maxhits, random, position
+        )
+        coords_selected = coords[sel]  # V' x C
+        means = segment_mean(coords_selected, selected_offsets)  # B x C
+        coords_selected = coords_selected - means[event]  # V' x C
         # build covariance
-        cov = torch.unsqueeze(coords_selected, dim=1) * torch.unsqueeze(coords_selected, dim=2)
-        cov = torch.mean(cov, dim=0, keepdim=False)  # 1 x C x C
-        # print('cov',cov)
-        # get eigenvals
-        eigenvals, _ = torch.linalg.eig(cov)  # cheap because just once, no need for approx
-        eigenvals = eigenvals.to(torch.float32)
+        cov = torch.unsqueeze(coords_selected, dim=1) * torch.unsqueeze(
+            coords_selected, dim=2
+        )
+        cov = segment_mean(cov.flatten(start_dim=1), selected_offsets)
+        cov = cov.view(n_events, coords.shape[1], coords.shape[1])  # B x C x C
+        # get eigenvals, the covariance is symmetric
+        eigenvals = torch.linalg.eigvalsh(cov)
         # penalise one small EV (e.g. when building a surface)
-        pen = torch.log((torch.mean(eigenvals) / (torch.min(eigenvals) + 1e-6) - 1.) ** 2 + 1.)
-        return pen
-
-    def _raw_loss(self, coords, batch_idx):
-        loss = torch.tensor(0).float().to(coords.device)
-        for i in batch_idx.unique():
-            idx = batch_idx == i
-            loss += self._rs_loop(coords[idx, :])
-        return loss
+        pen = torch.log(
+            (torch.mean(eigenvals, dim=1) / (eigenvals[:, 0] + 1e-6) - 1.0) ** 2 + 1.0
+        )
+        return torch.sum(pen[n_hits > 0])
 
     def forward(self, clust_space, batch_idx):
         if self.counter >= 0:  # completely optimise away increment
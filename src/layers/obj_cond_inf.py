@@ -1,17 +1,36 @@
 from typing import Tuple, Union
 import numpy as np
 import torch
-from torch_scatter import scatter_max, scatter_add, scatter_mean
-from src.layers.object_cond import assert_no_nans, scatter_count, batch_cluster_indices
+from torch_scatter import scatter_max, scatter_add, scatter_mean, segment_csr
+from src.layers.object_cond import (
+    assert_no_nans,
+    scatter_count,
+    batch_cluster_indices,
+    assign_to_condpoints,
+)
 import dgl
+from src.layers.clustering import greedy_assignment
+from src.layers.truth_index import get_truth_index
 
 
 def calc_energy_loss(
     batch, cluster_space_coords, beta, beta_stabilizing="soft_q_scaling", qmin=0.1, radius=0.7, e_frac_loss_return_particles=False, y=None, select_centers_by_particle=True
 ):
+    """
+    Energy fraction diagnostics, for all events of the batch at once. Every
+    particle gets a center (its max-beta hit with select_centers_by_particle,
+    otherwise the lowest-beta hits of the event); hits are assigned greedily
+    to the centers within radius in cluster space. Per center, returns the
+    clustered energy and the correctly clustered energy as fractions of the
+    energy of the center's particle, averaged per event and then over events
+    unless e_frac_loss_return_particles is set. In that case the second output
+    is [fractions true, particle ids (1-based, over the whole batch),
+    reco_count, non_reco_count, total_count], the counts being
+    (pids, counts) tensors per particle type, and y must have one row per
+    particle of the batch. The fractions and ids are flat tensors over the
+    batch, not lists per event, and the counts are not dicts.
+    """
     # select_centers_by_particle: if True, we pretend we know which hits belong to which particle...
-    list_graphs = dgl.unbatch(batch)
-    node_counter = 0
     if beta_stabilizing == "paper":
         q = beta.arctanh() ** 2 + qmin
     elif beta_stabilizing == "clip":
@@ -21,100 +40,79 @@ def calc_energy_loss(
         q = (beta.clip(0.0, 1 - 1e-4) / 1.002).arctanh() ** 2 + qmin
     else:
         raise ValueError(f"beta_stablizing mode {beta_stabilizing} is not known")
-    loss_E_frac = []
-    loss_E_frac_true = []
-    particle_ids_all = []
-    reco_count = {}  # per-PID count
-    non_reco_count = {}
-    total_count = {}
-    for g in list_graphs:
-        particle_id = g.ndata["particle_number"]
-        number_of_objects = len(particle_id.unique())
-        print("No. of objects", number_of_objects)
-        non = g.number_of_nodes()
-        q_g = q[node_counter : non + node_counter]
-        betas = beta[node_counter : non + node_counter]
-        sorted, indices = torch.sort(betas.view(-1), descending=False)
-        selected_centers = indices[0:number_of_objects]
-        if select_centers_by_particle:
-            _, selected_centers = scatter_max(
-                betas.flatten().cpu(), particle_id.cpu().long() - 1
-            )
-            assert selected_centers.shape[0] == number_of_objects
-        all_particles = set((particle_id.unique()-1).long().tolist())
-        reco_particles = set((particle_id[selected_centers]-1).long().tolist())
-        non_reco_particles = all_particles - reco_particles
-        part_pids = y[:, 6].long()
-        for particle in all_particles:
-            curr_pid = part_pids[particle].item()
-            if curr_pid in total_count:
-                total_count[curr_pid] += 1
-            else:
-                total_count[curr_pid] = 1
-            if particle in reco_particles:
-                if curr_pid in reco_count:
-                    reco_count[curr_pid] += 1
-                else:
-                    reco_count[curr_pid] = 1
-            else:
-                if curr_pid in non_reco_count:
-                    non_reco_count[curr_pid] += 1
-                else:
-                    non_reco_count[curr_pid] = 1
-        X = cluster_space_coords[node_counter : non + node_counter]
-        print("Radius", radius)
-        clusterings = get_clustering(selected_centers, X, betas, td=radius)
-        clusterings = clusterings.to(g.device)
-        node_counter += non
-        counter = 0
-        frac_energy = []
-        frac_energy_true = []
-        particle_ids = []
-        for alpha in selected_centers:
-            id_particle = particle_id[alpha]
-            true_mask_particle = particle_id == id_particle
-            true_energy = torch.sum(g.ndata["e_hits"][true_mask_particle])
-            mask_clustering_particle = clusterings == counter
-            clustered_energy = torch.sum(g.ndata["e_hits"][mask_clustering_particle])
-            clustered_energy_true = torch.sum(
-                g.ndata["e_hits"][
-                    mask_clustering_particle * true_mask_particle.flatten()
-                ]
-            )  # only consider how much has been correctly assigned
-            counter += 1
-            frac_energy.append(clustered_energy / (true_energy + 1e-7))
-            frac_energy_true.append(clustered_energy_true / (true_energy + 1e-7))
-            particle_ids.append(id_particle.cpu().long().item())
-        frac_energy = torch.stack(frac_energy, dim=0)
-        if not e_frac_loss_return_particles:
-            frac_energy = torch.mean(frac_energy)
-        frac_energy_true = torch.stack(frac_energy_true, dim=0)
-        if not e_frac_loss_return_particles:
-            frac_energy_true = torch.mean(frac_energy_true)
-        loss_E_frac.append(frac_energy)
-        loss_E_frac_true.append(frac_energy_true)
-        particle_ids_all.append(particle_ids)
+    device = beta.device
+    betas = beta.view(-1)
+    # event and particle offsets, precomputed by graph_batch_func when available
+    truth_index = get_truth_index(batch, device=device)
+    batch_idx = truth_index.batch
+    event_offsets = truth_index.event_offsets
+    # particle index over the whole batch
+    particle_id = batch.ndata["particle_number"].view(-1).long()
+    n_particles_per_event = truth_index.n_objects_per_event
+    particle_offsets = truth_index.object_offsets
+    particle = particle_offsets[:-1][batch_idx] + particle_id - 1
+    n_particles = truth_index.n_objects
+    if select_centers_by_particle:
+        _, centers = scatter_max(betas, particle, dim_size=n_particles)
+    else:
+        # the hits with the lowest betas of every event, one per particle
+        order = torch.argsort(betas)
+        order = order[torch.argsort(batch_idx[order], stable=True)]
+        position = torch.arange(order.size(0), device=device) - event_offsets[:-1][batch_idx[order]]
+        centers = order[position < n_particles_per_event[batch_idx[order]]]
+    n_centers = centers.size(0)
+    clustering = assign_to_condpoints(
+        cluster_space_coords, batch_idx, centers, particle_offsets, radius
+    )
+
+    e_hits = batch.ndata["e_hits"].view(-1)
+    center_particle = particle[centers]
+    true_energy = scatter_add(e_hits, particle, dim_size=n_particles)[center_particle]
+    # unassigned hits go to an extra last row, which is dropped
+    clustered_energy = scatter_add(e_hits, clustering, dim_size=n_centers + 1)[:-1]
+    correct = particle == torch.cat((center_particle, center_particle.new_full((1,), -1)))[clustering]
+    clustered_energy_true = scatter_add(
+        e_hits * correct, clustering, dim_size=n_centers + 1
+    )[:-1]
+    frac_energy = clustered_energy / (true_energy + 1e-7)
+    frac_energy_true = clustered_energy_true / (true_energy + 1e-7)
+    particle_ids = center_particle + 1
+
     if e_frac_loss_return_particles:
-        return loss_E_frac, [loss_E_frac_true, particle_ids_all, reco_count, non_reco_count, total_count]
-    loss_E_frac = torch.mean(torch.stack(loss_E_frac, dim=0))
-    loss_E_frac_true = torch.mean(torch.stack(loss_E_frac_true, dim=0))
+        # per-PID counts of reconstructed (i.e. chosen as center) particles
+        is_reco = torch.zeros(n_particles, device=device)
+        is_reco[center_particle] = 1.0
+        # the rows of y are the particles of the batch, in the same order
+        assert y.shape[0] == n_particles, (
+            "y has %d particles, the hits of the batch %d" % (y.shape[0], n_particles)
+        )
+        pids, pid_index = torch.unique(y[:, 6].long().to(device), return_inverse=True)
+        total_count = torch.bincount(pid_index, minlength=pids.size(0))
+        reco_count = torch.bincount(pid_index, weights=is_reco, minlength=pids.size(0)).long()
+        non_reco_count = total_count - reco_count
+        return frac_energy, [
+            frac_energy_true,
+            particle_ids,
+            (pids, reco_count),
+            (pids, non_reco_count),
+            (pids, total_count),
+        ]
+    # mean per event, then over the events with particles
+    has_particles = (n_particles_per_event > 0).float()
+    loss_E_frac = segment_csr(frac_energy, particle_offsets, reduce="mean")
+    loss_E_frac = (loss_E_frac * has_particles).sum() / has_particles.sum()
+    loss_E_frac_true = segment_csr(frac_energy_true, particle_offsets, reduce="mean")
+    loss_E_frac_true = (loss_E_frac_true * has_particles).sum() / has_particles.sum()
     return loss_E_frac, loss_E_frac_true
 
 
 def get_clustering(index_alpha_i, X, betas, td=0.7):
-    n_points = betas.size(0)
-    unassigned = torch.arange(n_points).to(betas.device)
-    clustering = -1 * torch.ones(n_points, dtype=torch.long)
-    counter = 0
-    for index_condpoint in index_alpha_i:
-        d = torch.norm(X[unassigned] - X[index_condpoint], dim=-1)
-        assigned_to_this_condpoint = unassigned[d < td]
-        clustering[assigned_to_this_condpoint] = counter
-        unassigned = unassigned[~(d < td)]
-        counter = counter + 1
-    counter = 0
-    for index_condpoint in index_alpha_i:
-        clustering[index_condpoint] = counter
-        counter = counter + 1
+    # greedy assignment in the order of index_alpha_i, the centers themselves
+    # always belong to their own cluster
+    index_alpha_i = torch.as_tensor(index_alpha_i).cpu()
+    clustering = torch.from_numpy(
+        greedy_assignment(X.detach().cpu().numpy(), index_alpha_i.numpy(), td)
+    ).long()
+    clustering[index_alpha_i] = torch.arange(index_alpha_i.shape[0])
 
     return clustering
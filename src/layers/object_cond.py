@@ -1,8 +1,12 @@
 from typing import Tuple, Union
 import numpy as np
 import torch
+from torch.profiler import record_function
 from torch_scatter import scatter_max, scatter_add, scatter_mean
 from src.layers.loss_fill_space_torch import LLFillSpace
+from src.layers.clustering import get_clustering_np
+from src.layers.segment import batch_to_offsets, segment_count, segment_sum
+from src.layers.truth_index import get_truth_index
 
 
 onehot_particles_arr = [
@@ -41,6 +45,17 @@ def safe_index(arr, index):
         return arr.index(index) + 1
 
 
+def onehot_particles_index(pids: torch.Tensor) -> torch.LongTensor:
+    """
+    safe_index for a tensor of PDG ids, on the device of pids
+    """
+    table = torch.tensor(onehot_particles_arr, device=pids.device)
+    match = pids.long().view(-1, 1) == table.view(1, -1)
+    return torch.where(
+        match.any(dim=1), match.long().argmax(dim=1) + 1, torch.zeros_like(table[:1])
+    )
+
+
 def assert_no_nans(x):
     """
     Raises AssertionError if there is a nan in the tensor
@@ -59,6 +74,127 @@ def debug(*args, **kwargs):
         print(*args, **kwargs)
 
 
+# Regression terms of calc_LV_Lbeta: energy, position (x), PID, momentum, mass
+REGRESSION_TERMS = ("E", "x", "PID", "momentum", "mass")
+
+
+def plan_regression_terms(clust_loss_only=False, add_energy_loss=False):
+    """
+    The regression terms calc_LV_Lbeta has to compute for a loss configuration
+    (see object_condensation_loss2 of the models); the others are skipped and
+    returned as zeros.
+    """
+    if not clust_loss_only:
+        return REGRESSION_TERMS
+    return ("E",) if add_energy_loss else ()
+
+
+class LossResult(object):
+    """
+    Loss terms returned by calc_LV_Lbeta. Everything stays on the device of the
+    loss: the PID labels and the resolutions are copied to the host only when
+    pid_true, pid_pred or resolutions are accessed (and then cached), so steps
+    that don't log them don't synchronize with the device.
+    Indexing with the positions of the former result tuple (a[0] is L_V, a[7]
+    pid_true, ...) still works.
+    """
+
+    fields = (
+        "L_V",  # 0
+        "L_beta",
+        "loss_E",
+        "loss_x",
+        "loss_particle_ids",  # 4
+        "loss_momentum",
+        "loss_mass",
+        "pid_true",
+        "pid_pred",
+        "resolutions",
+        "L_clusters",  # 10
+        "fill_loss",
+        "L_V_attractive",
+        "L_V_repulsive",
+        "L_alpha_coordinates",
+        "L_exp",
+        "norms_rep",  # 16
+        "norms_att",  # 17
+    )
+    __slots__ = (
+        "L_V",
+        "L_beta",
+        "loss_E",
+        "loss_x",
+        "loss_particle_ids",
+        "loss_momentum",
+        "loss_mass",
+        "pid_true_index",
+        "pid_pred_index",
+        "resolutions_device",
+        "L_clusters",
+        "fill_loss",
+        "L_V_attractive",
+        "L_V_repulsive",
+        "L_alpha_coordinates",
+        "L_exp",
+        "norms_rep",
+        "norms_att",
+        "_host",
+    )
+
+    def __init__(self, pid_true_index, pid_pred_index, resolutions_device, **losses):
+        self.pid_true_index = pid_true_index
+        self.pid_pred_index = pid_pred_index
+        self.resolutions_device = resolutions_device
+        for name in self.fields:
+            if name not in ("pid_true", "pid_pred", "resolutions"):
+                setattr(self, name, losses[name])
+        self._host = {}
+
+    @property
+    def pid_true(self):
+        if "pid_true" not in self._host:
+            self._host["pid_true"] = self.pid_true_index.cpu().tolist()
+        return self._host["pid_true"]
+
+    @property
+    def pid_pred(self):
+        if "pid_pred" not in self._host:
+            self._host["pid_pred"] = self.pid_pred_index.cpu().tolist()
+        return self._host["pid_pred"]
+
+    @property
+    def resolutions(self):
+        """
+        Dict of numpy arrays: momentum_res, e_res and pos_res
+        """
+        if "resolutions" not in self._host:
+            self._host["resolutions"] = {
+                key: val.cpu().numpy() for key, val in self.resolutions_device.items()
+            }
+        return self._host["resolutions"]
+
+    def detach(self):
+        """
+        Copy without the autograd graph, e.g. to keep the result across steps
+        """
+        result = LossResult.__new__(LossResult)
+        for name in self.__slots__:
+            val = getattr(self, name)
+            setattr(result, name, val.detach() if torch.is_tensor(val) else val)
+        return result
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self)[index]
+        return getattr(self, self.fields[index])
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __iter__(self):
+        return (getattr(self, name) for name in self.fields)
+
+
 def calc_energy_pred(
     batch,
     g,
@@ -69,65 +205,73 @@ def calc_energy_pred(
     energy_correction,
     pid_results,
     hit_mom,
+    truth_index=None,
 ):
+    """
+    Sums the corrected hit energies, PID embeddings and momenta of the hits
+    assigned to every object. Each object's condensation point (its max-q hit)
+    takes the hits within td of it in position space; when several objects of
+    an event are in reach, a hit goes to the first one in object order (what
+    a greedy pass over the objects gives). Returns (n_objects, ...) tensors,
+    ordered by object like the rest of calc_LV_Lbeta. truth_index (see
+    get_truth_index) can be given when is_sig are the signal hits of the truth.
+    """
     td = 0.7
-    batch_number = torch.max(batch) + 1
-    energies = []
-    pid_outputs = []
-    momenta = []
-    for i in range(0, batch_number):
-        mask_batch = batch == i
-        X = g.ndata["pos_hits_norm"][mask_batch]
-        cluster_index_i = cluster_index_per_event[mask_batch] - 1
-        is_sig_i = is_sig[mask_batch]
-
-        q_i = q[mask_batch]
-        betas = beta[mask_batch]
-        q_alpha_i, index_alpha_i = scatter_max(q_i[is_sig_i], cluster_index_i)
-        n_points = betas.size(0)
-        unassigned = torch.arange(n_points).to(betas.device)
-        clustering = -1 * torch.ones(n_points, dtype=torch.long)
-        counter = 0
-        # index_alpha_i -= 1
-        for index_condpoint in index_alpha_i:
-            d = torch.norm(X[unassigned] - X[index_condpoint], dim=-1)
-            assigned_to_this_condpoint = unassigned[d < td]
-            clustering[assigned_to_this_condpoint] = counter
-            unassigned = unassigned[~(d < td)]
-            counter = counter + 1
-        counter = 0
-        for index_condpoint in index_alpha_i:
-            clustering[index_condpoint] = counter
-            counter = counter + 1
-        if torch.sum(clustering == -1) > 0:
-            clustering_ = clustering + 1
-        else:
-            clustering_ = clustering
-        clus_values = np.unique(clustering)
-        e_c = g.ndata["e_hits"][mask_batch][is_sig_i].view(-1) * energy_correction[
-            mask_batch
-        ][is_sig_i].view(-1)
-        mom_c = hit_mom[mask_batch][is_sig_i].view(-1)
-        # pid_results_i = pid_results[mask_batch][is_sig_i][index_alpha_i]
-        pid_results_i = scatter_add(
-            pid_results[mask_batch][is_sig_i],
-            clustering_.long().to(pid_results.device),
-            dim=0,
+    X = g.ndata["pos_hits_norm"]
+    sig_index = torch.nonzero(is_sig).view(-1)
+    if truth_index is not None:
+        object_index = truth_index.object_index
+    else:
+        object_index, _ = batch_cluster_indices(
+            cluster_index_per_event[is_sig] - 1, batch[is_sig]
         )
-        #  aggregated "PID embeddings"
-        e_objects = scatter_add(e_c, clustering_.long().to(e_c.device))
-        mom_objects = scatter_add(mom_c, clustering_.long().to(mom_c.device))
-        e_objects = e_objects[clus_values != -1]
-        pid_results_i = pid_results_i[clus_values != -1]
-        mom_objects = mom_objects[clus_values != -1]
-        energies.append(e_objects)
-        pid_outputs.append(pid_results_i)
-        momenta.append(mom_objects)
-    return (
-        torch.cat(energies, dim=0),
-        torch.cat(pid_outputs, dim=0),
-        torch.cat(momenta, dim=0),
+    _, index_alpha = scatter_max(q[is_sig], object_index)
+    n_objects = index_alpha.size(0)
+    condpoints = sig_index[index_alpha]
+    if truth_index is not None:
+        object_offsets = truth_index.object_offsets
+    else:
+        object_offsets = batch_to_offsets(batch[condpoints], batch.max() + 1)
+
+    clustering = assign_to_condpoints(X, batch, condpoints, object_offsets, td)
+
+    # unassigned hits are summed into an extra last row, which is dropped
+    clustering_sig = clustering[is_sig]
+    e_c = g.ndata["e_hits"][is_sig].view(-1) * energy_correction[is_sig].view(-1)
+    mom_c = hit_mom[is_sig].view(-1)
+    #  aggregated "PID embeddings"
+    pid_objects = scatter_add(
+        pid_results[is_sig], clustering_sig, dim=0, dim_size=n_objects + 1
     )
+    e_objects = scatter_add(e_c, clustering_sig, dim_size=n_objects + 1)
+    mom_objects = scatter_add(mom_c, clustering_sig, dim_size=n_objects + 1)
+    return e_objects[:-1], pid_objects[:-1], mom_objects[:-1]
+
+
+def assign_to_condpoints(X, batch, condpoints, condpoint_offsets, td):
+    """
+    Greedy assignment of hits to condensation points, for all events at once:
+    going through the condensation points of an event in order, each takes the
+    unassigned hits within td, i.e. a hit goes to the first condensation point
+    in reach. Condensation points always belong to themselves.
+    :param condpoints: hit index of the condensation points, ordered by event
+    :param condpoint_offsets: CSR offsets of the condensation points per event
+    :return: index of the condensation point for every hit, len(condpoints)
+        for unassigned hits
+    """
+    n_condpoints = condpoints.size(0)
+    # All (hit, condensation point) pairs within an event; a hit gets the
+    # lowest index in reach
+    hits, objects = event_block_pairs(batch, condpoint_offsets)
+    d = torch.norm(X[hits] - X[condpoints[objects]], dim=-1)
+    clustering = torch.full(
+        (batch.size(0),), n_condpoints, dtype=torch.long, device=batch.device
+    )
+    clustering = clustering.scatter_reduce(
+        0, hits, torch.where(d < td, objects, n_condpoints), reduce="amin"
+    )
+    clustering[condpoints] = torch.arange(n_condpoints, device=batch.device)
+    return clustering
 
 
 def calc_pred_pid(batch, g, cluster_index_per_event, is_sig, q, beta, pred_pid):
@@ -141,6 +285,7 @@ def calc_pred_pid(batch, g, cluster_index_per_event, is_sig, q, beta, pred_pid):
     return torch.cat(outputs, dim=0)
 
 
+@record_function("calc_LV_Lbeta")
 def calc_LV_Lbeta(
     original_coords,
     g,
@@ -170,6 +315,8 @@ def calc_LV_Lbeta(
     fill_loss_weight=0.0,
     use_average_cc_pos=0.0,
     hgcal_implementation=False,
+    regression_terms=REGRESSION_TERMS,
+    truth=False,
 ) -> Union[Tuple[torch.Tensor, torch.Tensor], dict]:
     """
     Calculates the L_V and L_beta object condensation losses.
@@ -191,9 +338,22 @@ def calc_LV_Lbeta(
         beta points, acting like V_attractive.
     Note this function has modifications w.r.t. the implementation in 2002.03605:
     - The norms for V_repulsive are now Gaussian (instead of linear hinge)
+    regression_terms: the regression terms (see REGRESSION_TERMS and
+        plan_regression_terms) to compute; the others are returned as zeros
+        without computing their ingredients.
+    truth: cluster_index_per_event is the particle_number of the hits of g, so
+        the truth index precomputed by graph_batch_func can be used.
     """
     # remove dummy rows added for dataloader #TODO think of better way to do this
     device = beta.device
+    if return_regression_resolution:
+        regression_terms = REGRESSION_TERMS
+    unknown_terms = set(regression_terms) - set(REGRESSION_TERMS)
+    if unknown_terms:
+        raise ValueError(f"Regression terms {unknown_terms} are not known")
+    # the energy prediction also gives the summed PID embeddings and momenta
+    need_energy_pred = any(t in regression_terms for t in ("E", "PID", "momentum", "mass"))
+    zero = torch.zeros((), device=device)
     assert_no_nans(beta)
     # ________________________________
 
@@ -202,44 +362,34 @@ def calc_LV_Lbeta(
     # cluster_index: unique index over events
     # E.g. cluster_index_per_event=[ 0, 0, 1, 2, 0, 0, 1], batch=[0, 0, 0, 0, 1, 1, 1]
     #      -> cluster_index=[ 0, 0, 1, 2, 3, 3, 4 ]
-    cluster_index, n_clusters_per_event = batch_cluster_indices(
-        cluster_index_per_event, batch
-    )
-    n_clusters = n_clusters_per_event.sum()
-    n_hits, cluster_space_dim = cluster_space_coords.size()
-    batch_size = batch.max() + 1
-    n_hits_per_event = scatter_count(batch)
-
-    # Index of cluster -> event (n_clusters,)
-    batch_cluster = scatter_counts_to_indices(n_clusters_per_event)
-
-    # Per-hit boolean, indicating whether hit is sig or noise
-    is_noise = cluster_index_per_event == noise_cluster_index
-    is_sig = ~is_noise
-    n_hits_sig = is_sig.sum()
-    n_sig_hits_per_event = scatter_count(batch[is_sig])
-
-    # Per-cluster boolean, indicating whether cluster is an object or noise
-    is_object = scatter_max(is_sig.long(), cluster_index)[0].bool()
-    is_noise_cluster = ~is_object
-
     # FIXME: This assumes noise_cluster_index == 0!!
     # Not sure how to do this in a performant way in case noise_cluster_index != 0
     if noise_cluster_index != 0:
         raise NotImplementedError
-    object_index_per_event = cluster_index_per_event[is_sig] - 1
-    object_index, n_objects_per_event = batch_cluster_indices(
-        object_index_per_event, batch[is_sig]
+    # Precomputed by graph_batch_func in the loader workers when available
+    truth_index = get_truth_index(
+        g, cluster_index_per_event, batch, device=device, truth=truth
     )
-    n_hits_per_object = scatter_count(object_index)
-    # print("n_hits_per_object", n_hits_per_object)
-    batch_object = batch_cluster[is_object]
-    n_objects = is_object.sum()
+    cluster_index = truth_index.cluster_index
+    n_hits, cluster_space_dim = cluster_space_coords.size()
+    assert truth_index.n_hits == n_hits
+    batch_size = truth_index.batch_size
+    # batches are sorted by event, so per-event sums are segment reductions
+    event_offsets = truth_index.event_offsets
+    n_hits_per_event = truth_index.n_hits_per_event
+
+    # Per-hit boolean, indicating whether hit is sig or noise
+    is_sig = truth_index.is_sig
+    is_noise = ~is_sig
+    n_hits_sig = truth_index.object_index.size(0)
+
+    object_index = truth_index.object_index
+    n_objects_per_event = truth_index.n_objects_per_event
+    n_hits_per_object = truth_index.n_hits_per_object
+    object_offsets = truth_index.object_offsets
+    n_objects = truth_index.n_objects
 
-    assert object_index.size() == (n_hits_sig,)
-    assert is_object.size() == (n_clusters,)
     assert torch.all(n_hits_per_object > 0)
-    assert object_index.max() + 1 == n_objects
 
     # ________________________________
     # L_V term
@@ -284,128 +434,108 @@ def calc_LV_Lbeta(
     assert x_alpha.size() == (n_objects, cluster_space_dim)
     assert beta_alpha.size() == (n_objects,)
 
-    positions_particles_pred = g.ndata["pos_hits_norm"][is_sig][index_alpha]
-    positions_particles_pred = (
-        positions_particles_pred + distance_threshold[is_sig][index_alpha]
-    )
-
-    # e_particles_pred = g.ndata["e_hits"][is_sig][index_alpha]
-    # e_particles_pred = e_particles_pred * energy_correction[is_sig][index_alpha]
-    # particles pred updated to follow end-to-end paper approach, sum the particles in the object and multiply by the correction factor of alpha (the cluster center)
-    # e_particles_pred = (scatter_add(g.ndata["e_hits"][is_sig].view(-1), object_index)*energy_correction[is_sig][index_alpha].view(-1)).view(-1,1)
-    e_particles_pred, pid_particles_pred, mom_particles_pred = calc_energy_pred(
-        batch,
-        g,
-        cluster_index_per_event,
-        is_sig,
-        q,
-        beta,
-        energy_correction,
-        predicted_pid,
-        momentum,
-    )
-
     if fill_loss_weight > 0:
         fill_loss = fill_loss_weight * LLFillSpace()(cluster_space_coords, batch)
     else:
         fill_loss = 0
-    pid_particles_pred = post_pid_pool_module(
-        pid_particles_pred
-    )  # Project the pooled PID embeddings to the final "one hot encoding" space
-    # pid_particles_pred = calc_pred_pid(
-    #    batch, g, cluster_index_per_event, is_sig, q, beta, predicted_pid
-    # )
-    x_particles = y[:, 0:3]
-    e_particles = y[:, 3]
-    mom_particles_true = y[:, 4]
-    mass_particles_true = y[:, 5]
+
+    # ________________________________
+    # Regression terms, only the ones in regression_terms are computed
+
+    x_particles = y[:, 0:3].to(device)
+    e_particles = y[:, 3].to(device)
+    mom_particles_true = y[:, 4].to(device)
+    mass_particles_true = y[:, 5].to(device)
     # particles_mask = y[:, 6]
-    mom_particles_true = mom_particles_true.to(device)
-    mass_particles_pred = e_particles_pred**2 - mom_particles_pred**2
-    mass_particles_true = mass_particles_true.to(device)
-    mass_particles_pred[mass_particles_pred < 0] = 0.0
-    mass_particles_pred = torch.sqrt(mass_particles_pred)
-    loss_mass = torch.nn.MSELoss()(
-        mass_particles_true, mass_particles_pred
-    )  # only logging this, not using it in the loss func
-    pid_id_particles = y[:, 6].unsqueeze(1).long()
-    pid_particles_true = torch.zeros((pid_id_particles.shape[0], 22))
-    part_idx_onehot = [
-        safe_index(onehot_particles_arr, i) for i in pid_id_particles.flatten().tolist()
-    ]
-    pid_particles_true[torch.arange(pid_id_particles.shape[0]), part_idx_onehot] = 1.0
+    loss_E, loss_x, loss_particle_ids, loss_momentum, loss_mass = (zero,) * 5
+    resolutions = {}
+    pid_true = pid_pred = torch.zeros(0, dtype=torch.long, device=device)
+    if "x" in regression_terms:
+        positions_particles_pred = g.ndata["pos_hits_norm"][is_sig][index_alpha]
+        positions_particles_pred = (
+            positions_particles_pred + distance_threshold[is_sig][index_alpha]
+        )
+        loss_x = torch.nn.MSELoss()(positions_particles_pred, x_particles)
+        # loss_x = 0. # TEMPORARILY, there is some issue with X loss and it goes to \infty
+        resolutions["pos_res"] = (
+            positions_particles_pred.detach().flatten() - x_particles.flatten()
+        ) / x_particles.flatten()
+    if need_energy_pred:
+        # e_particles_pred = g.ndata["e_hits"][is_sig][index_alpha]
+        # e_particles_pred = e_particles_pred * energy_correction[is_sig][index_alpha]
+        # particles pred updated to follow end-to-end paper approach, sum the particles in the object and multiply by the correction factor of alpha (the cluster center)
+        # e_particles_pred = (scatter_add(g.ndata["e_hits"][is_sig].view(-1), object_index)*energy_correction[is_sig][index_alpha].view(-1)).view(-1,1)
+        e_particles_pred, pid_particles_pred, mom_particles_pred = calc_energy_pred(
+            batch,
+            g,
+            cluster_index_per_event,
+            is_sig,
+            q,
+            beta,
+            energy_correction,
+            predicted_pid,
+            momentum,
+            truth_index=truth_index,
+        )
+    if "E" in regression_terms:
+        loss_E = torch.mean(
+            torch.square((e_particles_pred - e_particles) / e_particles)
+        )
+        resolutions["e_res"] = (
+            e_particles_pred.detach().flatten() - e_particles
+        ) / e_particles
+    if "momentum" in regression_terms:
+        loss_momentum = torch.mean(
+            torch.square((mom_particles_pred - mom_particles_true) / mom_particles_true)
+        )
+        resolutions["momentum_res"] = (
+            mom_particles_pred.detach().flatten() - mom_particles_true
+        ) / mom_particles_true
+    if "mass" in regression_terms:
+        mass_particles_pred = e_particles_pred**2 - mom_particles_pred**2
+        mass_particles_pred[mass_particles_pred < 0] = 0.0
+        mass_particles_pred = torch.sqrt(mass_particles_pred)
+        loss_mass = torch.nn.MSELoss()(
+            mass_particles_true, mass_particles_pred
+        )  # only logging this, not using it in the loss func
+    if "PID" in regression_terms:
+        pid_particles_pred = post_pid_pool_module(
+            pid_particles_pred
+        )  # Project the pooled PID embeddings to the final "one hot encoding" space
+        # pid_particles_pred = calc_pred_pid(
+        #    batch, g, cluster_index_per_event, is_sig, q, beta, predicted_pid
+        # )
+        part_idx_onehot = onehot_particles_index(y[:, 6].to(device))
+        pid_particles_true = torch.nn.functional.one_hot(part_idx_onehot, 22).float()
+        loss_particle_ids = torch.nn.BCELoss()(pid_particles_pred, pid_particles_true)
+        pid_true = part_idx_onehot
+        pid_pred = pid_particles_pred.detach().argmax(dim=1)
 
     if return_regression_resolution:
-        e_particles_pred = e_particles_pred.detach().flatten()
-        e_particles = e_particles.detach().flatten()
-        positions_particles_pred = positions_particles_pred.detach().flatten()
-        x_particles = x_particles.detach().flatten()
-        mom_particles_pred = mom_particles_pred.detach().flatten().to("cpu")
-        mom_particles_true = mom_particles_true.detach().flatten().to("cpu")
         return (
-            {
-                "momentum_res": (
-                    (mom_particles_pred - mom_particles_true) / mom_particles_true
-                ).tolist(),
-                "e_res": ((e_particles_pred - e_particles) / e_particles).tolist(),
-                "pos_res": (
-                    (positions_particles_pred - x_particles) / x_particles
-                ).tolist(),
-            },
+            {key: val.tolist() for key, val in resolutions.items()},
             pid_particles_true,
             pid_particles_pred,
         )
 
-    loss_E = torch.mean(
-        torch.square(
-            (e_particles_pred.to(device) - e_particles.to(device))
-            / e_particles.to(device)
-        )
-    )
-    loss_momentum = torch.mean(
-        torch.square(
-            (mom_particles_pred.to(device) - mom_particles_true.to(device))
-            / mom_particles_true.to(device)
-        )
-    )
-    loss_ce = torch.nn.BCELoss()
-    loss_mse = torch.nn.MSELoss()
-    loss_x = loss_mse(positions_particles_pred.to(device), x_particles.to(device))
-    # loss_x = 0. # TEMPORARILY, there is some issue with X loss and it goes to \infty
-    loss_particle_ids = loss_ce(
-        pid_particles_pred.to(device), pid_particles_true.to(device)
-    )
-    pid_true = pid_particles_true.argmax(dim=1).detach().tolist()
-    pid_pred = pid_particles_pred.argmax(dim=1).detach().tolist()
-    # pid_true = [pid_dict[i.long().item()] for i in pid_true]
-    # pid_pred = [pid_dict[i.long().item()] for i in pid_pred]
-    # Connectivity matrix from hit (row) -> cluster (column)
-    # Index to matrix, e.g.:
-    # [1, 3, 1, 0] --> [
-    #     [0, 1, 0, 0],
-    #     [0, 0, 0, 1],
-    #     [0, 1, 0, 0],
-    #     [1, 0, 0, 0]
-    #     ]
-    M = torch.nn.functional.one_hot(cluster_index).long()
-
-    # Anti-connectivity matrix; be sure not to connect hits to clusters in different events!
-    M_inv = get_inter_event_norms_mask(batch, n_clusters_per_event) - M
-
-    # Throw away noise cluster columns; we never need them
-    M = M[:, is_object]
-    M_inv = M_inv[:, is_object]
-    assert M.size() == (n_hits, n_objects)
-    assert M_inv.size() == (n_hits, n_objects)
-
-    # Calculate all norms
-    # Warning: Should not be used without a mask!
-    # Contains norms between hits and objects from different events
-    # (n_hits, 1, cluster_space_dim) - (1, n_objects, cluster_space_dim)
-    #   gives (n_hits, n_objects, cluster_space_dim)
-    norms = (cluster_space_coords.unsqueeze(1) - x_alpha.unsqueeze(0)).norm(dim=-1)
-    assert norms.size() == (n_hits, n_objects)
-    L_clusters = torch.tensor(0.0).to(device)
+    # Only (hit, object) pairs within the same event are needed: the attractive
+    # term uses the pairs of signal hits with their own object, the repulsive
+    # term the pairs of all hits with the other objects of their event. The
+    # pairs are enumerated per event block instead of building dense
+    # (n_hits, n_objects) matrices for the whole batch.
+    own_object = -torch.ones(n_hits, dtype=torch.long, device=device)
+    own_object[is_sig] = object_index
+    hit_pairs, object_pairs = event_block_pairs(batch, object_offsets)
+    not_own = object_pairs != own_object[hit_pairs]
+    hit_pairs, object_pairs = hit_pairs[not_own], object_pairs[not_own]
+
+    # Norms of the signal hits w.r.t. the object they belong to, and of all
+    # hits w.r.t. the other objects in the event
+    norms_sig = (cluster_space_coords[is_sig] - x_alpha[object_index]).norm(dim=-1)
+    norms_pairs = (
+        cluster_space_coords[hit_pairs] - x_alpha[object_pairs]
+    ).norm(dim=-1)
+    L_clusters = zero
     if frac_combinations != 0:
         L_clusters = L_clusters_calc(
             batch, cluster_space_coords, cluster_index, frac_combinations, q
@@ -414,95 +544,72 @@ def calc_LV_Lbeta(
     # -------
     # Attractive potential term
 
-    # First get all the relevant norms: We only want norms of signal hits
-    # w.r.t. the object they belong to, i.e. no noise hits and no noise clusters.
-    # First select all norms of all signal hits w.r.t. all objects, mask out later
-
     if hgcal_implementation:
-        norms = (cluster_space_coords.unsqueeze(1) - x_alpha.unsqueeze(0)).norm(
-            p=2, dim=-1
-        )
-        norms_att = norms[is_sig]
         #! att func as in line 159 of object condensation
         norms_att = torch.log(
-            torch.exp(torch.Tensor([1]).to(norms_att.device)) * norms_att / 2 + 1
+            torch.exp(torch.Tensor([1]).to(norms_sig.device)) * norms_sig / 2 + 1
         )
         # Power-scale the norms
     elif huberize_norm_for_V_attractive:
-        norms_att = norms[is_sig]
         # Huberized version (linear but times 4)
-        # Be sure to not move 'off-diagonal' away from zero
-        # (i.e. norms of hits w.r.t. clusters they do _not_ belong to)
-        norms_att = huber(norms_att + 1e-5, 4.0)
+        norms_att = huber(norms_sig + 1e-5, 4.0)
     else:
-        norms_att = norms[is_sig]
-        # Paper version is simply norms squared (no need for mask)
-        norms_att = norms_att**2
-    assert norms_att.size() == (n_hits_sig, n_objects)
+        # Paper version is simply norms squared
+        norms_att = norms_sig**2
+    assert norms_att.size() == (n_hits_sig,)
 
-    # Now apply the mask to keep only norms of signal hits w.r.t. to the object
-    # they belong to
-    norms_att *= M[is_sig]
-
-    # Final potential term
-    # (n_sig_hits, 1) * (1, n_objects) * (n_sig_hits, n_objects)
-    V_attractive = q[is_sig].unsqueeze(-1) * q_alpha.unsqueeze(0) * norms_att
-    assert V_attractive.size() == (n_hits_sig, n_objects)
+    # Final potential term, per signal hit
+    V_attractive = q[is_sig] * q_alpha[object_index] * norms_att
+    # Sum over hits per object
+    V_attractive = scatter_add(V_attractive, object_index, dim_size=int(n_objects))
 
     # Sum over hits, then sum per event, then divide by n_hits_per_event, then sum over events
     if hgcal_implementation:
         #! each shower is account for separately
-        V_attractive = V_attractive.sum(dim=0)  # K objects
         #! divide by the number of hits per object
         V_attractive = V_attractive / n_hits_per_object
 
         #! add to terms function (divide by total number of showers per event)
-        L_V_attractive = scatter_add(V_attractive, batch_object) / n_objects_per_event
+        L_V_attractive = segment_sum(V_attractive, object_offsets) / n_objects_per_event
         L_V_attractive = torch.sum(L_V_attractive)
 
     else:
         #! in comparison this works per hit
-        V_attractive = (
-            scatter_add(V_attractive.sum(dim=0), batch_object) / n_hits_per_event
-        )
+        V_attractive = segment_sum(V_attractive, object_offsets) / n_hits_per_event
         assert V_attractive.size() == (batch_size,)
         L_V_attractive = V_attractive.sum()
 
     # -------
     # Repulsive potential term
 
-    # Get all the relevant norms: We want norms of any hit w.r.t. to
-    # objects they do *not* belong to, i.e. no noise clusters.
-    # We do however want to keep norms of noise hits w.r.t. objects
-    # Power-scale the norms: Gaussian scaling term instead of a cone
-    # Mask out the norms of hits w.r.t. the cluster they belong to
+    # Norms of any hit w.r.t. to the objects of its event it does *not* belong
+    # to, i.e. no noise clusters. We do however keep norms of noise hits w.r.t.
+    # objects. Power-scale the norms: Gaussian scaling term instead of a cone
     if hgcal_implementation:
-        norms_rep = torch.exp(-(norms**2) / 2) * M_inv
+        norms_rep = torch.exp(-(norms_pairs**2) / 2)
     else:
-        norms_rep = torch.exp(-4.0 * norms**2) * M_inv
+        norms_rep = torch.exp(-4.0 * norms_pairs**2)
 
-    # (n_sig_hits, 1) * (1, n_objects) * (n_sig_hits, n_objects)
-    V_repulsive = q.unsqueeze(1) * q_alpha.unsqueeze(0) * norms_rep
+    V_repulsive = q[hit_pairs] * q_alpha[object_pairs] * norms_rep
     # No need to apply a V = max(0, V); by construction V>=0
-    assert V_repulsive.size() == (n_hits, n_objects)
+    # Sum over hits per object
+    V_repulsive = scatter_add(V_repulsive, object_pairs, dim_size=int(n_objects))
 
     # Sum over hits, then sum per event, then divide by n_hits_per_event, then sum up events
     nope = n_objects_per_event - 1
     nope[nope == 0] = 1
     if hgcal_implementation:
         #! sum each object repulsive terms
-        L_V_repulsive = V_repulsive.sum(dim=0)  # size number of objects
-        number_of_repulsive_terms_per_object = torch.sum(M_inv, dim=0)
-        L_V_repulsive = L_V_repulsive.view(
-            -1
-        ) / number_of_repulsive_terms_per_object.view(-1)
+        number_of_repulsive_terms_per_object = scatter_add(
+            torch.ones_like(object_pairs), object_pairs, dim_size=int(n_objects)
+        )
+        L_V_repulsive = V_repulsive / number_of_repulsive_terms_per_object
         #! add to terms function (divide by total number of showers per event)
-        L_V_repulsive = scatter_add(L_V_repulsive, batch_object) / n_objects_per_event
+        L_V_repulsive = segment_sum(L_V_repulsive, object_offsets) / n_objects_per_event
         L_V_repulsive = torch.sum(L_V_repulsive)
     else:
         L_V_repulsive = (
-            scatter_add(V_repulsive.sum(dim=0), batch_object)
-            / (n_hits_per_event * nope)
+            segment_sum(V_repulsive, object_offsets) / (n_hits_per_event * nope)
         ).sum()
 
     L_V = (
@@ -511,27 +618,26 @@ def calc_LV_Lbeta(
         # + L_clusters
         # + fill_loss
     )
-    if L_clusters != 0:
-        print(
+    if DEBUG and torch.is_tensor(L_clusters):
+        debug(
             "L-clusters is",
             100 * (L_clusters / L_V).detach().cpu().item(),
             "% of L_V. L_clusters value:",
             L_clusters.detach().cpu().item(),
         )
-    else:
-        print("L-clusters is ZERO")
     # ________________________________
     # L_beta term
 
     # -------
     # L_beta noise term
 
-    n_noise_hits_per_event = scatter_count(batch[is_noise])
+    noise_offsets = truth_index.noise_offsets
+    n_noise_hits_per_event = segment_count(noise_offsets)
     n_noise_hits_per_event[n_noise_hits_per_event == 0] = 1
     L_beta_noise = (
         s_B
         * (
-            (scatter_add(beta[is_noise], batch[is_noise])) / n_noise_hits_per_event
+            (segment_sum(beta[is_noise], noise_offsets)) / n_noise_hits_per_event
         ).sum()
     )
 
@@ -548,7 +654,7 @@ def calc_LV_Lbeta(
     if beta_term_option == "paper":
 
         L_beta_sig = (
-            scatter_add((1 - beta_alpha), batch_object) / n_objects_per_event
+            segment_sum((1 - beta_alpha), object_offsets) / n_objects_per_event
         ).sum()
 
         beta_exp = beta[is_sig]
@@ -562,8 +668,8 @@ def calc_LV_Lbeta(
         # belong to (like in V_attractive)
         # Apply transformation first, and then apply mask to keep only the norms we want,
         # then sum over hits, so the result is (n_objects,)
-        norms_beta_sig = (1.0 / (20.0 * norms[is_sig] ** 2 + 1.0) * M[is_sig]).sum(
-            dim=0
+        norms_beta_sig = scatter_add(
+            1.0 / (20.0 * norms_sig**2 + 1.0), object_index, dim_size=int(n_objects)
         )
         assert torch.all(norms_beta_sig >= 1.0) and torch.all(
             norms_beta_sig <= n_hits_per_object
@@ -578,7 +684,7 @@ def calc_LV_Lbeta(
 
         # Sum over objects, divide by number of objects per event, then sum over events
         L_beta_norms_term = (
-            scatter_add(norms_beta_sig, batch_object) / n_objects_per_event
+            segment_sum(norms_beta_sig, object_offsets) / n_objects_per_event
         ).sum()
         assert L_beta_norms_term >= -batch_size and L_beta_norms_term <= 0.0
 
@@ -586,7 +692,7 @@ def calc_LV_Lbeta(
         # divide by n_objects_per_event, then sum over events (same pattern as above)
         # lower beta --> higher loss
         L_beta_logbeta_term = (
-            scatter_add(-0.2 * torch.log(beta_alpha + 1e-9), batch_object)
+            segment_sum(-0.2 * torch.log(beta_alpha + 1e-9), object_offsets)
             / n_objects_per_event
         ).sum()
 
@@ -625,44 +731,26 @@ def calc_LV_Lbeta(
         print(L_beta, batch_size)
         print("L_beta_noise", L_beta_noise)
         print("L_beta_sig", L_beta_sig)
-    e_particles_pred = e_particles_pred.detach().to("cpu").flatten()
-    e_particles = e_particles.detach().to("cpu").flatten()
-    positions_particles_pred = positions_particles_pred.detach().to("cpu").flatten()
-    x_particles = x_particles.detach().to("cpu").flatten()
-    mom_particles_pred = mom_particles_pred.detach().flatten().to("cpu")
-    mom_particles_true = mom_particles_true.detach().flatten().to("cpu")
-    resolutions = {
-        "momentum_res": (
-            (mom_particles_pred - mom_particles_true) / mom_particles_true
-        ),
-        "e_res": ((e_particles_pred - e_particles) / e_particles).tolist(),
-        "pos_res": ((positions_particles_pred - x_particles) / x_particles).tolist(),
-    }
-    # also return pid_true an<d pid_pred here to log the confusion matrix at each validation step
-    # try:
-    #    L_clusters = L_clusters.detach().cpu().item()  # if L_clusters is zero
-    # except:
-    #    pass
-
-    return (
-        L_V / batch_size,  # 0
-        L_beta / batch_size,
-        loss_E,
-        loss_x,
-        loss_particle_ids,  # 4
-        loss_momentum,
-        loss_mass,
+    # pid_true and pid_pred are also returned to log the confusion matrix at each validation step
+    return LossResult(
         pid_true,
         pid_pred,
         resolutions,
-        L_clusters,  # 10
-        fill_loss,
-        L_V_attractive / batch_size,
-        L_V_repulsive / batch_size,
-        L_alpha_coordinates,
-        L_exp,
-        norms_rep,  # 16
-        norms_att,  # 17
+        L_V=L_V / batch_size,
+        L_beta=L_beta / batch_size,
+        loss_E=loss_E,
+        loss_x=loss_x,
+        loss_particle_ids=loss_particle_ids,
+        loss_momentum=loss_momentum,
+        loss_mass=loss_mass,
+        L_clusters=L_clusters,
+        fill_loss=fill_loss,
+        L_V_attractive=L_V_attractive / batch_size,
+        L_V_repulsive=L_V_repulsive / batch_size,
+        L_alpha_coordinates=L_alpha_coordinates,
+        L_exp=L_exp,
+        norms_rep=norms_rep,
+        norms_att=norms_att,
     )
 
 
@@ -1038,34 +1126,6 @@ def batch_cluster_indices(
     return offset + cluster_id, n_clusters_per_event
 
 
-def get_clustering_np(
-    betas: np.array, X: np.array, tbeta: float = 0.1, td: float = 1.0
-) -> np.array:
-    """
-    Returns a clustering of hits -> cluster_index, based on the GravNet model
-    output (predicted betas and cluster space coordinates) and the clustering
-    parameters tbeta and td.
-    Takes numpy arrays as input.
-    """
-    n_points = betas.shape[0]
-    select_condpoints = betas > tbeta
-    # Get indices passing the threshold
-    indices_condpoints = np.nonzero(select_condpoints)[0]
-    # Order them by decreasing beta value
-    indices_condpoints = indices_condpoints[np.argsort(-betas[select_condpoints])]
-    # Assign points to condensation points
-    # Only assign previously unassigned points (no overwriting)
-    # Points unassigned at the end are bkg (-1)
-    unassigned = np.arange(n_points)
-    clustering = -1 * np.ones(n_points, dtype=np.int32)
-    for index_condpoint in indices_condpoints:
-        d = np.linalg.norm(X[unassigned] - X[index_condpoint], axis=-1)
-        assigned_to_this_condpoint = unassigned[d < td]
-        clustering[assigned_to_this_condpoint] = index_condpoint
-        unassigned = unassigned[~(d < td)]
-    return clustering
-
-
 def get_clustering(betas: torch.Tensor, X: torch.Tensor, tbeta=0.1, td=1.0):
     """
     Returns a clustering of hits -> cluster_index, based on the GravNet model
@@ -1073,23 +1133,10 @@ def get_clustering(betas: torch.Tensor, X: torch.Tensor, tbeta=0.1, td=1.0):
     parameters tbeta and td.
     Takes torch.Tensors as input.
     """
-    n_points = betas.size(0)
-    select_condpoints = betas > tbeta
-    # Get indices passing the threshold
-    indices_condpoints = select_condpoints.nonzero()
-    # Order them by decreasing beta value
-    indices_condpoints = indices_condpoints[(-betas[select_condpoints]).argsort()]
-    # Assign points to condensation points
-    # Only assign previously unassigned points (no overwriting)
-    # Points unassigned at the end are bkg (-1)
-    unassigned = torch.arange(n_points)
-    clustering = -1 * torch.ones(n_points, dtype=torch.long)
-    for index_condpoint in indices_condpoints:
-        d = torch.norm(X[unassigned] - X[index_condpoint][0], dim=-1)
-        assigned_to_this_condpoint = unassigned[d < td]
-        clustering[assigned_to_this_condpoint] = index_condpoint[0]
-        unassigned = unassigned[~(d < td)]
-    return clustering
+    clustering = get_clustering_np(
+        betas.detach().cpu().numpy(), X.detach().cpu().numpy(), tbeta=tbeta, td=td
+    )
+    return torch.from_numpy(clustering).long()
 
 
 def scatter_count(input: torch.Tensor):
@@ -1105,6 +1152,27 @@ def scatter_count(input: torch.Tensor):
     return scatter_add(torch.ones_like(input, dtype=torch.long), input.long())
 
 
+def event_block_pairs(batch: torch.LongTensor, object_offsets: torch.LongTensor):
+    """
+    Enumerates all (hit, object) pairs within the same event, given the sorted
+    event index of the hits and the CSR offsets of the objects per event.
+    Example:
+    batch = [0, 0, 1], object_offsets = [0, 2, 3]
+    -->
+    hits    = [0, 0, 1, 1, 2]
+    objects = [0, 1, 0, 1, 2]
+    """
+    n_objects_per_hit = segment_count(object_offsets)[batch]
+    hits = torch.repeat_interleave(
+        torch.arange(batch.size(0), device=batch.device), n_objects_per_hit
+    )
+    # position of every pair within the block of its hit
+    pair_start = torch.cumsum(n_objects_per_hit, dim=0) - n_objects_per_hit
+    position = torch.arange(hits.size(0), device=batch.device) - pair_start[hits]
+    objects = object_offsets[batch][hits] + position
+    return hits, objects
+
+
 def scatter_counts_to_indices(input: torch.LongTensor) -> torch.LongTensor:
     """
     Converts counts to indices. This is the inverse operation of scatter_count
@@ -1199,102 +1267,62 @@ def reincrementalize(y: torch.Tensor, batch: torch.Tensor) -> torch.Tensor:
 
 
 def L_clusters_calc(batch, cluster_space_coords, cluster_index, frac_combinations, q):
-    number_of_pairs = 0
-    for batch_id in batch.unique():
-        # do all possible pairs...
-        bmask = batch == batch_id
-        clust_space_filt = cluster_space_coords[bmask]
-        pos_pairs_all = []
-        neg_pairs_all = []
-        if len(cluster_index[bmask].unique()) <= 1:
-            continue
-        L_clusters = torch.tensor(0.0).to(q.device)
-        for cluster in cluster_index[bmask].unique():
-            coords_pos = clust_space_filt[cluster_index[bmask] == cluster]
-            coords_neg = clust_space_filt[cluster_index[bmask] != cluster]
-            if len(coords_neg) == 0:
-                continue
-            clust_idx = cluster_index[bmask] == cluster
-            # all_ones = torch.ones_like((clust_idx, clust_idx))
-            # pos_pairs = [[i, j] for i in range(len(coords_pos)) for j in range (len(coords_pos)) if i < j]
-            total_num = (len(coords_pos) ** 2) / 2
-            num = int(frac_combinations * total_num)
-            pos_pairs = []
-            for i in range(num):
-                pos_pairs.append(
-                    [
-                        np.random.randint(len(coords_pos)),
-                        np.random.randint(len(coords_pos)),
-                    ]
-                )
-            neg_pairs = []
-            for i in range(len(pos_pairs)):
-                neg_pairs.append(
-                    [
-                        np.random.randint(len(coords_pos)),
-                        np.random.randint(len(coords_neg)),
-                    ]
-                )
-            pos_pairs_all += pos_pairs
-            neg_pairs_all += neg_pairs
-        pos_pairs = torch.tensor(pos_pairs_all)
-        neg_pairs = torch.tensor(neg_pairs_all)
-        """# do just a small sample of the pairs. ...
-        bmask = batch == batch_id
-
-        #L_clusters = 0   # Loss of randomly sampled distances between points inside and outside clusters
-
-        pos_idx, neg_idx = [], []
-        for cluster in cluster_index[bmask].unique():
-            clust_idx = (cluster_index == cluster)[bmask]
-            perm = torch.randperm(clust_idx.sum())
-            perm1 = torch.randperm((~clust_idx).sum())
-            perm2 = torch.randperm(clust_idx.sum())
-            #cutoff = clust_idx.sum()//2
-            pos_lst = clust_idx.nonzero()[perm]
-            neg_lst = (~clust_idx).nonzero()[perm1]
-            neg_lst_second = clust_idx.nonzero()[perm2]
-            if len(pos_lst) % 2:
-                pos_lst = pos_lst[:-1]
-            if len(neg_lst) % 2:
-                neg_lst = neg_lst[:-1]
-            len_cap = min(len(pos_lst), len(neg_lst), len(neg_lst_second))
-            if len_cap % 2:
-                len_cap -= 1
-            pos_lst = pos_lst[:len_cap]
-            neg_lst = neg_lst[:len_cap]
-            neg_lst_second = neg_lst_second[:len_cap]
-            pos_pairs = pos_lst.reshape(-1, 2)
-            neg_pairs = torch.cat([neg_lst, neg_lst_second], dim=1)
-            neg_pairs = neg_pairs[:pos_lst.shape[0]//2, :]
-            pos_idx.append(pos_pairs)
-            neg_idx.append(neg_pairs)
-        pos_idx = torch.cat(pos_idx)
-        neg_idx = torch.cat(neg_idx)"""
-        assert pos_pairs.shape == neg_pairs.shape
-        if len(pos_pairs) == 0:
-            continue
-        cluster_space_coords_filtered = cluster_space_coords[bmask]
-        qs_filtered = q[bmask]
-        pos_norms = (
-            cluster_space_coords_filtered[pos_pairs[:, 0]]
-            - cluster_space_coords_filtered[pos_pairs[:, 1]]
-        ).norm(dim=-1)
-
-        neg_norms = (
-            cluster_space_coords_filtered[neg_pairs[:, 0]]
-            - cluster_space_coords_filtered[neg_pairs[:, 1]]
-        ).norm(dim=-1)
-        q_pos = qs_filtered[pos_pairs[:, 0]]
-        q_neg = qs_filtered[neg_pairs[:, 0]]
-        q_s = torch.cat([q_pos, q_neg])
-        norms_pos = torch.cat([pos_norms, neg_norms])
-        ys = torch.cat([torch.ones_like(pos_norms), -torch.ones_like(neg_norms)])
-        L_clusters += torch.sum(
-            q_s * torch.nn.HingeEmbeddingLoss(reduce=None)(norms_pos, ys)
-        )
-        number_of_pairs += norms_pos.shape[0]
-    if number_of_pairs > 0:
-        L_clusters = L_clusters / number_of_pairs
-
-    return L_clusters
+    """
+    Hinge loss on randomly sampled pairs of hits: positive pairs are two hits
+    of the same cluster, negative pairs a hit of the cluster and a hit of
+    another cluster of the same event. Every cluster of an event with more
+    than one cluster draws int(frac_combinations * n_hits_cluster**2 / 2) pairs
+    of each kind. The pairs of the whole batch are sampled at once on the
+    device; the loss is weighted by q of the first hit of each pair and
+    averaged over all pairs.
+    cluster_index is the cluster index over the whole batch (see
+    batch_cluster_indices), batch is sorted.
+    """
+    device = q.device
+    n_clusters = int(cluster_index.max()) + 1
+    batch_size = int(batch.max()) + 1
+    # hits sorted by cluster; since the cluster index is ordered by event,
+    # every event is also a contiguous range in this order
+    order = torch.argsort(cluster_index, stable=True)
+    cluster_offsets = batch_to_offsets(cluster_index[order], n_clusters)
+    event_offsets = batch_to_offsets(batch, batch_size)
+    n_hits_cluster = segment_count(cluster_offsets)
+    cluster_event = scatter_max(batch, cluster_index, dim_size=n_clusters)[0]
+    cluster_start = cluster_offsets[:-1]
+    event_start = event_offsets[:-1][cluster_event]
+    n_neg_cluster = event_offsets[1:][cluster_event] - event_start - n_hits_cluster
+    n_pairs_cluster = (frac_combinations * n_hits_cluster**2 / 2).long()
+    n_pairs_cluster[n_neg_cluster == 0] = 0
+
+    pair_cluster = torch.repeat_interleave(
+        torch.arange(n_clusters, device=device), n_pairs_cluster
+    )
+    n_pairs = pair_cluster.size(0)
+    if n_pairs == 0:
+        return torch.tensor(0.0).to(device)
+
+    def sample(n):
+        return (torch.rand(n_pairs, device=device) * n).long()
+
+    n_pos = n_hits_cluster[pair_cluster]
+    start = cluster_start[pair_cluster]
+    pos_first = order[start + sample(n_pos)]
+    pos_second = order[start + sample(n_pos)]
+    neg_first = order[start + sample(n_pos)]
+    # random hit of the event outside of the cluster: skip the cluster's range
+    neg = event_start[pair_cluster] + sample(n_neg_cluster[pair_cluster])
+    neg_second = order[torch.where(neg >= start, neg + n_pos, neg)]
+
+    pos_norms = (
+        cluster_space_coords[pos_first] - cluster_space_coords[pos_second]
+    ).norm(dim=-1)
+    neg_norms = (
+        cluster_space_coords[neg_first] - cluster_space_coords[neg_second]
+    ).norm(dim=-1)
+    q_s = torch.cat([q[pos_first], q[neg_first]])
+    norms_pos = torch.cat([pos_norms, neg_norms])
+    ys = torch.cat([torch.ones_like(pos_norms), -torch.ones_like(neg_norms)])
+    L_clusters = torch.sum(
+        q_s * torch.nn.HingeEmbeddingLoss(reduction="none")(norms_pos, ys)
+    )
+    return L_clusters / norms_pos.shape[0]
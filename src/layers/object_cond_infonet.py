@@ -1,75 +1,83 @@
 from typing import Tuple, Union
 import numpy as np
 import torch
-from torch_scatter import scatter_max, scatter_add, scatter_mean
+from torch_scatter import scatter_max, scatter_add, scatter_mean, segment_csr
 from src.layers.loss_fill_space_torch import LLFillSpace
+from src.layers.object_cond import event_block_pairs
+from src.layers.segment import batch_to_offsets, segment_count
 import dgl
 
 
-def infonet_updated(g, qmin, xj, bj):
-    list_graphs = dgl.unbatch(g)
-    loss_total = 0
-    Loss_beta_zero = 0
-    number_particles_accounted_for = 0
-    node_counter = 0
-    Loss_beta = 0
-    for i in range(0, len(list_graphs)):
-        graph_eval = list_graphs[i]
-        non = graph_eval.number_of_nodes()
-        xj_graph = xj[node_counter : non + node_counter]
-        bj_graph = bj[node_counter : non + node_counter]
-        q_graph = bj_graph.arctanh() ** 2 + qmin
-        q = q_graph.detach().cpu().numpy()
-        part_num = graph_eval.ndata["particle_number"].view(-1).to(torch.long)
-        q_alpha, index_alpha = scatter_max(q_graph.view(-1), part_num - 1)
-        x_alpha = xj_graph[index_alpha]
-        number_of_particles = torch.unique(graph_eval.ndata["particle_number"])
-        indx = torch.zeros((len(number_of_particles), 50)).to(x_alpha.device)
-        b_alpha = bj_graph[index_alpha]
-        # beta_zero_loss = torch.sum(torch.exp(10 * bj_graph)) / non
-        beta_zero_loss = torch.sum(bj_graph) / non
-        if len(number_of_particles) > 1:
-            for nn in range(0, len(number_of_particles)):
-                idx_part = number_of_particles[nn]
-                positives_of_class = graph_eval.ndata["particle_number"] == idx_part
-                pos_indx = torch.where(positives_of_class == True)[0]
-                if len(pos_indx) > 50:
-                    indx[nn, :] = pos_indx[0:50]
-                else:
-                    indx[nn, 0 : len(pos_indx)] = pos_indx
-                    indx[nn, len(pos_indx) :] = pos_indx[0]
-            for nn in range(0, len(number_of_particles)):
-                idx_part = number_of_particles[nn]
-                positives_of_class = graph_eval.ndata["particle_number"] == idx_part
-                xj_ = xj_graph[positives_of_class]
-                x_alpha_ = x_alpha[nn]
-                dot_products = torch.mul(
-                    xj_, x_alpha_.unsqueeze(0).tile((xj_.shape[0], 1))
-                ).sum(dim=1)
-                dot_products_exp = torch.exp(dot_products)
-                indx_copy = indx.clone()
-                indx_copy[nn] = -1
-                indx_copy = indx_copy.view(-1)
-                indx_copy = indx_copy[indx_copy > -1]
-                neg_indx = indx_copy
-                xj_neg = xj_graph[neg_indx.long()]
-                dot_neg = torch.sum(
-                    torch.exp(torch.tensordot(xj_, xj_neg, dims=([1], [1]))), dim=1
-                )
-                loss = torch.mean(-torch.log(dot_products_exp / dot_neg))
-                if torch.sum(torch.isnan(loss)) > 0:
-                    print(dot_products)
-                    print(dot_neg)
-                    print(dot_products / dot_neg)
-                    print(torch.log(dot_products / dot_neg))
-                loss_total = loss_total + loss
-                number_particles_accounted_for = number_particles_accounted_for + 1
-        Loss_beta = Loss_beta + torch.sum((1 - b_alpha)) / len(b_alpha)
-        Loss_beta_zero = Loss_beta_zero + beta_zero_loss
+def infonet_updated(g, qmin, xj, bj, n_samples=50):
+    """
+    Contrastive (InfoNCE) loss for all events of the batch at once. For every
+    particle, each of its hits is pulled towards the particle's max-q hit and
+    pushed away from the first n_samples hits (padded with the first hit) of
+    every other particle of the event. Events with a single particle only
+    enter the beta terms.
+    Returns total loss, beta loss of the condensation points, mean beta loss
+    and the contrastive loss.
+    """
+    device = xj.device
+    bj = bj.view(-1)
+    n_per_event = g.batch_num_nodes().to(device)
+    n_events = n_per_event.size(0)
+    batch = torch.repeat_interleave(torch.arange(n_events, device=device), n_per_event)
+    event_offsets = torch.zeros(n_events + 1, dtype=torch.long, device=device)
+    event_offsets[1:] = torch.cumsum(n_per_event, dim=0)
+    q = bj.arctanh() ** 2 + qmin
 
-    loss_total = loss_total / number_particles_accounted_for
-    Loss_beta = Loss_beta / len(list_graphs)
-    Loss_beta_zero = Loss_beta_zero / len(list_graphs)
+    # particle index over the whole batch, particles are ordered by event
+    part_num = g.ndata["particle_number"].view(-1).to(torch.long)
+    n_particles_per_event = scatter_max(part_num, batch, dim_size=n_events)[0]
+    particle_offsets = torch.zeros(n_events + 1, dtype=torch.long, device=device)
+    particle_offsets[1:] = torch.cumsum(n_particles_per_event, dim=0)
+    particle = particle_offsets[:-1][batch] + part_num - 1
+    n_particles = int(particle_offsets[-1])
+    particle_event = torch.repeat_interleave(
+        torch.arange(n_events, device=device), n_particles_per_event
+    )
+    q_alpha, index_alpha = scatter_max(q, particle, dim_size=n_particles)
+    x_alpha = xj[index_alpha]
+    b_alpha = bj[index_alpha]
+
+    # n_samples hits per particle (the first ones, padded with the first hit)
+    order = torch.argsort(particle, stable=True)
+    hit_offsets = batch_to_offsets(particle[order], n_particles)
+    n_hits_particle = segment_count(hit_offsets)
+    slots = torch.arange(n_samples, device=device).unsqueeze(0)
+    slots = torch.where(slots < n_hits_particle.unsqueeze(1), slots, 0)
+    samples = order[hit_offsets[:-1].unsqueeze(1) + slots]  # n_particles x n_samples
+
+    # positives: dot product of every hit with its particle's max-q hit
+    dot_products_exp = torch.exp((xj * x_alpha[particle]).sum(dim=1))
+    # negatives: samples of all the other particles of the event
+    hits, others = event_block_pairs(batch, particle_offsets)
+    is_other = others != particle[hits]
+    hits, others = hits[is_other], others[is_other]
+    xj_neg = xj[samples[others]]  # pairs x n_samples x dim
+    dot_neg = torch.exp((xj_neg * xj[hits].unsqueeze(1)).sum(dim=-1)).sum(dim=1)
+    dot_neg = scatter_add(dot_neg, hits, dim_size=xj.shape[0])
+
+    # mean over the hits of each particle, then over the particles of all
+    # events with more than one particle; the hits of single-particle events
+    # have no negatives (dot_neg == 0) and are dropped before the log
+    accounted_for = (n_particles_per_event > 1)[particle_event].float()
+    hit_accounted = (n_particles_per_event > 1)[batch]
+    loss_hits = -torch.log(
+        dot_products_exp[hit_accounted] / dot_neg[hit_accounted]
+    )
+    loss_particles = scatter_mean(
+        loss_hits, particle[hit_accounted], dim_size=n_particles
+    )
+    if accounted_for.sum() > 0:
+        loss_total = (loss_particles * accounted_for).sum() / accounted_for.sum()
+    else:
+        loss_total = xj.sum() * 0
+
+    Loss_beta = segment_csr(1 - b_alpha, particle_offsets, reduce="mean").mean()
+    # beta_zero_loss = torch.sum(torch.exp(10 * bj_graph)) / non
+    Loss_beta_zero = segment_csr(bj, event_offsets, reduce="mean").mean()
     loss_total_ = loss_total + Loss_beta + Loss_beta_zero
 
     return loss_total_, Loss_beta, Loss_beta_zero, loss_total
@@ -0,0 +1,60 @@
+"""
+Segment reductions over contiguous (CSR) segments, e.g. the hits of the events
+in a batch, which are always sorted by event. A segmentation is described by
+its offsets: segment i covers rows offsets[i]:offsets[i + 1].
+"""
+import torch
+from torch_scatter import segment_csr, gather_csr
+
+
+def batch_to_offsets(batch: torch.Tensor, n_segments=None) -> torch.LongTensor:
+    """
+    Returns the CSR offsets of a sorted index array. Empty segments are kept.
+    Example:
+    >>> batch_to_offsets(torch.LongTensor([0, 0, 0, 1, 1, 3]))
+    >>> tensor([0, 3, 5, 5, 6])
+    """
+    batch = batch.long()
+    if n_segments is None:
+        n_segments = int(batch.max()) + 1 if batch.numel() > 0 else 0
+    boundaries = torch.arange(int(n_segments) + 1, device=batch.device)
+    return torch.searchsorted(batch, boundaries)
+
+
+def segment_count(offsets: torch.LongTensor) -> torch.LongTensor:
+    """
+    Number of rows in every segment (the counterpart of scatter_count).
+    """
+    return offsets[1:] - offsets[:-1]
+
+
+def segment_sum(x: torch.Tensor, offsets: torch.LongTensor) -> torch.Tensor:
+    return segment_csr(x, offsets, reduce="sum")
+
+
+def segment_mean(x: torch.Tensor, offsets: torch.LongTensor) -> torch.Tensor:
+    return segment_csr(x, offsets, reduce="mean")
+
+
+def segment_mean_min_max(x: torch.Tensor, offsets: torch.LongTensor):
+    """
+    Mean, min, max and count per segment of x (n_rows x n_features). The min and
+    max are taken in one reduction over [x, -x] and the count comes from the
+    offsets. Empty segments give zeros, like torch_scatter.
+    """
+    count = segment_count(offsets)
+    mean = segment_csr(x, offsets, reduce="sum") / count.clamp(min=1).unsqueeze(
+        1
+    ).to(x.dtype)
+    max_, minus_min = segment_csr(torch.cat((x, -x), dim=1), offsets, reduce="max").chunk(
+        2, dim=1
+    )
+    return mean, -minus_min, max_, count
+
+
+def segment_broadcast(values: torch.Tensor, offsets: torch.LongTensor) -> torch.Tensor:
+    """
+    Copies the per-segment values back to the rows of every segment, i.e.
+    values[batch] without materialising batch.
+    """
+    return gather_csr(values, offsets)
@@ -0,0 +1,126 @@
+"""
+Truth-side index of a batch of events: which hits are noise, which object
+(particle) every signal hit belongs to and where the hits and objects of every
+event start. It only depends on the truth, so graph_batch_func builds it in the
+dataloader workers and attaches it to the batched graph (g.truth_index); the
+losses build it on the fly for graphs that don't have it.
+Hits with particle_number 0 are noise, object k of an event has particle_number
+k + 1, i.e. an event with largest particle_number n has n objects.
+"""
+import torch
+from torch_scatter import segment_csr
+from src.layers.segment import batch_to_offsets, segment_count
+
+
+def counts_to_offsets(counts: torch.LongTensor) -> torch.LongTensor:
+    offsets = torch.zeros(counts.size(0) + 1, dtype=torch.long, device=counts.device)
+    offsets[1:] = torch.cumsum(counts, dim=0)
+    return offsets
+
+
+class TruthIndex(object):
+    """
+    batch: event of every hit (n_hits,)
+    event_offsets: CSR offsets of the hits of every event (batch_size + 1,)
+    is_sig: per-hit boolean, False for noise hits
+    noise_offsets: CSR offsets of the noise hits (batch_size + 1,)
+    cluster_index: cluster of every hit over the whole batch, the noise of
+        every event is one cluster (n_hits,)
+    object_index: object of every signal hit over the whole batch (n_hits_sig,)
+    object_offsets: CSR offsets of the objects of every event (batch_size + 1,)
+    n_hits_per_object: (n_objects,)
+    batch_size, n_hits, n_objects: python ints, so using them doesn't sync
+    """
+
+    __slots__ = (
+        "batch",
+        "event_offsets",
+        "is_sig",
+        "noise_offsets",
+        "cluster_index",
+        "object_index",
+        "object_offsets",
+        "n_hits_per_object",
+        "batch_size",
+        "n_hits",
+        "n_objects",
+    )
+
+    def __init__(self, cluster_index_per_event, batch, batch_size=None):
+        cluster_index_per_event = cluster_index_per_event.view(-1).long()
+        batch = batch.view(-1).long()
+        if batch_size is None:
+            batch_size = int(batch.max()) + 1
+        self.batch = batch
+        self.batch_size = int(batch_size)
+        self.n_hits = batch.size(0)
+        self.event_offsets = batch_to_offsets(batch, batch_size)
+        n_objects_per_event = segment_csr(
+            cluster_index_per_event, self.event_offsets, reduce="max"
+        )
+        self.object_offsets = counts_to_offsets(n_objects_per_event)
+        self.n_objects = int(self.object_offsets[-1])
+        self.is_sig = cluster_index_per_event != 0
+        self.noise_offsets = batch_to_offsets(batch[~self.is_sig], batch_size)
+        first_object = self.object_offsets[:-1][batch]
+        # one extra (noise) cluster per event in front of its objects
+        self.cluster_index = first_object + batch + cluster_index_per_event
+        self.object_index = (first_object + cluster_index_per_event - 1)[self.is_sig]
+        self.n_hits_per_object = torch.bincount(
+            self.object_index, minlength=self.n_objects
+        )
+
+    @property
+    def n_hits_per_event(self):
+        return segment_count(self.event_offsets)
+
+    @property
+    def n_objects_per_event(self):
+        return segment_count(self.object_offsets)
+
+    @property
+    def n_sig_hits_per_event(self):
+        return self.n_hits_per_event - segment_count(self.noise_offsets)
+
+    def to(self, device, non_blocking=False):
+        if self.batch.device == torch.device(device):
+            return self
+        result = TruthIndex.__new__(TruthIndex)
+        for name in self.__slots__:
+            val = getattr(self, name)
+            if torch.is_tensor(val):
+                val = val.to(device, non_blocking=non_blocking)
+            setattr(result, name, val)
+        return result
+
+
+def get_truth_index(
+    g, cluster_index_per_event=None, batch=None, device=None, truth=False
+):
+    """
+    Returns the truth index attached to the graph by graph_batch_func, on
+    device, or builds it from cluster_index_per_event (default: the
+    particle_number of the hits) and batch (default: from the number of hits
+    of every graph in the batch). The attached one is built from the
+    particle_number of the hits, so it is only used when no
+    cluster_index_per_event is passed or with truth (the passed one is the
+    particle_number of the hits of g, e.g. in the training losses). Predicted
+    clusterings always get a new index.
+    """
+    device = g.device if device is None else device
+    if cluster_index_per_event is None:
+        cluster_index_per_event = g.ndata["particle_number"]
+        truth = True
+    truth_index = getattr(g, "truth_index", None)
+    if truth and truth_index is not None and truth_index.n_hits == g.num_nodes():
+        return truth_index.to(device, non_blocking=True)
+    batch_size = None
+    if batch is None:
+        n_per_event = g.batch_num_nodes()
+        batch_size = n_per_event.size(0)
+        batch = torch.repeat_interleave(
+            torch.arange(batch_size, device=n_per_event.device), n_per_event
+        )
+    return TruthIndex(
+        cluster_index_per_event.to(device), batch.to(device), batch_size
+    )
@@ -7,14 +7,21 @@ import dgl
 
 
 from torch_scatter import scatter_max, scatter_add, scatter_mean
-from src.layers.object_cond import calc_LV_Lbeta
+from src.layers.object_cond import calc_LV_Lbeta, plan_regression_terms
 from src.layers.obj_cond_inf import calc_energy_loss
-from src.models.gravnet_model import global_exchange, obtain_batch_numbers
+from src.layers.edge_messages import propagate
+from torch.utils.checkpoint import checkpoint
+from src.models.gravnet_model import (
+    global_exchange,
+    obtain_batch_numbers,
+    checkpointed_blocks,
+)
 
 class EGNN(nn.Module):
-    def __init__(self, dev, activation: str = ("relu",), concat_global_exchange: bool = False):
+    def __init__(self, dev, activation: str = ("relu",), concat_global_exchange: bool = False, checkpoint_blocks=None):
         '''
         :param concat_global_exchange: Whether to concat "global" features to the node features.
+        :param checkpoint_blocks: E_GCL layers to recompute in the backward pass: True/"all" or a list of layer indices.
         '''
         super().__init__()
         in_node_nf = 6
@@ -42,6 +49,7 @@ class EGNN(nn.Module):
         # self.embedding_in_coords = nn.Linear(6, self.hidden_nf)
         self.embedding_out = nn.Linear(self.hidden_nf + 3, out_node_nf)
         self.layers = nn.ModuleList()
+        use_checkpoint = checkpointed_blocks(checkpoint_blocks, n_layers)
         for i in range(0, n_layers):
             self.layers.append(
                 E_GCL(
@@ -54,6 +62,7 @@ class EGNN(nn.Module):
                     attention=attention,
                     normalize=normalize,
                     tanh=tanh,
+                    use_checkpoint=use_checkpoint[i],
                 )
             )
 
@@ -178,8 +187,10 @@ class EGNN(nn.Module):
                 -1
             ).long(),  # Truth hit->cluster index
             batch=batch_numbers.long(),
+            truth=True,  # the particle_number of the hits
             qmin=q_min,
             return_regression_resolution=return_resolution,
+            regression_terms=plan_regression_terms(clust_loss_only, add_energy_loss),
             post_pid_pool_module=self.post_pid_pool_module,
             clust_space_dim=clust_space_dim,
             frac_combinations=frac_clustering_loss,
@@ -237,9 +248,11 @@ class E_GCL(nn.Module):
         normalize=False,
         coords_agg="mean",
         tanh=False,
+        use_checkpoint=False,
     ):
         super(E_GCL, self).__init__()
         input_edge = input_nf * 2
+        self.use_checkpoint = use_checkpoint
         self.residual = residual
         self.attention = attention
         self.normalize = normalize
@@ -262,11 +275,29 @@ class E_GCL(nn.Module):
         self.agg = Aggregationlayer(input_nf, hidden_nf, output_nf, residual)
 
     def forward(self, g, edge_attr=None, node_attr=None):
+        src, dst = g.edges()
+        args = (g.ndata["x"], g.ndata["hh"], src.long(), dst.long(), g.in_degrees())
+        if self.use_checkpoint and self.training and torch.is_grad_enabled():
+            # the edge messages are recomputed in the backward pass
+            x, hh = checkpoint(self.propagate, *args, use_reentrant=False)
+        else:
+            x, hh = self.propagate(*args)
+        g.ndata["x"] = x
+        g.ndata["hh"] = hh
+        return g
 
+    def forward_udf(self, g):
+        # reference implementation with DGL user-defined functions
         g.update_all(self.message, self.agg)
-
         return g
 
+    def propagate(self, x, hh, src, dst, in_degrees):
+        """
+        Vectorized version of g.update_all(self.message, self.agg), see
+        src.layers.edge_messages.propagate
+        """
+        return propagate(self.message, self.agg, x, hh, src, dst, in_degrees)
+
 
 class RelativePositionCordMessage(nn.Module):
     """
@@ -315,21 +346,28 @@ class RelativePositionCordMessage(nn.Module):
         self.coord_mlp = nn.Sequential(*coord_mlp)
 
     def forward(self, edges):
-        coord_diff0 = edges.src["x"] - edges.dst["x"]
-        # coord_diff1 = edges.src["x"][:, 3:] - edges.dst["x"][:, 3:]
-        coord_diff = edges.src["x"] - edges.dst["x"]
+        radial0, trans, edge_feature = self.messages(
+            edges.src["x"], edges.dst["x"], edges.src["hh"], edges.dst["hh"]
+        )
+        return {"radial": radial0, "trans": trans, "edge_feature": edge_feature}
+
+    def messages(self, x_src, x_dst, hh_src, hh_dst):
+        """
+        Edge messages from the (flat, E x ...) features of the edge endpoints
+        """
+        coord_diff0 = x_src - x_dst
+        # coord_diff1 = x_src[:, 3:] - x_dst[:, 3:]
+        coord_diff = x_src - x_dst
         # coord_diff0 = torch.atan2(
-        #     torch.sin(edges.src["x"][:, 1] - edges.dst["x"][:, 1]),
-        #     torch.cos(edges.src["x"][:, 1] - edges.dst["x"][:, 1]),
+        #     torch.sin(x_src[:, 1] - x_dst[:, 1]),
+        #     torch.cos(x_src[:, 1] - x_dst[:, 1]),
         # )
         # radial1 = torch.sqrt(torch.sum(coord_diff1**2, 1))
         # radial0 = torch.sqrt(torch.sum(coord_diff0**2, 1)).unsqueeze(1)
         radial0 = torch.sum(coord_diff0**2, 1).unsqueeze(1)
         # radial = torch.cat((radial0.unsqueeze(1), radial1.unsqueeze(1)), dim=1)
 
-        edge_feature = torch.cat(
-            (radial0, edges.src["hh"], edges.dst["hh"]), dim=1
-        )  # E x (2+80*2)
+        edge_feature = torch.cat((radial0, hh_src, hh_dst), dim=1)  # E x (2+80*2)
         edge_feature = self.edge_mlp(edge_feature)  # E x 80
         if self.normalize:
             norm = torch.sqrt(radial0).detach() + self.epsilon
@@ -337,7 +375,7 @@ class RelativePositionCordMessage(nn.Module):
 
         trans = coord_diff * self.coord_mlp(edge_feature)  # E x 2
 
-        return {"radial": radial0, "trans": trans, "edge_feature": edge_feature}
+        return radial0, trans, edge_feature
 
 
 class Aggregationlayer(nn.Module):
@@ -354,15 +392,21 @@ class Aggregationlayer(nn.Module):
     def forward(self, nodes):
         # shape = nodes.mailbox['agg_feat'].shape # 1x7x80
         trans = torch.mean(nodes.mailbox["trans"], dim=1)
-        coord = nodes.data["x"] + trans
         edge_feature = torch.sum(nodes.mailbox["edge_feature"], dim=1)
+        coord, h = self.update(nodes.data["x"], nodes.data["hh"], trans, edge_feature)
+        return {"x": coord, "hh": h}
 
-        agg = torch.cat((nodes.data["hh"], edge_feature), dim=1)
+    def update(self, x, hh, trans, edge_feature):
+        """
+        New coordinates and features from the mean coordinate update and the
+        summed edge features of every node
+        """
+        coord = x + trans
+        agg = torch.cat((hh, edge_feature), dim=1)
         h = self.node_mlp(agg)
         if self.residual:
-            h = nodes.data["hh"] + h
-
-        return {"x": coord, "hh": h}
+            h = hh + h
+        return coord, h
 
 
 def update_knn(batch):
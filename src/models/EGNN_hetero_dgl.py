@@ -7,8 +7,9 @@ import dgl
 
 
 from torch_scatter import scatter_max, scatter_add, scatter_mean
-from src.layers.object_cond import calc_LV_Lbeta
+from src.layers.object_cond import calc_LV_Lbeta, plan_regression_terms
 from src.layers.obj_cond_inf import calc_energy_loss
+from src.layers.edge_messages import propagate
 from src.models.gravnet_model import global_exchange, obtain_batch_numbers
 
 class HEGNN(nn.Module):
@@ -40,6 +41,7 @@ class HEGNN(nn.Module):
         else:
             add_global_exchange = 0
         node_types = ["2", "3"]
+        self.node_types = node_types
         self.single_embedding_in_out = single_embedding_in_out  # if True, use same embedding matrices for all node types
         if single_embedding_in_out:
             self.embedding_in = nn.Linear(in_node_nf + add_global_exchange, self.hidden_nf)
@@ -81,44 +83,50 @@ class HEGNN(nn.Module):
         # g.ndata["x"] = self.embedding_in_coords(g.ndata["c"])  # NBx2
         ht = g.ndata["hit_type"]
         ht = torch.argmax(ht, dim=1)
+        # index of the node type in self.node_types, -1 for other hit types
+        type_lookup = torch.full(
+            (g.ndata["hit_type"].shape[1],), -1, dtype=torch.long, device=ht.device
+        )
+        for i, nt in enumerate(self.node_types):
+            type_lookup[int(nt)] = i
+        node_type = type_lookup[ht]
         g.ndata["x"] = g.ndata["h"][:, 0:3]
         if self.concat_global_exchange:
             h = global_exchange(g.ndata["h"], batch)
             h = h[:, 3:]
         if not self.single_embedding_in_out:
-            h1 = torch.zeros((h.shape[0], self.hidden_nf)).to(self.device)
-            for ht1 in [2, 3]:
-                h1[ht == ht1] = self.embedding_in[str(ht1)](h[ht == ht1])
-            h = h1
+            h = typed_linear(
+                [self.embedding_in[nt] for nt in self.node_types], h, node_type
+            )
         else:
             h = self.embedding_in(h)
         g.ndata["hh"] = h
-        for i in range(len(self.layers["2-2"])):
+        relations = list(self.layers.keys())
+        partitions = typed_edge_partitions(g, node_type, len(self.node_types))
+        n_layers = len(self.layers["2-2"])
+        for i in range(n_layers):
+            x, hh = g.ndata["x"], g.ndata["hh"]
             n = 0
-            for key in self.layers.keys():
-                # edges of g
-                edge_type, edge_type_dst = key.split("-")
-                edgelist = g.edges()
-                filt = ht[edgelist[0]] == int(edge_type)
-                filt_dst = ht[edgelist[1]] == int(edge_type_dst)
-                filt = filt & filt_dst
-                if torch.sum(filt) <= 0:
+            for r, key in enumerate(relations):
+                # edges of g from nodes of type edge_type to nodes of type edge_type_dst
+                src, dst, in_degrees = partitions[r]
+                if src.shape[0] == 0:
                     continue
-                filt_edges = torch.nonzero(filt, as_tuple=False).squeeze()
-                subgraph = dgl.edge_subgraph(g, filt_edges, relabel_nodes=False)
-                g1 = self.layers[key][i](subgraph)
-                g.ndata["hh"] = g1.ndata["hh"] + g.ndata["hh"]
+                _, hh_key = self.layers[key][i].propagate(x, hh, src, dst, in_degrees)
+                hh = hh_key + hh
                 n += 1
-            g.ndata["hh"] = g.ndata["hh"] / n
+            g.ndata["hh"] = hh / n
             g = update_knn(g)
+            if i < n_layers - 1:
+                # the edges of the new kNN graph, for the next layer
+                partitions = typed_edge_partitions(g, node_type, len(self.node_types))
 
             # the second step could be to do the knn again for each graph with the new coordinates
         h = torch.cat((g.ndata["hh"], g.ndata["x"]), dim=1)
         if not self.single_embedding_in_out:
-            h1 = torch.zeros((h.shape[0], 4)).to(self.device)
-            for ht1 in [2, 3]:
-                h1[ht == ht1, :] = self.embedding_out[str(ht1)](h[ht == ht1])
-            h = h1
+            h = typed_linear(
+                [self.embedding_out[nt] for nt in self.node_types], h, node_type
+            )
         else:
             h = self.embedding_out(h)
         g.ndata["hh"] = h
@@ -217,8 +225,10 @@ class HEGNN(nn.Module):
                 -1
             ).long(),  # Truth hit->cluster index
             batch=batch_numbers.long(),
+            truth=True,  # the particle_number of the hits
             qmin=q_min,
             return_regression_resolution=return_resolution,
+            regression_terms=plan_regression_terms(clust_loss_only, add_energy_loss),
             post_pid_pool_module=self.post_pid_pool_module,
             clust_space_dim=clust_space_dim,
             frac_combinations=frac_clustering_loss,
@@ -352,11 +362,26 @@ class E_GCL(nn.Module):
         self.agg = Aggregationlayer(input_nf, hidden_nf, output_nf, residual)
 
     def forward(self, g, edge_attr=None, node_attr=None):
+        src, dst = g.edges()
+        x, hh = self.propagate(
+            g.ndata["x"], g.ndata["hh"], src.long(), dst.long(), g.in_degrees()
+        )
+        g.ndata["x"] = x
+        g.ndata["hh"] = hh
+        return g
 
+    def forward_udf(self, g):
+        # reference implementation with DGL user-defined functions
         g.update_all(self.message, self.agg)
-
         return g
 
+    def propagate(self, x, hh, src, dst, in_degrees):
+        """
+        Vectorized version of g.update_all(self.message, self.agg), see
+        src.layers.edge_messages.propagate
+        """
+        return propagate(self.message, self.agg, x, hh, src, dst, in_degrees)
+
 
 class RelativePositionCordMessage(nn.Module):
     """
@@ -405,21 +430,28 @@ class RelativePositionCordMessage(nn.Module):
         self.coord_mlp = nn.Sequential(*coord_mlp)
 
     def forward(self, edges):
-        coord_diff0 = edges.src["x"] - edges.dst["x"]
-        # coord_diff1 = edges.src["x"][:, 3:] - edges.dst["x"][:, 3:]
-        coord_diff = edges.src["x"] - edges.dst["x"]
+        radial0, trans, edge_feature = self.messages(
+            edges.src["x"], edges.dst["x"], edges.src["hh"], edges.dst["hh"]
+        )
+        return {"radial": radial0, "trans": trans, "edge_feature": edge_feature}
+
+    def messages(self, x_src, x_dst, hh_src, hh_dst):
+        """
+        Edge messages from the (flat, E x ...) features of the edge endpoints
+        """
+        coord_diff0 = x_src - x_dst
+        # coord_diff1 = x_src[:, 3:] - x_dst[:, 3:]
+        coord_diff = x_src - x_dst
         # coord_diff0 = torch.atan2(
-        #     torch.sin(edges.src["x"][:, 1] - edges.dst["x"][:, 1]),
-        #     torch.cos(edges.src["x"][:, 1] - edges.dst["x"][:, 1]),
+        #     torch.sin(x_src[:, 1] - x_dst[:, 1]),
+        #     torch.cos(x_src[:, 1] - x_dst[:, 1]),
         # )
         # radial1 = torch.sqrt(torch.sum(coord_diff1**2, 1))
         # radial0 = torch.sqrt(torch.sum(coord_diff0**2, 1)).unsqueeze(1)
         radial0 = torch.sum(coord_diff0**2, 1).unsqueeze(1)
         # radial = torch.cat((radial0.unsqueeze(1), radial1.unsqueeze(1)), dim=1)
 
-        edge_feature = torch.cat(
-            (radial0, edges.src["hh"], edges.dst["hh"]), dim=1
-        )  # E x (2+80*2)
+        edge_feature = torch.cat((radial0, hh_src, hh_dst), dim=1)  # E x (2+80*2)
         edge_feature = self.edge_mlp(edge_feature)  # E x 80
         if self.normalize:
             norm = torch.sqrt(radial0).detach() + self.epsilon
@@ -427,7 +459,7 @@ class RelativePositionCordMessage(nn.Module):
 
         trans = coord_diff * self.coord_mlp(edge_feature)  # E x 2
 
-        return {"radial": radial0, "trans": trans, "edge_feature": edge_feature}
+        return radial0, trans, edge_feature
 
 
 class Aggregationlayer(nn.Module):
@@ -444,15 +476,58 @@ class Aggregationlayer(nn.Module):
     def forward(self, nodes):
         # shape = nodes.mailbox['agg_feat'].shape # 1x7x80
         trans = torch.mean(nodes.mailbox["trans"], dim=1)
-        coord = nodes.data["x"] + trans
         edge_feature = torch.sum(nodes.mailbox["edge_feature"], dim=1)
+        coord, h = self.update(nodes.data["x"], nodes.data["hh"], trans, edge_feature)
+        return {"x": coord, "hh": h}
 
-        agg = torch.cat((nodes.data["hh"], edge_feature), dim=1)
+    def update(self, x, hh, trans, edge_feature):
+        """
+        New coordinates and features from the mean coordinate update and the
+        summed edge features of every node
+        """
+        coord = x + trans
+        agg = torch.cat((hh, edge_feature), dim=1)
         h = self.node_mlp(agg)
         if self.residual:
-            h = nodes.data["hh"] + h
+            h = hh + h
+        return coord, h
 
-        return {"x": coord, "hh": h}
+
+def typed_linear(linears, h, node_type):
+    """
+    Applies linears[node_type[i]] to h[i] for all nodes with one matmul and a
+    gather. Nodes with node_type -1 get zeros.
+    """
+    weight = torch.cat([linear.weight for linear in linears], dim=0)
+    bias = torch.cat([linear.bias for linear in linears], dim=0)
+    out = F.linear(h, weight, bias).view(h.shape[0], len(linears), -1)
+    out = out[torch.arange(h.shape[0], device=h.device), node_type.clamp(min=0)]
+    return out * (node_type >= 0).unsqueeze(1)
+
+
+def typed_edge_partitions(g, node_type, n_types):
+    """
+    Splits the edges of g by relation (type of the source node, type of the
+    destination node), ordered like "src_type-dst_type" keys with the types in
+    order: a CSR over the edges sorted by relation. Returns, per relation, the
+    source and destination node ids and the in-degrees of all nodes within that
+    relation. Edges touching nodes with node_type -1 are dropped.
+    """
+    src, dst = g.edges()
+    src, dst = src.long(), dst.long()
+    n_relations = n_types * n_types
+    relation = node_type[src] * n_types + node_type[dst]
+    relation[(node_type[src] < 0) | (node_type[dst] < 0)] = n_relations
+    order = torch.argsort(relation, stable=True)
+    src, dst = src[order], dst[order]
+    counts = torch.bincount(relation, minlength=n_relations + 1)
+    offsets = [0] + torch.cumsum(counts, dim=0).tolist()
+    partitions = []
+    for r in range(n_relations):
+        src_r, dst_r = src[offsets[r] : offsets[r + 1]], dst[offsets[r] : offsets[r + 1]]
+        in_degrees = torch.bincount(dst_r, minlength=g.num_nodes())
+        partitions.append((src_r, dst_r, in_degrees))
+    return partitions
 
 
 def update_knn(batch):
@@ -28,7 +28,7 @@ from src.layers.gated_gcn_layer import GatedGCNLayer
 from src.layers.mlp_readout_layer import MLPReadout
 
 from torch_scatter import scatter_max, scatter_add, scatter_mean
-from src.layers.object_cond import calc_LV_Lbeta
+from src.layers.object_cond import calc_LV_Lbeta, plan_regression_terms
 from src.layers.object_cond_infonet import infonet_updated
 
 
@@ -209,8 +209,10 @@ class GatedGCNNet(nn.Module):
                 -1
             ).long(),  # Truth hit->cluster index
             batch=batch_numbers.long(),
+            truth=True,  # the particle_number of the hits
             qmin=q_min,
             return_regression_resolution=return_resolution,
+            regression_terms=plan_regression_terms(clust_loss_only, add_energy_loss),
             post_pid_pool_module=self.post_pid_pool_module,
             clust_space_dim=clust_space_dim,
             frac_combinations=frac_clustering_loss,
@@ -9,8 +9,9 @@ from src.models.gatconv import GATConv
 
 
 from torch_scatter import scatter_max, scatter_add, scatter_mean
-from src.layers.object_cond import calc_LV_Lbeta
+from src.layers.object_cond import calc_LV_Lbeta, plan_regression_terms
 from src.layers.obj_cond_inf import calc_energy_loss
+from src.layers.edge_messages import propagate
 from src.models.gravnet_model import global_exchange, obtain_batch_numbers
 
 class Mixed_EGNN(nn.Module):
@@ -196,8 +197,10 @@ class Mixed_EGNN(nn.Module):
                 -1
             ).long(),  # Truth hit->cluster index
             batch=batch_numbers.long(),
+            truth=True,  # the particle_number of the hits
             qmin=q_min,
             return_regression_resolution=return_resolution,
+            regression_terms=plan_regression_terms(clust_loss_only, add_energy_loss),
             post_pid_pool_module=self.post_pid_pool_module,
             clust_space_dim=clust_space_dim,
             frac_combinations=frac_clustering_loss,
@@ -281,11 +284,26 @@ class E_GCL(nn.Module):
         self.agg = Aggregationlayer(input_nf, hidden_nf, output_nf, residual)
 
     def forward(self, g, edge_attr=None, node_attr=None):
+        src, dst = g.edges()
+        x, hh = self.propagate(
+            g.ndata["x"], g.ndata["hh"], src.long(), dst.long(), g.in_degrees()
+        )
+        g.ndata["x"] = x
+        g.ndata["hh"] = hh
+        return g
 
+    def forward_udf(self, g):
+        # reference implementation with DGL user-defined functions
         g.update_all(self.message, self.agg)
-
         return g
 
+    def propagate(self, x, hh, src, dst, in_degrees):
+        """
+        Vectorized version of g.update_all(self.message, self.agg), see
+        src.layers.edge_messages.propagate
+        """
+        return propagate(self.message, self.agg, x, hh, src, dst, in_degrees)
+
 
 class RelativePositionCordMessage(nn.Module):
     """
@@ -334,21 +352,28 @@ class RelativePositionCordMessage(nn.Module):
         self.coord_mlp = nn.Sequential(*coord_mlp)
 
     def forward(self, edges):
-        coord_diff0 = edges.src["x"] - edges.dst["x"]
-        # coord_diff1 = edges.src["x"][:, 3:] - edges.dst["x"][:, 3:]
-        coord_diff = edges.src["x"] - edges.dst["x"]
+        radial0, trans, edge_feature = self.messages(
+            edges.src["x"], edges.dst["x"], edges.src["hh"], edges.dst["hh"]
+        )
+        return {"radial": radial0, "trans": trans, "edge_feature": edge_feature}
+
+    def messages(self, x_src, x_dst, hh_src, hh_dst):
+        """
+        Edge messages from the (flat, E x ...) features of the edge endpoints
+        """
+        coord_diff0 = x_src - x_dst
+        # coord_diff1 = x_src[:, 3:] - x_dst[:, 3:]
+        coord_diff = x_src - x_dst
         # coord_diff0 = torch.atan2(
-        #     torch.sin(edges.src["x"][:, 1] - edges.dst["x"][:, 1]),
-        #     torch.cos(edges.src["x"][:, 1] - edges.dst["x"][:, 1]),
+        #     torch.sin(x_src[:, 1] - x_dst[:, 1]),
+        #     torch.cos(x_src[:, 1] - x_dst[:, 1]),
         # )
         # radial1 = torch.sqrt(torch.sum(coord_diff1**2, 1))
         # radial0 = torch.sqrt(torch.sum(coord_diff0**2, 1)).unsqueeze(1)
         radial0 = torch.sum(coord_diff0**2, 1).unsqueeze(1)
         # radial = torch.cat((radial0.unsqueeze(1), radial1.unsqueeze(1)), dim=1)
 
-        edge_feature = torch.cat(
-            (radial0, edges.src["hh"], edges.dst["hh"]), dim=1
-        )  # E x (2+80*2)
+        edge_feature = torch.cat((radial0, hh_src, hh_dst), dim=1)  # E x (2+80*2)
         edge_feature = self.edge_mlp(edge_feature)  # E x 80
         if self.normalize:
             norm = torch.sqrt(radial0).detach() + self.epsilon
@@ -356,7 +381,7 @@ class RelativePositionCordMessage(nn.Module):
 
         trans = coord_diff * self.coord_mlp(edge_feature)  # E x 2
 
-        return {"radial": radial0, "trans": trans, "edge_feature": edge_feature}
+        return radial0, trans, edge_feature
 
 
 class Aggregationlayer(nn.Module):
@@ -373,15 +398,21 @@ class Aggregationlayer(nn.Module):
     def forward(self, nodes):
         # shape = nodes.mailbox['agg_feat'].shape # 1x7x80
         trans = torch.mean(nodes.mailbox["trans"], dim=1)
-        coord = nodes.data["x"] + trans
         edge_feature = torch.sum(nodes.mailbox["edge_feature"], dim=1)
+        coord, h = self.update(nodes.data["x"], nodes.data["hh"], trans, edge_feature)
+        return {"x": coord, "hh": h}
 
-        agg = torch.cat((nodes.data["hh"], edge_feature), dim=1)
+    def update(self, x, hh, trans, edge_feature):
+        """
+        New coordinates and features from the mean coordinate update and the
+        summed edge features of every node
+        """
+        coord = x + trans
+        agg = torch.cat((hh, edge_feature), dim=1)
         h = self.node_mlp(agg)
         if self.residual:
-            h = nodes.data["hh"] + h
-
-        return {"x": coord, "hh": h}
+            h = hh + h
+        return coord, h
 
 
 def update_knn(batch):
@@ -33,7 +33,7 @@ import dgl
 
 
 from torch_scatter import scatter_max, scatter_add, scatter_mean
-from src.layers.object_cond import calc_LV_Lbeta
+from src.layers.object_cond import calc_LV_Lbeta, plan_regression_terms
 from src.layers.obj_cond_inf import calc_energy_loss
 from src.models.gravnet_model import global_exchange, obtain_batch_numbers
 
@@ -381,8 +381,10 @@ class GATConv(MessagePassing):
                 -1
             ).long(),  # Truth hit->cluster index
             batch=batch_numbers.long(),
+            truth=True,  # the particle_number of the hits
             qmin=q_min,
             return_regression_resolution=return_resolution,
+            regression_terms=plan_regression_terms(clust_loss_only, add_energy_loss),
             post_pid_pool_module=self.post_pid_pool_module,
             clust_space_dim=clust_space_dim,
             frac_combinations=frac_clustering_loss,
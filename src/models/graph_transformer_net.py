@@ -19,12 +19,13 @@ from src.layers.object_cond import (
     calc_LV_Lbeta,
     get_clustering,
     calc_LV_Lbeta_inference,
+    plan_regression_terms,
 )
 from src.layers.obj_cond_inf import calc_energy_loss
 
 
 class GraphTransformerNet(nn.Module):
-    def __init__(self, dev):
+    def __init__(self, dev, fused_attention=False):
         super().__init__()
 
         in_dim_node = 9  # node_dim (feat is an integer)
@@ -63,6 +64,7 @@ class GraphTransformerNet(nn.Module):
                     self.layer_norm,
                     self.batch_norm,
                     self.residual,
+                    fused_attention=fused_attention,
                 )
                 for _ in range(n_layers - 1)
             ]
@@ -76,6 +78,7 @@ class GraphTransformerNet(nn.Module):
                 self.layer_norm,
                 self.batch_norm,
                 self.residual,
+                fused_attention=fused_attention,
             )
         )
         self.MLP_layer = MLPReadout(out_dim, 4)
@@ -193,8 +196,10 @@ class GraphTransformerNet(nn.Module):
                 -1
             ).long(),  # Truth hit->cluster index
             batch=batch_numbers.long(),
+            truth=True,  # the particle_number of the hits
             qmin=q_min,
             return_regression_resolution=return_resolution,
+            regression_terms=plan_regression_terms(clust_loss_only, add_energy_loss),
             post_pid_pool_module=self.post_pid_pool_module,
             clust_space_dim=clust_space_dim,
             frac_combinations=frac_clustering_loss,
@@ -18,7 +18,7 @@ from src.layers.graph_transformer_edge_layer import GraphTransformerLayer
 
 
 class GraphTransformerNet(nn.Module):
-    def __init__(self, dev):
+    def __init__(self, dev, fused_attention=False):
         super().__init__()
 
         in_dim_node = 4  # node_dim (feat is an integer)
@@ -61,6 +61,7 @@ class GraphTransformerNet(nn.Module):
                     self.layer_norm,
                     self.batch_norm,
                     self.residual,
+                    fused_attention=fused_attention,
                 )
                 for _ in range(n_layers - 1)
             ]
@@ -74,6 +75,7 @@ class GraphTransformerNet(nn.Module):
                 self.layer_norm,
                 self.batch_norm,
                 self.residual,
+                fused_attention=fused_attention,
             )
         )
         self.MLP_layer = MLPReadout(out_dim, 2)
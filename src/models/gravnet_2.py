@@ -12,6 +12,7 @@ from src.layers.object_cond import (
     calc_LV_Lbeta,
     get_clustering,
     calc_LV_Lbeta_inference,
+    plan_regression_terms,
 )
 from src.layers.obj_cond_inf import calc_energy_loss
 from src.models.gravnet_model import (
@@ -242,8 +243,10 @@ class GravnetModel(nn.Module):
                 -1
             ).long(),  # Truth hit->cluster index
             batch=batch_numbers.long(),
+            truth=True,  # the particle_number of the hits
             qmin=q_min,
             return_regression_resolution=return_resolution,
+            regression_terms=plan_regression_terms(clust_loss_only, add_energy_loss),
             post_pid_pool_module=self.post_pid_pool_module,
             clust_space_dim=clust_space_dim,
             frac_combinations=frac_clustering_loss,
@@ -1,9 +1,15 @@
 import torch
 import torch.nn as nn
 from torch import Tensor
-from torch_scatter import scatter_min, scatter_max, scatter_mean, scatter_add
+from torch.utils.checkpoint import checkpoint
+from torch_scatter import scatter_add
 
 from src.layers.GravNetConv import GravNetConv
+from src.layers.segment import (
+    batch_to_offsets,
+    segment_mean_min_max,
+    segment_broadcast,
+)
 
 from typing import Tuple, Union, List
 import dgl
@@ -12,6 +18,7 @@ from src.layers.object_cond import (
     calc_LV_Lbeta,
     get_clustering,
     calc_LV_Lbeta_inference,
+    plan_regression_terms,
 )
 from src.layers.obj_cond_inf import calc_energy_loss
 
@@ -51,22 +58,16 @@ def global_exchange(x, batch):
     and that the batches are sorted!
     """
     batch = batch.to(torch.int64)
-    n_hits_per_event = scatter_count(batch)
     n_hits, n_features = x.size()
     batch_size = int(batch.max()) + 1
+    offsets = batch_to_offsets(batch, batch_size)
 
     # minmeanmax: (batch_size x 3*n_features)
-    meanminmax = torch.cat(
-        (
-            scatter_mean(x, batch, dim=0),
-            scatter_min(x, batch, dim=0)[0],
-            scatter_max(x, batch, dim=0)[0],
-        ),
-        dim=1,
-    )
+    mean, min_, max_, _ = segment_mean_min_max(x, offsets)
+    meanminmax = torch.cat((mean, min_, max_), dim=1)
     assert list(meanminmax.size()) == [batch_size, 3 * n_features]
 
-    meanminmax = torch.repeat_interleave(meanminmax, n_hits_per_event, dim=0)
+    meanminmax = segment_broadcast(meanminmax, offsets)
     assert list(meanminmax.size()) == [n_hits, 3 * n_features]
 
     out = torch.cat((x, meanminmax), dim=1)
@@ -75,6 +76,39 @@ def global_exchange(x, batch):
     return out
 
 
+def global_exchange_flat(x, batch):
+    """
+    Same as global_exchange, but written with scatter_add/scatter_reduce and a
+    gather so that it can be exported to ONNX (no torch_scatter, no asserts on
+    dynamic shapes). Assumes batch is a LongTensor.
+    """
+    batch_size = batch.max() + 1
+    index = batch.unsqueeze(1).expand_as(x)
+    empty = torch.zeros(
+        (batch_size, x.size(1)), dtype=x.dtype, device=x.device
+    )
+    counts = torch.zeros_like(empty).scatter_add(0, index, torch.ones_like(x))
+    mean = torch.zeros_like(empty).scatter_add(0, index, x) / counts
+    min_ = empty.scatter_reduce(0, index, x, reduce="amin", include_self=False)
+    max_ = empty.scatter_reduce(0, index, x, reduce="amax", include_self=False)
+    meanminmax = torch.cat((mean, min_, max_), dim=1)
+    return torch.cat((x, meanminmax[batch]), dim=1)
+
+
+def checkpointed_blocks(checkpoint_blocks, n_blocks):
+    """
+    Per-block flags for activation checkpointing, from the `checkpoint_blocks`
+    model kwarg: True/"all" for all blocks, or a list of block indices.
+    >>> checkpointed_blocks([0, 2], 4)
+    >>> [True, False, True, False]
+    """
+    if checkpoint_blocks in (True, "all"):
+        return [True] * n_blocks
+    if not checkpoint_blocks:
+        return [False] * n_blocks
+    return [i in checkpoint_blocks for i in range(n_blocks)]
+
+
 # FROM https://link.springer.com/content/pdf/10.1140/epjc/s10052-019-7113-9.pdf:
 
 # GravNet model: The model consists of four blocks. Each
@@ -105,9 +139,13 @@ class GravNetBlock(nn.Module):
         space_dimensions: int = 3,
         propagate_dimensions: int = 22,
         k: int = 40,
+        use_checkpoint: bool = False,
         # batchnorm: bool = True
     ):
         super(GravNetBlock, self).__init__()
+        # recompute the block (kNN graph, edge weights, messages) in the
+        # backward pass instead of keeping its activations
+        self.use_checkpoint = use_checkpoint
         # self.batchnorm = batchnorm
         # Includes all layers up to the global_exchange
         self.gravnet_layer = GravNetConv(
@@ -126,6 +164,11 @@ class GravNetBlock(nn.Module):
         )
 
     def forward(self, g, x: Tensor, batch: Tensor) -> Tensor:
+        if self.use_checkpoint and self.training and torch.is_grad_enabled():
+            return checkpoint(self._forward, g, x, batch, use_reentrant=False)
+        return self._forward(g, x, batch)
+
+    def _forward(self, g, x: Tensor, batch: Tensor) -> Tensor:
         x, graph, s_l = self.gravnet_layer(g, x, batch)
         x = self.post_gravnet(x)
         assert x.size(1) == 96
@@ -134,6 +177,12 @@ class GravNetBlock(nn.Module):
         assert x.size(1) == 96
         return x, graph
 
+    def forward_flat(self, x: Tensor, batch: Tensor) -> Tensor:
+        x = self.gravnet_layer.forward_flat(x, batch)
+        x = self.post_gravnet(x)
+        x = global_exchange_flat(x, batch)
+        return self.output(x)
+
 
 class GravnetModel(nn.Module):
     def __init__(
@@ -146,6 +195,7 @@ class GravnetModel(nn.Module):
         clust_space_norm: str = "twonorm",
         k_gravnet: int = 7,
         activation: str = "relu",
+        checkpoint_blocks=None,
     ):
         # if not batchnorm:
         #    print("!!!! no batchnorm !!!")
@@ -183,9 +233,14 @@ class GravnetModel(nn.Module):
         # Note: out_channels of the internal gravnet layer
         # not clearly specified in paper
         N_NEIGHBOURS = [16,128,16,256]  # TEMPORARILY
+        use_checkpoint = checkpointed_blocks(checkpoint_blocks, self.n_gravnet_blocks)
         self.gravnet_blocks = nn.ModuleList(
             [
-                GravNetBlock(64 if i == 0 else 96, k=N_NEIGHBOURS[i])
+                GravNetBlock(
+                    64 if i == 0 else 96,
+                    k=N_NEIGHBOURS[i],
+                    use_checkpoint=use_checkpoint[i],
+                )
                 for i in range(self.n_gravnet_blocks)
             ]
         )
@@ -237,7 +292,9 @@ class GravnetModel(nn.Module):
         for gravnet_block in self.gravnet_blocks:
             x, graph = gravnet_block(g, x, batch)
             x_gravnet_per_block.append(x)
-            graphs.append(graph)
+            if self.return_graphs:
+                # only hold on to the kNN graphs if they are requested
+                graphs.append(graph)
         x = torch.cat(x_gravnet_per_block, dim=-1)
         assert x.size() == (x.size(0), 4 * 96)
         assert x.device == device
@@ -253,6 +310,39 @@ class GravnetModel(nn.Module):
         else:
             return x
 
+    def quantizable_modules(self, static=False):
+        """
+        The plain nn.Linear stacks that hold most of the parameters and FLOPs;
+        the GravNet message passing itself stays in float. post_pid_pool_module
+        only runs in the loss, so the forward used for the static calibration
+        never observes its activations: it is only quantized dynamically.
+        """
+        names = ["input", "postgn_dense", "output", "clustering"]
+        if not static:
+            names.append("post_pid_pool_module")
+        for i in range(self.n_gravnet_blocks):
+            names += [f"gravnet_blocks.{i}.post_gravnet", f"gravnet_blocks.{i}.output"]
+        return names
+
+    def forward_flat(self, x, batch):
+        """
+        DGL-free forward used for the ONNX export.
+        :param x: hit features (n_hits x input_dim), i.e. g.ndata["h"]
+        :param batch: event index of every hit (n_hits,), sorted
+        """
+        x = global_exchange_flat(x, batch)
+        x = self.input(x)
+        x_gravnet_per_block = []
+        for gravnet_block in self.gravnet_blocks:
+            x = gravnet_block.forward_flat(x, batch)
+            x_gravnet_per_block.append(x)
+        x = torch.cat(x_gravnet_per_block, dim=-1)
+        x = self.postgn_dense(x)
+        x = self.output(x)
+        x_cluster_coord = self.clustering(x)
+        beta = self.beta(x)
+        return torch.cat((x_cluster_coord, beta.view(-1, 1)), dim=1)
+
     def object_condensation_loss2(
         self,
         batch,
@@ -344,8 +434,10 @@ class GravnetModel(nn.Module):
                 -1
             ).long(),  # Truth hit->cluster index
             batch=batch_numbers.long(),
+            truth=True,  # the particle_number of the hits
             qmin=q_min,
             return_regression_resolution=return_resolution,
+            regression_terms=plan_regression_terms(clust_loss_only, add_energy_loss),
             post_pid_pool_module=self.post_pid_pool_module,
             clust_space_dim=clust_space_dim,
             frac_combinations=frac_clustering_loss,
@@ -5,7 +5,7 @@ from src.models.EGNN_dgl import EGNN
 class EGNNNetWrapper(torch.nn.Module):
     def __init__(self, dev, **kwargs) -> None:
         super().__init__()
-        self.mod = EGNN(dev)
+        self.mod = EGNN(dev, checkpoint_blocks=kwargs.get("checkpoint_blocks"))
 
     def forward(self, g):
         return self.mod(g)
@@ -15,7 +15,7 @@ def get_model(data_config, dev, **kwargs):
 
     # pf_features_dims = len(data_config.input_dicts['pf_features'])
     # num_classes = len(data_config.label_value)
-    model = EGNNNetWrapper(dev)
+    model = EGNNNetWrapper(dev, **kwargs)
 
     model_info = {
         "input_names": list(data_config.input_names),
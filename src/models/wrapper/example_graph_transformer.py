@@ -5,7 +5,9 @@ from src.models.graph_transformer_net import GraphTransformerNet
 class GraphTransformerNetWrapper(torch.nn.Module):
     def __init__(self, dev, **kwargs) -> None:
         super().__init__()
-        self.mod = GraphTransformerNet(dev)
+        self.mod = GraphTransformerNet(
+            dev, fused_attention=kwargs.get("fused_attention", False)
+        )
 
     def forward(self, g):
         return self.mod(g)
@@ -15,7 +17,7 @@ def get_model(data_config, dev, **kwargs):
 
     # pf_features_dims = len(data_config.input_dicts['pf_features'])
     # num_classes = len(data_config.label_value)
-    model = GraphTransformerNetWrapper(dev)
+    model = GraphTransformerNetWrapper(dev, **kwargs)
 
     model_info = {
         "input_names": list(data_config.input_names),
@@ -11,6 +11,29 @@ class GraphTransformerNetWrapper(torch.nn.Module):
         return self.mod(g)
 
 
+class GravnetModelONNXWrapper(torch.nn.Module):
+    """
+    Flat-input view of the model used for the ONNX export: takes the hit features
+    and the per-hit event index instead of a DGLGraph, and also returns the
+    cluster space coordinates and betas that the clustering runs on.
+    """
+
+    def __init__(self, mod, clust_space_dim) -> None:
+        super().__init__()
+        self.mod = mod
+        self.clust_space_dim = clust_space_dim
+
+    def forward(self, h, batch):
+        pred = self.mod.forward_flat(h, batch)
+        xj = pred[:, 0 : self.clust_space_dim]
+        if self.mod.clust_space_norm == "twonorm":
+            xj = torch.nn.functional.normalize(xj, dim=1)
+        elif self.mod.clust_space_norm == "tanh":
+            xj = torch.tanh(xj)
+        bj = torch.sigmoid(pred[:, self.clust_space_dim])
+        return pred, xj, bj
+
+
 def get_model(data_config, dev, **kwargs):
     # pf_features_dims = len(data_config.input_dicts['pf_features'])
     # num_classes = len(data_config.label_value)
@@ -32,6 +55,19 @@ def get_model(data_config, dev, **kwargs):
     return model, model_info
 
 
+def get_onnx_model(model, clust_space_dim):
+    model = GravnetModelONNXWrapper(model.mod, clust_space_dim)
+    model_info = {
+        "input_names": ["h", "batch"],
+        "output_names": ["output", "cluster_coords", "beta"],
+        "dynamic_axes": {
+            k: {0: "n_hits"}
+            for k in ["h", "batch", "output", "cluster_coords", "beta"]
+        },
+    }
+    return model, model_info
+
+
 def get_loss(data_config, **kwargs):
 
     return torch.nn.MSELoss()
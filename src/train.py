@@ -6,6 +6,7 @@ import sys
 import shutil
 import glob
 import argparse
+import copy
 import functools
 import numpy as np
 import math
@@ -21,7 +22,10 @@ from src.dataset.dataset import SimpleIterDataset
 from src.utils.import_tools import import_module
 from src.utils.train_utils import (
     to_filelist,
+    dist_world,
     train_load,
+    fold_store_setup,
+    fold_load,
     onnx,
     test_load,
     iotest,
@@ -33,6 +37,13 @@ from src.utils.train_utils import (
 )
 from src.dataset.functions_graph import graph_batch_func
 from src.utils.parser_args import parser
+from src.utils.checkpoint import (
+    CheckpointWriter,
+    epoch_checkpoints,
+    rng_state,
+    set_rng_state,
+)
+from src.utils.async_eval import AsyncEvaluator
 
 
 def find_free_port():
@@ -47,6 +58,11 @@ def find_free_port():
 
 
 def _main(args):
+    # export to ONNX
+    if args.export_onnx:
+        onnx(args)
+        return
+
     if args.condensation:
         from src.utils.nn.tools_condensation import train_regression as train
         from src.utils.nn.tools_condensation import evaluate_regression as evaluate
@@ -62,28 +78,40 @@ def _main(args):
     # load data
     if training_mode:
 
-        train_loader, val_loader, data_config, train_input_names = train_load(args)
+        if args.fold_store is not None:
+            train_loader, val_loader, data_config, train_input_names = fold_load(args)
+        else:
+            train_loader, val_loader, data_config, train_input_names = train_load(
+                args
+            )
         print(train_loader)
 
     else:
         test_loaders, data_config = test_load(args)
     # device
-    if args.gpus:
-        # distributed training
-        if args.backend is not None:
-            local_rank = args.local_rank
-            print("localrank", local_rank)
+    rank, world_size = dist_world(args)
+    if args.backend is not None:
+        # distributed training, one process per GPU or, without --gpus, one
+        # process per group of CPU cores
+        local_rank = args.local_rank
+        if args.gpus:
             torch.cuda.set_device(local_rank)
             gpus = [local_rank]
             dev = torch.device(local_rank)
-            print("initizaing group process")
-            torch.distributed.init_process_group(backend=args.backend)
-            _logger.info(f"Using distributed PyTorch with {args.backend} backend")
-            print("ended initizaing group process")
         else:
-            gpus = [int(i) for i in args.gpus.split(",")]
-            dev = torch.device(gpus[0])
-            local_rank = 0
+            if args.backend != "gloo":
+                raise RuntimeError("Distributed training on the CPU needs --backend gloo")
+            gpus = None
+            dev = torch.device("cpu")
+        if not torch.distributed.is_initialized():
+            torch.distributed.init_process_group(backend=args.backend)
+        _logger.info(
+            f"Using distributed PyTorch with {args.backend} backend, rank {rank} of {world_size}"
+        )
+    elif args.gpus:
+        gpus = [int(i) for i in args.gpus.split(",")]
+        dev = torch.device(gpus[0])
+        local_rank = 0
     else:
         gpus = None
         local_rank = 0
@@ -95,12 +123,22 @@ def _main(args):
     num_parameters_counted = count_parameters(model)
     print(num_parameters_counted)
 
+    if args.profile:
+        assert training_mode, "--profile uses the training data"
+        profile(
+            args,
+            model,
+            train_loader,
+            loss_terms=[args.clustering_loss_only, args.clustering_and_energy_loss],
+        )
+        return
+
     # note: we should always save/load the state_dict of the original model, not the one wrapped by nn.DataParallel
     # so we do not convert it to nn.DataParallel now
     orig_model = model
     training_mode = not args.predict
     if training_mode:
-        if args.log_wandb and local_rank == 0:
+        if args.log_wandb and rank == 0:
             import wandb
             from src.utils.logger_wandb import log_wandb_init
 
@@ -117,23 +155,35 @@ def _main(args):
 
         # DistributedDataParallel
         if args.backend is not None:
-            model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
+            if gpus is not None:
+                # SyncBatchNorm only runs on GPUs
+                model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
             model = torch.nn.parallel.DistributedDataParallel(
                 model,
                 device_ids=gpus,
-                output_device=local_rank,
+                output_device=local_rank if gpus is not None else None,
                 find_unused_parameters=True,
             )
 
+        # optimizer, scheduler, loss scaler, step count and loader RNG of the
+        # resumed epoch
+        training_state = None
+        if args.load_epoch is not None:
+            training_state_file = (
+                args.model_prefix + "_epoch-%d_training_state.pt" % args.load_epoch
+            )
+            if os.path.exists(training_state_file):
+                training_state = torch.load(training_state_file, map_location="cpu")
+
         # optimizer & learning rate
-        opt, scheduler = optim(args, model, dev)
+        opt, scheduler = optim(args, model, dev, training_state=training_state)
 
         # DataParallel
         if args.backend is None:
             if gpus is not None and len(gpus) > 1:
                 # model becomes `torch.nn.DataParallel` w/ model.module being the original `torch.nn.Module`
                 model = torch.nn.DataParallel(model, device_ids=gpus)
-        if args.log_wandb and local_rank == 0:
+        if args.log_wandb and rank == 0:
             wandb.watch(model, log="all", log_freq=10)
             # model = model.to(dev)
 
@@ -142,6 +192,52 @@ def _main(args):
         grad_scaler = torch.cuda.amp.GradScaler() if args.use_amp else None
         tb = None
         steps = 0  # for wandb logging
+        if training_state is not None:
+            if scheduler is not None and training_state["scheduler"] is not None:
+                scheduler.load_state_dict(training_state["scheduler"])
+            if grad_scaler is not None and training_state["grad_scaler"] is not None:
+                grad_scaler.load_state_dict(training_state["grad_scaler"])
+            steps = training_state["steps"]
+            best_valid_metric = training_state["best_valid_metric"]
+            # only the global RNG: the loader restarts at the beginning of its
+            # files, and persistent or infinity loaders don't resume their
+            # position
+            set_rng_state(training_state["loader"]["rng"])
+        checkpoint_writer = None
+        if args.model_prefix and rank == 0:
+            dirname = os.path.dirname(args.model_prefix)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            # an epoch submits up to 3 jobs (state, training state, best
+            # epoch copy), none of them waits for the writes of its epoch
+            checkpoint_writer = CheckpointWriter(
+                max_in_flight=3,
+                keep_last=args.keep_checkpoints,
+                # the checkpoints of the resumed run count for --keep-checkpoints
+                existing=epoch_checkpoints(args.model_prefix, args.load_epoch)
+                if args.load_epoch is not None
+                else None,
+            )
+        evaluator = None
+        if args.async_eval:
+            if world_size > 1:
+                raise RuntimeError("--async-eval does not support distributed training")
+            evaluator = AsyncEvaluator(args, best_valid_metric)
+
+        def log_async_results(results, best_valid_metric):
+            for epoch_done, valid_metric, is_best_epoch, seconds in results:
+                if is_best_epoch:
+                    print("Best epoch!")
+                    best_valid_metric = valid_metric
+                _logger.info(
+                    "Epoch #%d: Validation metric: %.5f (best: %.5f), evaluated in %.1f s"
+                    % (epoch_done, valid_metric, best_valid_metric, seconds),
+                    color="bold",
+                )
+                if args.log_wandb:
+                    wandb.log({"loss val async": valid_metric, "epoch": epoch_done})
+            return best_valid_metric
+
         add_energy_loss = False
         if args.clustering_and_energy_loss:
             add_energy_loss = True
@@ -167,86 +263,117 @@ def _main(args):
                 steps_per_epoch=args.steps_per_epoch,
                 grad_scaler=grad_scaler,
                 tb_helper=tb,
-                logwandb=args.log_wandb,
-                local_rank=local_rank,
+                logwandb=args.log_wandb and rank == 0,
+                local_rank=rank,
                 current_step=steps,
                 loss_terms=[args.clustering_loss_only, add_energy_loss],
                 args=args,
                 args_model=data_config,
             )
 
-            if args.model_prefix and (args.backend is None or local_rank == 0):
-                dirname = os.path.dirname(args.model_prefix)
-                if dirname and not os.path.exists(dirname):
-                    os.makedirs(dirname)
-
-                state_dict = (
-                    model.module.state_dict()
-                    if isinstance(
-                        model,
-                        (
-                            torch.nn.DataParallel,
-                            torch.nn.parallel.DistributedDataParallel,
-                        ),
-                    )
-                    else model.state_dict()
-                )
-
-                torch.save(state_dict, args.model_prefix + "_epoch-%d_state.pt" % epoch)
-                torch.save(
-                    opt.state_dict(),
-                    args.model_prefix + "_epoch-%d_optimizer.pt" % epoch,
+            state_dict = (
+                model.module.state_dict()
+                if isinstance(
+                    model,
+                    (
+                        torch.nn.DataParallel,
+                        torch.nn.parallel.DistributedDataParallel,
+                    ),
                 )
-            # if args.backend is not None and local_rank == 0:
-            # TODO: save checkpoint
-            #     save_checkpoint()
-
-            _logger.info("Epoch #%d validating" % epoch)
-            valid_metric = evaluate(
-                model,
-                val_loader,
-                dev,
-                epoch,
-                loss_func=loss_func,
-                steps_per_epoch=args.steps_per_epoch_val,
-                tb_helper=tb,
-                logwandb=args.log_wandb,
-                energy_weighted=args.energy_loss,
-                local_rank=local_rank,
-                step=steps,
-                loss_terms=[args.clustering_loss_only, args.clustering_and_energy_loss],
-                args=args,
-            )
-            is_best_epoch = (
-                (valid_metric < best_valid_metric)
-                if args.regression_mode
-                else (valid_metric > best_valid_metric)
+                else model.state_dict()
             )
-            if is_best_epoch:
-                print("Best epoch!")
-                best_valid_metric = valid_metric
-                if args.model_prefix and (args.backend is None or local_rank == 0):
-                    shutil.copy2(
+            if evaluator is not None:
+                # validated by the evaluation process, which also writes the
+                # best epoch; training goes on with the next epoch
+                evaluator.submit(epoch, state_dict)
+                best_valid_metric = log_async_results(
+                    evaluator.poll(), best_valid_metric
+                )
+                is_best_epoch = False
+            else:
+                _logger.info("Epoch #%d validating" % epoch)
+                valid_metric = evaluate(
+                    model,
+                    val_loader,
+                    dev,
+                    epoch,
+                    loss_func=loss_func,
+                    steps_per_epoch=args.steps_per_epoch_val,
+                    tb_helper=tb,
+                    logwandb=args.log_wandb and rank == 0,
+                    energy_weighted=args.energy_loss,
+                    local_rank=rank,
+                    step=steps,
+                    loss_terms=[args.clustering_loss_only, args.clustering_and_energy_loss],
+                    args=args,
+                )
+                is_best_epoch = (
+                    (valid_metric < best_valid_metric)
+                    if args.regression_mode
+                    else (valid_metric > best_valid_metric)
+                )
+                if is_best_epoch:
+                    print("Best epoch!")
+                    best_valid_metric = valid_metric
+            if checkpoint_writer is not None:
+                # snapshots to CPU here, written in the background
+                checkpoint_writer.save(
+                    state_dict,
+                    args.model_prefix + "_epoch-%d_state.pt" % epoch,
+                    group="state",
+                )
+                checkpoint_writer.save(
+                    {
+                        "epoch": epoch,
+                        "optimizer": opt.state_dict(),
+                        "scheduler": scheduler.state_dict() if scheduler else None,
+                        "grad_scaler": grad_scaler.state_dict() if grad_scaler else None,
+                        "steps": steps,
+                        "best_valid_metric": best_valid_metric,
+                        "loader": {
+                            "rng": rng_state(),
+                            "batch_size": args.batch_size,
+                            "steps_per_epoch": args.steps_per_epoch,
+                        },
+                    },
+                    args.model_prefix + "_epoch-%d_training_state.pt" % epoch,
+                    group="training_state",
+                )
+                if is_best_epoch:
+                    checkpoint_writer.copy(
                         args.model_prefix + "_epoch-%d_state.pt" % epoch,
                         args.model_prefix + "_best_epoch_state.pt",
                     )
                     # torch.save(model, args.model_prefix + '_best_epoch_full.pt')
-            _logger.info(
-                "Epoch #%d: Current validation metric: %.5f (best: %.5f)"
-                % (epoch, valid_metric, best_valid_metric),
-                color="bold",
-            )
+            if evaluator is None:
+                _logger.info(
+                    "Epoch #%d: Current validation metric: %.5f (best: %.5f)"
+                    % (epoch, valid_metric, best_valid_metric),
+                    color="bold",
+                )
+        if evaluator is not None:
+            # the test below loads the best epoch the evaluation process wrote
+            _logger.info("Waiting for the evaluation of the last epochs")
+            best_valid_metric = log_async_results(evaluator.close(), best_valid_metric)
+        if checkpoint_writer is not None:
+            # the test below loads the best checkpoint
+            checkpoint_writer.close()
 
     if args.data_test:
         tb = None
-        if args.backend is not None and local_rank != 0:
+        if rank != 0:
             return
         if training_mode:
             del train_loader, val_loader
             test_loaders, data_config = test_load(args)
 
         if not args.model_prefix.endswith(".onnx"):
-            if args.predict_gpus:
+            if args.predict_gpus and args.quantize:
+                # decided before loading, the checkpoint goes straight to the CPU
+                _logger.warning("Quantized models only run on the CPU")
+                gpus = None
+                dev = torch.device("cpu")
+            elif args.predict_gpus:
                 gpus = [int(i) for i in args.predict_gpus.split(",")]
                 dev = torch.device(gpus[0])
             else:
@@ -261,6 +388,25 @@ def _main(args):
                 )
                 _logger.info("Loading model %s for eval" % model_path)
                 model.load_state_dict(torch.load(model_path, map_location=dev))
+            if args.quantize:
+                from src.utils.quantization import quantize_model, compare_quantized
+
+                get_calibration_loader = next(iter(test_loaders.values()))
+                model_int8 = quantize_model(
+                    model,
+                    mode=args.quantize,
+                    calibration_loader=get_calibration_loader(),
+                    num_batches=args.quantize_calibration_batches,
+                )
+                compare_quantized(
+                    model,
+                    model_int8,
+                    get_calibration_loader(),
+                    clust_space_dim=args.clustering_space_dim,
+                    clust_loss_only=args.clustering_loss_only,
+                    num_batches=args.quantize_calibration_batches,
+                )
+                model = model_int8
             if gpus is not None and len(gpus) > 1:
                 model = torch.nn.DataParallel(model, device_ids=gpus)
             model = model.to(dev)
@@ -272,6 +418,7 @@ def _main(args):
                 _logger.info("Loading model %s for eval" % args.model_prefix)
                 from src.utils.nn.tools import evaluate_onnx
 
+                # no loss with ONNX Runtime: test_metric is None, not logged
                 test_metric, scores, labels, observers = evaluate_onnx(
                     args.model_prefix, test_loader
                 )
@@ -327,12 +474,59 @@ def _main(args):
                 _logger.info("Written output to %s" % output_path, color="bold")
 
 
+def _run_fold(args, num_threads):
+    _configLogger(
+        "weaver",
+        stdout=None if args.log else sys.stdout,
+        filename=args.log + ".fold%d" % args.fold if args.log else None,
+    )
+    torch.set_num_threads(num_threads)
+    _main(args)
+
+
+def _run_folds(folds, jobs):
+    """
+    Trains the folds in up to `jobs` processes at the same time, each with
+    an equal share of the CPU threads
+    """
+    import multiprocessing
+    from multiprocessing.connection import wait
+
+    ctx = multiprocessing.get_context("spawn")
+    num_threads = max(1, torch.get_num_threads() // jobs)
+    pending = list(folds)
+    running = {}
+    while pending or running:
+        while pending and len(running) < jobs:
+            fold_args = pending.pop(0)
+            _logger.info("=== Starting cross validation fold %d ===" % fold_args.fold)
+            # not a daemon, the data loaders of the fold start their own processes
+            process = ctx.Process(target=_run_fold, args=(fold_args, num_threads))
+            process.start()
+            running[process.sentinel] = (fold_args, process)
+        for sentinel in wait(list(running)):
+            fold_args, process = running.pop(sentinel)
+            process.join()
+            if process.exitcode != 0:
+                for _, other in running.values():
+                    other.terminate()
+                raise RuntimeError(
+                    "Cross validation fold %d failed (exit code %s), see %s.fold%d"
+                    % (fold_args.fold, process.exitcode, fold_args.log, fold_args.fold)
+                )
+            _logger.info("=== Cross validation fold %d done ===" % fold_args.fold)
+
+
 def main():
     args = parser.parse_args()
 
+    rank, world_size = dist_world(args)
     if args.samples_per_epoch is not None:
         if args.steps_per_epoch is None:
-            args.steps_per_epoch = args.samples_per_epoch // args.batch_size
+            # --batch-size is per process
+            args.steps_per_epoch = args.samples_per_epoch // (
+                args.batch_size * world_size
+            )
         else:
             raise RuntimeError(
                 "Please use either `--steps-per-epoch` or `--samples-per-epoch`, but not both!"
@@ -340,7 +534,9 @@ def main():
 
     if args.samples_per_epoch_val is not None:
         if args.steps_per_epoch_val is None:
-            args.steps_per_epoch_val = args.samples_per_epoch_val // args.batch_size
+            args.steps_per_epoch_val = args.samples_per_epoch_val // (
+                args.batch_size * world_size
+            )
         else:
             raise RuntimeError(
                 "Please use either `--steps-per-epoch-val` or `--samples-per-epoch-val`, but not both!"
@@ -385,24 +581,50 @@ def main():
     if args.backend is not None:
         port = find_free_port()
         args.port = port
-        world_size = torch.cuda.device_count()
     stdout = sys.stdout
     if args.local_rank is not None:
-        args.log += ".%03d" % args.local_rank
-        if args.local_rank != 0:
+        args.log += ".%03d" % rank
+        if rank != 0:
             stdout = None
     _configLogger("weaver", stdout=stdout, filename=args.log)
+    if world_size > 1:
+        lr_scale = {"none": 1, "linear": world_size, "sqrt": math.sqrt(world_size)}
+        args.start_lr *= lr_scale[args.lr_scaling]
+        _logger.info(
+            "Distributed training on %d processes: batch size %d per process (%d in total), start lr %g (%s scaling)"
+            % (
+                world_size,
+                args.batch_size,
+                args.batch_size * world_size,
+                args.start_lr,
+                args.lr_scaling,
+            )
+        )
 
+    args.fold_store = None
     if args.cross_validation:
         model_dir, model_fn = os.path.split(args.model_prefix)
         var_name, kfold = args.cross_validation.split("%")
         kfold = int(kfold)
+        if args.cross_validation_store:
+            # decoded once, every fold is a subset of the store
+            args.fold_store = fold_store_setup(args, var_name, kfold)
+        folds = []
         for i in range(kfold):
-            _logger.info(f"\n=== Running cross validation, fold {i} of {kfold} ===")
-            args.model_prefix = os.path.join(f"{model_dir}_fold{i}", model_fn)
-            args.extra_selection = f"{var_name}%{kfold}!={i}"
-            args.extra_test_selection = f"{var_name}%{kfold}=={i}"
-            _main(args)
+            fold_args = copy.copy(args)
+            fold_args.fold = i
+            fold_args.model_prefix = os.path.join(f"{model_dir}_fold{i}", model_fn)
+            fold_args.extra_selection = f"{var_name}%{kfold}!={i}"
+            fold_args.extra_test_selection = f"{var_name}%{kfold}=={i}"
+            folds.append(fold_args)
+        if args.cross_validation_jobs > 1:
+            if args.fold_store is None:
+                raise RuntimeError("--cross-validation-jobs needs --cross-validation-store")
+            _run_folds(folds, args.cross_validation_jobs)
+        else:
+            for i, fold_args in enumerate(folds):
+                _logger.info(f"\n=== Running cross validation, fold {i} of {kfold} ===")
+                _main(fold_args)
     else:
         _main(args)
 
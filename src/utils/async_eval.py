@@ -0,0 +1,141 @@
+"""
+Validation in a separate process (--async-eval): after every epoch the
+training process hands a CPU snapshot of the model weights to an evaluation
+worker (through shared memory) and continues with the next epoch. The worker
+has its own validation loader, device and thread budget, runs
+evaluate_regression, keeps track of the best epoch and writes
+`{model_prefix}_best_epoch_state.pt` itself; the metrics are sent back to the
+training process, which logs them when they arrive.
+"""
+import multiprocessing
+import queue
+import sys
+import time
+import torch
+import torch.multiprocessing as mp
+from src.logger.logger import _logger, _configLogger
+from src.utils.checkpoint import atomic_save, snapshot
+
+
+def is_better(metric, best, regression_mode):
+    return metric < best if regression_mode else metric > best
+
+
+def _eval_worker(args, best_valid_metric, jobs, results):
+    from src.utils.train_utils import val_load, model_setup
+    from src.utils.nn.tools_condensation import evaluate_regression
+
+    _configLogger(
+        "weaver",
+        stdout=None if args.log else sys.stdout,
+        filename=args.log + ".eval" if args.log else None,
+    )
+    torch.set_num_threads(args.async_eval_threads)
+    dev = torch.device(args.async_eval_device)
+    # only the validation data, the training dataset is not built here
+    val_loader, data_config = val_load(args)
+    model, _, loss_func = model_setup(args, data_config)
+    model = model.to(dev)
+    while True:
+        try:
+            job = jobs.get(timeout=10)
+        except queue.Empty:
+            if not multiprocessing.parent_process().is_alive():
+                return
+            continue
+        if job is None:
+            return
+        epoch, state_dict = job
+        start_time = time.time()
+        model.load_state_dict(state_dict)
+        _logger.info("Epoch #%d validating" % epoch)
+        valid_metric = float(
+            evaluate_regression(
+                model,
+                val_loader,
+                dev,
+                epoch,
+                loss_func=loss_func,
+                steps_per_epoch=args.steps_per_epoch_val,
+                energy_weighted=args.energy_loss,
+                loss_terms=[args.clustering_loss_only, args.clustering_and_energy_loss],
+                args=args,
+            )
+        )
+        is_best_epoch = is_better(
+            valid_metric, best_valid_metric, args.regression_mode
+        )
+        if is_best_epoch:
+            best_valid_metric = valid_metric
+            if args.model_prefix:
+                atomic_save(state_dict, args.model_prefix + "_best_epoch_state.pt")
+        results.put((epoch, valid_metric, is_best_epoch, time.time() - start_time))
+        del state_dict, job
+
+
+class AsyncEvaluator(object):
+    """
+    Starts the evaluation worker. submit() blocks while max_pending epochs
+    are already waiting for the worker, which bounds the memory of the
+    snapshots; poll() returns the (epoch, metric, is_best_epoch, seconds) of
+    the evaluations finished since the last call.
+    """
+
+    def __init__(self, args, best_valid_metric, max_pending=2):
+        # spawn: the training process may already have threads and CUDA
+        ctx = mp.get_context("spawn")
+        self.jobs = ctx.Queue(maxsize=max_pending)
+        self.results = ctx.Queue()
+        self.pending = 0
+        # not a daemon, the worker's data loader starts its own processes
+        self.process = ctx.Process(
+            target=_eval_worker,
+            args=(args, best_valid_metric, self.jobs, self.results),
+        )
+        self.process.start()
+
+    def _put(self, job):
+        # a worker that died would never free a slot of the queue
+        while True:
+            try:
+                self.jobs.put(job, timeout=10)
+                return
+            except queue.Full:
+                if not self.process.is_alive():
+                    raise RuntimeError(
+                        "Evaluation worker exited (code %s) with %d epochs pending"
+                        % (self.process.exitcode, self.pending)
+                    )
+
+    def submit(self, epoch, state_dict):
+        self._put((epoch, snapshot(state_dict)))
+        self.pending += 1
+
+    def poll(self, block=False):
+        finished = []
+        while self.pending:
+            try:
+                if block:
+                    finished.append(self.results.get(timeout=10))
+                else:
+                    finished.append(self.results.get_nowait())
+            except queue.Empty:
+                if not block:
+                    break
+                if not self.process.is_alive():
+                    raise RuntimeError(
+                        "Evaluation worker exited (code %s) with %d epochs pending"
+                        % (self.process.exitcode, self.pending)
+                    )
+                continue
+            self.pending -= 1
+        return finished
+
+    def close(self):
+        """
+        Waits for the evaluation of all submitted epochs, returns their results
+        """
+        self._put(None)
+        finished = self.poll(block=True)
+        self.process.join()
+        return finished
@@ -0,0 +1,156 @@
+"""
+Checkpoints written in the background: the state dicts are copied to CPU
+memory in the training loop, serialized with torch.save by a writer thread and
+moved into place with a rename, so a checkpoint file is either complete or
+not there at all.
+"""
+import glob
+import os
+import queue
+import random
+import re
+import shutil
+import threading
+from collections import defaultdict, deque
+import numpy as np
+import torch
+from src.logger.logger import _logger
+
+
+def snapshot(state):
+    """
+    Copy of a (nested) state dict with all tensors copied to CPU memory, so
+    that training can continue while it is written
+    """
+    if torch.is_tensor(state):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return type(state)((k, snapshot(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(v) for v in state)
+    return state
+
+
+def rng_state():
+    """
+    RNG states the data loaders draw their shuffling and worker seeds from
+    """
+    return {
+        "torch": torch.get_rng_state(),
+        "numpy": np.random.get_state(),
+        "python": random.getstate(),
+    }
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["python"])
+
+
+def atomic_save(obj, path):
+    tmp_path = "%s.tmp%d" % (path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def atomic_copy(src, dst):
+    tmp_path = "%s.tmp%d" % (dst, os.getpid())
+    shutil.copy2(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+def epoch_checkpoints(model_prefix, last_epoch):
+    """
+    {group: paths} of the `_epoch-N_state.pt` ("state") and
+    `_epoch-N_training_state.pt` ("training_state") files already written for
+    the epochs up to last_epoch, oldest first, e.g. by the run that is resumed
+    """
+    pattern = re.compile(
+        re.escape(os.path.basename(model_prefix))
+        + r"_epoch-(\d+)_(state|training_state)\.pt$"
+    )
+    found = defaultdict(list)
+    for path in glob.glob(glob.escape(model_prefix) + "_epoch-*_state.pt"):
+        match = pattern.match(os.path.basename(path))
+        if match and int(match.group(1)) <= last_epoch:
+            found[match.group(2)].append((int(match.group(1)), path))
+    return {group: [path for _, path in sorted(v)] for group, v in found.items()}
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints on a background thread, in the order they are
+    submitted. save() blocks while max_in_flight snapshots are already
+    waiting, which bounds the extra CPU memory. With keep_last, only the last
+    keep_last files saved with the same `group` are kept, counting the files
+    of `existing` ({group: paths}, oldest first) as saved before.
+    Errors of the writer are raised by the next save(), copy() or wait().
+    """
+
+    def __init__(self, max_in_flight=1, keep_last=None, existing=None):
+        self.keep_last = keep_last
+        self.queue = queue.Queue(maxsize=max_in_flight)
+        self.saved = defaultdict(deque)
+        for group, paths in (existing or {}).items():
+            self.saved[group].extend(paths)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                job()
+            except Exception as e:  # reported in the training thread
+                _logger.error("Writing checkpoint failed: %s" % e)
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, state, path, group=None):
+        """
+        Snapshots state (to CPU) now and writes it to path in the background
+        """
+        self._check()
+        state = snapshot(state)
+
+        def job():
+            atomic_save(state, path)
+            _logger.info("Checkpoint written to %s" % path)
+            if group is not None and self.keep_last:
+                saved = self.saved[group]
+                saved.append(path)
+                while len(saved) > self.keep_last:
+                    old_path = saved.popleft()
+                    if os.path.exists(old_path):
+                        os.remove(old_path)
+
+        self.queue.put(job)
+
+    def copy(self, src, dst):
+        """
+        Copies src to dst after the writes submitted before are done
+        """
+        self._check()
+        self.queue.put(lambda: atomic_copy(src, dst))
+
+    def wait(self):
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
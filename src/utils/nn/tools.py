@@ -318,4 +318,38 @@ def evaluate_regression(
         return total_loss / count, scores, labels, observers
 
 
+def evaluate_onnx(model_path, test_loader, tbeta=0.1, td=1.0):
+    """
+    Runs a graph model exported to ONNX with ONNX Runtime on the CPU and clusters
+    the hits of every event.
+    :return: test_metric (None, no loss is computed), scores (per-hit
+    clustering), labels, observers (per-hit betas and event index)
+    """
+    from src.utils.onnx_inference import ONNXClusteringSession
+
+    session = ONNXClusteringSession(model_path)
+    count = 0
+    scores = []
+    labels = defaultdict(list)
+    observers = defaultdict(list)
+    start_time = time.time()
+    with tqdm.tqdm(test_loader) as tq:
+        for batch_g, _ in tq:
+            h = batch_g.ndata["h"].numpy()
+            batch = np.repeat(
+                np.arange(batch_g.batch_size), batch_g.batch_num_nodes().numpy()
+            )
+            clustering, beta = session.cluster(h, batch, tbeta=tbeta, td=td)
+            scores.append(clustering)
+            observers["beta"].append(beta)
+            observers["event_index"].append(batch + count)
+            count += batch_g.batch_size
 
+    time_diff = time.time() - start_time
+    _logger.info(
+        "Processed %d entries in total (avg. speed %.1f entries/s)"
+        % (count, count / time_diff)
+    )
+    scores = np.concatenate(scores)
+    observers = {k: _concat(v) for k, v in observers.items()}
+    return None, scores, labels, observers
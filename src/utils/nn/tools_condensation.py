@@ -20,9 +20,32 @@ from src.layers.object_cond import (
     onehot_particles_arr,
     get_clustering,
     calc_LV_Lbeta_inference,
+    plan_regression_terms,
 )
 from src.utils.logger_wandb import plot_clust
 
+# wandb names of the regression terms, and their position in the losses
+REGRESSION_LOG_KEYS = {
+    "E": ("E", 2),
+    "x": ("X", 3),
+    "PID": ("PID", 4),
+    "momentum": ("momentum", 5),
+    "mass": ("mass (not us. for opt.)", 6),
+}
+
+
+def regression_term_logs(losses, regression_terms, prefix="loss "):
+    """
+    wandb entries of the regression terms that are computed; the others are
+    only zeros and are not logged
+    """
+    logs = {}
+    for term in regression_terms:
+        name, i = REGRESSION_LOG_KEYS[term]
+        if i < len(losses):
+            logs[prefix + name] = losses[i]
+    return logs
+
 
 class_names = ["other"] + [str(i) for i in onehot_particles_arr]  # quick fix
 
@@ -46,6 +69,213 @@ def clip_list(l, clip_val=4.0):
     return result
 
 
+def peak_memory_mb(dev):
+    """
+    Peak memory since the last reset: allocated tensors on the GPU, or the max.
+    resident set size of the process on the CPU (never reset).
+    """
+    if dev.type == "cuda":
+        return torch.cuda.max_memory_allocated(dev) / 2**20
+    import resource
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+class MetricsAccumulator(object):
+    """
+    Values logged at every step, kept on the device until flush() so that
+    adding them doesn't synchronize. flush() copies the tensors of all the
+    steps since the last flush to the host in one transfer and returns one
+    dict per step (floats, numpy arrays for tensors with more than one
+    element), then resets. Host values (python floats) can be added too.
+    """
+
+    def __init__(self, dev, flush_every=10):
+        self.dev = dev
+        self.flush_every = flush_every
+        self.steps = 0
+        self.records, self.current = [], {}
+
+    def add(self, name, value):
+        if torch.is_tensor(value):
+            value = value.detach()
+        self.current[name] = value
+
+    def step(self):
+        """
+        Ends the values of a step, returns True every flush_every steps
+        """
+        self.records.append(self.current)
+        self.current = {}
+        self.steps += 1
+        return self.steps % self.flush_every == 0
+
+    def flush(self):
+        tensors = [
+            (i, name, value)
+            for i, record in enumerate(self.records)
+            for name, value in record.items()
+            if torch.is_tensor(value)
+        ]
+        if len(tensors):
+            host = torch.cat([v.float().reshape(-1) for _, _, v in tensors])
+            host = host.cpu().numpy()
+            offset = 0
+            for i, name, value in tensors:
+                values = host[offset : offset + value.numel()]
+                offset += value.numel()
+                self.records[i][name] = float(values[0]) if value.dim() == 0 else values
+        records, self.records = self.records, []
+        return records
+
+
+class StageTimer(object):
+    """
+    Wall-clock time of the stages of every step (loading, host-to-device
+    copy, forward, loss, backward, ...). stage(name) ends the current stage,
+    which started where the previous one ended; a stage can be hit more than
+    once per step. With mode "off" the calls do nothing, with "sync" the GPU
+    is synchronized at every stage boundary so that device time is attributed
+    to the right stage (otherwise it shows up where the host waits for it).
+    """
+
+    def __init__(self, dev, mode="on"):
+        self.enabled = mode != "off"
+        self.sync = mode == "sync" and dev.type == "cuda"
+        self.dev = dev
+        self.times = defaultdict(list)
+        self.current = defaultdict(float)
+        # stages measured elsewhere (add), they overlap the others
+        self.external = set()
+        self.last = time.perf_counter()
+
+    def start(self):
+        self.last = time.perf_counter()
+
+    def stage(self, name):
+        if not self.enabled:
+            return
+        if self.sync:
+            torch.cuda.synchronize(self.dev)
+        now = time.perf_counter()
+        self.current[name] += now - self.last
+        self.last = now
+
+    def add(self, name, seconds):
+        """
+        Time measured elsewhere, e.g. collate in the loader workers. It runs
+        in parallel with the stages of the step, so it is not part of the
+        fractions.
+        """
+        if self.enabled and seconds is not None:
+            self.external.add(name)
+            self.current[name] += seconds
+
+    def end_step(self):
+        if not self.enabled:
+            return
+        for name, seconds in self.current.items():
+            self.times[name].append(seconds)
+        self.current = defaultdict(float)
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """
+        {stage: {"total": s, "fraction": of all stages, "p50": s, ...}}, per-step
+        percentiles in seconds. The fraction of the stages measured elsewhere
+        (add) is None.
+        """
+        totals = {name: np.sum(times) for name, times in self.times.items()}
+        all_stages = sum(
+            total for name, total in totals.items() if name not in self.external
+        )
+        result = {}
+        for name, times in self.times.items():
+            if name in self.external:
+                fraction = None
+            else:
+                fraction = totals[name] / all_stages if all_stages > 0 else 0.0
+            result[name] = {"total": totals[name], "fraction": fraction}
+            for p, value in zip(percentiles, np.percentile(times, percentiles)):
+                result[name]["p%d" % p] = value
+        return result
+
+
+def log_stage_times(timer, mode, epoch, args):
+    """
+    Logs the per-epoch stage percentiles and appends them to --metrics-log
+    (one JSON record per line) if set
+    """
+    if not timer.enabled or not len(timer.times):
+        return
+    summary = timer.summary()
+    lines = [
+        "%-18s %7s %9.1f %9.1f %9.1f"
+        % (
+            name,
+            "-" if stats["fraction"] is None else "%.1f%%" % (100 * stats["fraction"]),
+            1000 * stats["p50"],
+            1000 * stats["p90"],
+            1000 * stats["p99"],
+        )
+        for name, stats in sorted(
+            summary.items(), key=lambda x: x[1]["total"], reverse=True
+        )
+    ]
+    _logger.info(
+        "Epoch #%d %s stage times (ms per step):\n%-18s %7s %9s %9s %9s\n%s"
+        % (epoch, mode, "stage", "share", "p50", "p90", "p99", "\n".join(lines))
+    )
+    if getattr(args, "metrics_log", None):
+        import json
+
+        with open(args.metrics_log, "a") as f:
+            f.write(
+                json.dumps({"epoch": epoch, "mode": mode, "stage_times": summary})
+                + "\n"
+            )
+
+
+def unwrap_model(model):
+    """
+    The model inside nn.DataParallel / DistributedDataParallel
+    """
+    if isinstance(
+        model, (torch.nn.DataParallel, torch.nn.parallel.DistributedDataParallel)
+    ):
+        return model.module
+    return model
+
+
+def is_distributed():
+    return torch.distributed.is_available() and torch.distributed.is_initialized()
+
+
+def all_reduce_sum(values, dev):
+    """
+    Sums the numbers (python or 0-dim tensors) of all processes of distributed
+    training, with one all_reduce; returns them unchanged otherwise
+    """
+    if not is_distributed():
+        return [float(v) for v in values]
+    summed = torch.tensor([float(v) for v in values], dtype=torch.float64, device=dev)
+    torch.distributed.all_reduce(summed)
+    return summed.tolist()
+
+
+def log_metrics(metrics):
+    # one wandb.log per step, arrays as histograms
+    for record in metrics.flush():
+        if len(record):
+            wandb.log(
+                {
+                    name: wandb.Histogram(value)
+                    if isinstance(value, np.ndarray)
+                    else value
+                    for name, value in record.items()
+                }
+            )
+
+
 def train_regression(
     model,
     loss_func,
@@ -65,6 +295,7 @@ def train_regression(
     args_model=None,
 ):
     model.train()
+    mod = unwrap_model(model).mod
     # print("starting to train")
     iterator = iter(train_loader)
     g, y = next(iterator)
@@ -74,20 +305,29 @@ def train_regression(
     data_config = train_loader.dataset.config
     clust_loss_only = loss_terms[0]
     add_energy_loss = loss_terms[1]  # whether to add energy loss to the clustering loss
+    regression_terms = plan_regression_terms(clust_loss_only, add_energy_loss)
     total_loss = 0
     num_batches = 0
     sum_abs_err = 0
     sum_sqr_err = 0
     count = 0
     step_count = current_step
+    if dev.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(dev)
+    # per-step betas, qs, lr and timings, sent to wandb every 10 steps
+    metrics = MetricsAccumulator(dev, flush_every=10)
+    timer = StageTimer(dev, mode=args.stage_timers)
     start_time = time.time()
     prev_time = time.time()
-    loss_epoch_total, losses_epoch_total = [], []
+    timer.start()
     with tqdm.tqdm(train_loader) as tq:
         for batch_g, y in tq:
             # print(batch_g)
             # print(y)
             load_end_time = time.time()
+            timer.stage("load")
+            # collate runs in the loader workers, in parallel to the step
+            timer.add("collate (loader)", getattr(batch_g, "collate_time", None))
             label = y
             step_count += 1
             num_examples = label.shape[0]
@@ -95,18 +335,20 @@ def train_regression(
             opt.zero_grad()
             with torch.cuda.amp.autocast(enabled=grad_scaler is not None):
                 batch_g = batch_g.to(dev)
+                timer.stage("to_device")
                 calc_e_frac_loss = (num_batches % 250) == 0
                 if args.loss_regularization:
                     model_output, loss_regularizing_neig, loss_ll = model(batch_g)
                 else:
                     model_output = model(batch_g)
+                timer.stage("forward")
                 preds = model_output.squeeze()
                 (
                     loss,
                     losses,
                     loss_E_frac,
                     loss_E_frac_true,
-                ) = model.mod.object_condensation_loss2(
+                ) = mod.object_condensation_loss2(
                     batch_g,
                     model_output,
                     y,
@@ -123,32 +365,27 @@ def train_regression(
                 )
                 if args.loss_regularization:
                     loss = loss + loss_regularizing_neig + loss_ll
-                betas = (
-                    torch.sigmoid(
-                        torch.reshape(preds[:, args.clustering_space_dim], [-1, 1])
-                    )
-                    .detach()
-                    .cpu()
-                    .numpy()
-                )
-                # wandb log betas hist
+                timer.stage("loss")
+                # betas and qs histograms of the step, kept on the device
                 if logwandb:
-                    wandb.log(
-                        {
-                            "betas": wandb.Histogram(betas),
-                            "qs": wandb.Histogram(
-                                np.arctanh(betas.clip(0.0, 1 - 1e-4) / 1.002) ** 2
-                                + args.qmin
-                            ),
-                        }
-                    )  # , step=step_count)
+                    betas = torch.sigmoid(preds[:, args.clustering_space_dim]).detach()
+                    metrics.add("betas", betas)
+                    metrics.add(
+                        "qs",
+                        torch.arctanh(betas.clip(0.0, 1 - 1e-4) / 1.002) ** 2
+                        + args.qmin,
+                    )
+                timer.stage("logging")
             if grad_scaler is None:
                 loss.backward()
+                timer.stage("backward")
                 opt.step()
             else:
                 grad_scaler.scale(loss).backward()
+                timer.stage("backward")
                 grad_scaler.step(opt)
                 grad_scaler.update()
+            timer.stage("optimizer")
             step_end_time = time.time()
 
             if clust_loss_only and calc_e_frac_loss and logwandb:
@@ -159,13 +396,10 @@ def train_regression(
                     }
                 )
             if logwandb and (num_batches % 10) == 0:
-                wandb.log(
-                    {
-                        "load_time": load_end_time - prev_time,
-                        "step_time": step_end_time - load_end_time,
-                    }
-                )  # , step=step_count)
-            loss = loss.item()
+                metrics.add("load_time", load_end_time - prev_time)
+                metrics.add("step_time", step_end_time - load_end_time)
+            # stays on the device, total_loss is copied to the host after the epoch
+            loss = loss.detach()
 
             num_batches += 1
             count += num_examples
@@ -187,15 +421,21 @@ def train_regression(
                     scheduler.step()  # loss
                 if logwandb and local_rank == 0:
                     if args.lr_scheduler == "reduceplateau":
-                        wandb.log({"lr": opt.param_groups[0]["lr"]})
+                        metrics.add("lr", opt.param_groups[0]["lr"])
                     else:
-                        wandb.log({"lr": scheduler.get_last_lr()[0]})
+                        metrics.add("lr", scheduler.get_last_lr()[0])
+            if metrics.step() and logwandb:
+                log_metrics(metrics)
 
             if tb_helper:
                 print("tb_helper!", tb_helper)
                 tb_helper.write_scalars(
                     [
-                        ("Loss/train", loss, tb_helper.batch_train_count + num_batches),
+                        (
+                            "Loss/train",
+                            loss.item(),
+                            tb_helper.batch_train_count + num_batches,
+                        ),
                     ]
                 )
                 if tb_helper.custom_fn:
@@ -209,9 +449,6 @@ def train_regression(
                         )
 
             if logwandb and ((num_batches - 1) % 10) == 0:
-                pid_true, pid_pred = losses[7], losses[8]
-                loss_epoch_total.append(loss)
-                losses_epoch_total.append(losses)
                 fig, ax = plt.subplots()
                 repulsive, attractive = (
                     lst_nonzero(losses[16].detach().cpu().flatten()),
@@ -240,11 +477,7 @@ def train_regression(
                         "loss regression": loss,
                         "loss lv": losses[0],
                         "loss beta": losses[1],
-                        "loss E": losses[2],
-                        "loss X": losses[3],
-                        "loss PID": losses[4],
-                        "loss momentum": losses[5],
-                        "loss mass (not us. for opt.)": losses[6],
+                        **regression_term_logs(losses, regression_terms),
                         "inter-clustering loss": losses[10],
                         "filling loss": losses[11],
                         "loss attractive": losses[12],
@@ -259,21 +492,21 @@ def train_regression(
 
                 if (num_batches - 1) % 100 == 0:
                     if clust_loss_only:
-                        clust_space_dim = model.mod.output_dim - 1
+                        clust_space_dim = mod.output_dim - 1
                     else:
-                        clust_space_dim = model.mod.output_dim - 28
+                        clust_space_dim = mod.output_dim - 28
                     bj = torch.sigmoid(
                         torch.reshape(model_output[:, clust_space_dim], [-1, 1])
                     )  # 3: betas
                     xj = model_output[:, 0:clust_space_dim]  # xj: cluster space coords
                     # assert len(bj) == len(xj)
-                    if model.mod.clust_space_norm == "twonorm":
+                    if mod.clust_space_norm == "twonorm":
                         xj = torch.nn.functional.normalize(
                             xj, dim=1
                         )  # 0, 1, 2: cluster space coords
-                    elif model.mod.clust_space_norm == "tanh":
+                    elif mod.clust_space_norm == "tanh":
                         xj = torch.tanh(xj)
-                    elif model.mod.clust_space_norm == "none":
+                    elif mod.clust_space_norm == "none":
                         pass
 
                     bj = bj.clip(0.0, 1 - 1e-4)
@@ -292,42 +525,61 @@ def train_regression(
                     )
                     wandb.log({"clust": wandb.Image(fig)})
                     fig.clf()
-                    if (num_batches - 1) % 500 == 0:
+                    # no PID labels when the PID term is not computed
+                    has_pid = losses.pid_true_index.numel() > 0
+                    if (num_batches - 1) % 500 == 0 and has_pid:
                         wandb.log(
                             {
                                 "conf_mat_train": wandb.plot.confusion_matrix(
-                                    y_true=pid_true,
-                                    preds=pid_pred,
+                                    y_true=losses.pid_true,
+                                    preds=losses.pid_pred,
                                     class_names=class_names,
                                 )
                             }
                         )
 
-                ks = sorted(list(losses[9].keys()))
-                losses_cpu = [
-                    x.detach().to("cpu") if isinstance(x, torch.Tensor) else x
-                    for x in losses
-                ]
-                tables = {}
-                for key in ks:
-                    tables[key] = losses[9][
-                        key
-                    ]  # wandb.Table(data=[[x] for x in losses[9][key]], columns=[key])
-                wandb.log(
-                    {
-                        key: wandb.Histogram(clip_list(tables[key]), num_bins=100)
-                        for key, val in losses_cpu[9].items()
-                    }
-                )  # , step=step_count)
+                # only the computed terms have resolutions
+                if len(losses.resolutions):
+                    wandb.log(
+                        {
+                            key: wandb.Histogram(clip_list(val), num_bins=100)
+                            for key, val in losses.resolutions.items()
+                        }
+                    )  # , step=step_count)
+            timer.stage("logging")
+            timer.end_step()
             if steps_per_epoch is not None and num_batches >= steps_per_epoch:
                 break
             prev_time = time.time()
 
+    if logwandb:
+        log_metrics(metrics)
+    log_stage_times(timer, "train", epoch, args)
     time_diff = time.time() - start_time
     _logger.info(
         "Processed %d entries in total (avg. speed %.1f entries/s)"
         % (count, count / time_diff)
     )
+    # the epoch statistics are over all processes of distributed training
+    total_loss, num_batches, count, sum_sqr_err, sum_abs_err = all_reduce_sum(
+        [total_loss, num_batches, count, sum_sqr_err, sum_abs_err], dev
+    )
+    num_batches, count = int(num_batches), int(count)
+    if is_distributed():
+        _logger.info(
+            "Processed %d entries on all processes (avg. speed %.1f entries/s)"
+            % (count, count / time_diff)
+        )
+    peak_memory = peak_memory_mb(dev)
+    if dev.type == "cuda":
+        _logger.info("Peak memory during training: %.1f MB" % peak_memory)
+        memory_key = "peak memory (MB)"
+    else:
+        # ru_maxrss can't be reset, it is the peak of all epochs so far
+        _logger.info("Peak memory of the process so far: %.1f MB" % peak_memory)
+        memory_key = "peak memory process lifetime (MB)"
+    if logwandb and local_rank == 0:
+        wandb.log({memory_key: peak_memory})
     if count > 0 and num_batches > 0:
         _logger.info(
             "Train AvgLoss: %.5f, AvgMSE: %.5f, AvgMAE: %.5f"
@@ -356,7 +608,8 @@ def train_regression(
         if scheduler and getattr(scheduler, "_update_per_step") == False:
             if args.lr_scheduler == "reduceplateau":
                 scheduler.step(total_loss / num_batches)  # loss
-                wandb.log({"total_loss batch": total_loss / num_batches})
+                if logwandb and local_rank == 0:
+                    wandb.log({"total_loss batch": total_loss / num_batches})
             else:
                 scheduler.step()  # loss
             if logwandb and local_rank == 0:
@@ -366,6 +619,16 @@ def train_regression(
                     wandb.log({"lr": scheduler.get_last_lr()[0]})
     return step_count
 
+
+def pid_counts_dict(pids, counts):
+    # {pid: count} for the particle types with a non-zero count
+    return {
+        pid: count
+        for pid, count in zip(pids.tolist(), counts.tolist())
+        if count > 0
+    }
+
+
 def update_dict(dict1, dict2):
     for key in dict2:
         if key not in dict1:
@@ -464,15 +727,14 @@ def inference_statistics(
                     e_frac_loss_radius=radius
                 )
                 loss_E_frac_true, particle_ids_all, reco_count, non_reco_count, total_count = loss_E_frac_true
-                update_dict(reco_counts, reco_count)
-                update_dict(total_counts, total_count)
-                if len(reco_count):
-                    assert len(reco_counts) >= len(reco_count)
-                update_dict(non_reco_counts, non_reco_count)
-                loss_E_fracs.append([x.cpu() for x in loss_E_frac])
-                loss_E_fracs_true.append([x.cpu() for x in loss_E_frac_true])
-                part_PID_true.append([y[torch.tensor(pidall) - 1, 6].long() for pidall in particle_ids_all])
-                part_E_true.append([y[torch.tensor(pidall) - 1, 3] for pidall in particle_ids_all])
+                update_dict(reco_counts, pid_counts_dict(*reco_count))
+                update_dict(total_counts, pid_counts_dict(*total_count))
+                update_dict(non_reco_counts, pid_counts_dict(*non_reco_count))
+                loss_E_fracs.append(loss_E_frac.detach().cpu())
+                loss_E_fracs_true.append(loss_E_frac_true.detach().cpu())
+                particle_ids_all = particle_ids_all.cpu()
+                part_PID_true.append(y[particle_ids_all - 1, 6].long())
+                part_E_true.append(y[particle_ids_all - 1, 3])
                 if clust_loss_only:
                     clust_space_dim = model.mod.output_dim - 1
                 else:
@@ -504,14 +766,10 @@ def inference_statistics(
             num_batches += 1
             if num_batches % 5 == 0 and save_ckpt_to_folder is not None:
                 Path(save_ckpt_to_folder).mkdir(parents=True, exist_ok=True)
-                loss_E_fracs_fold = [item for sublist in loss_E_fracs for item in sublist]
-                loss_E_fracs_fold = torch.concat(loss_E_fracs_fold).flatten()
-                loss_E_fracs_true_fold = [item for sublist in loss_E_fracs_true for item in sublist]
-                loss_E_fracs_true_fold = torch.concat(loss_E_fracs_true_fold).flatten()
-                part_E_true_fold = [item for sublist in part_E_true for item in sublist]
-                part_E_true_fold = torch.concat(part_E_true_fold).flatten()
-                part_PID_true_fold = [item for sublist in part_PID_true for item in sublist]
-                part_PID_true_fold = torch.concat(part_PID_true_fold).flatten()
+                loss_E_fracs_fold = torch.concat(loss_E_fracs).flatten()
+                loss_E_fracs_true_fold = torch.concat(loss_E_fracs_true).flatten()
+                part_E_true_fold = torch.concat(part_E_true).flatten()
+                part_PID_true_fold = torch.concat(part_PID_true).flatten()
                 obj = {
                     "loss_e_fracs": loss_E_fracs_fold,
                     "loss_e_fracs_true": loss_E_fracs_true_fold,
@@ -529,13 +787,9 @@ def inference_statistics(
             # flatten the lists
         if save_ckpt_to_folder is not None:
             return
-        loss_E_fracs = [item for sublist in loss_E_fracs for item in sublist]
         loss_E_fracs = torch.concat(loss_E_fracs).flatten()
-        loss_E_fracs_true = [item for sublist in loss_E_fracs_true for item in sublist]
         loss_E_fracs_true = torch.concat(loss_E_fracs_true).flatten()
-        part_E_true = [item for sublist in part_E_true for item in sublist]
         part_E_true = torch.concat(part_E_true).flatten()
-        part_PID_true = [item for sublist in part_PID_true for item in sublist]
         part_PID_true = torch.concat(part_PID_true).flatten()
     return {
         "loss_e_fracs": loss_E_fracs,
@@ -614,16 +868,18 @@ def evaluate_regression(
     :return:
     """
     model.eval()
+    mod = unwrap_model(model).mod
 
     data_config = test_loader.dataset.config
 
-    center, scales = _check_scales_centers(iter(test_loader.dataset))
+    center, scales = _check_scales_centers(test_loader.dataset)
     total_loss = 0
     num_batches = 0
     sum_sqr_err = 0
     sum_abs_err = 0
     clust_loss_only = loss_terms[0]
     add_energy_loss = loss_terms[1]  # whether to add energy loss to the clustering loss
+    regression_terms = plan_regression_terms(clust_loss_only, add_energy_loss)
     count = 0
     scores = []
     results = []  # resolution results
@@ -631,35 +887,43 @@ def evaluate_regression(
     observers = defaultdict(list)
     start_time = time.time()
     all_val_loss, all_val_losses = [], []
+    timer = StageTimer(dev, mode=args.stage_timers)
 
     with torch.no_grad():
         with tqdm.tqdm(test_loader) as tq:
+            timer.start()
             for batch_g, y in tq:
+                timer.stage("load")
+                timer.add("collate (loader)", getattr(batch_g, "collate_time", None))
                 calc_e_frac_loss = num_batches % 10 == 0
                 batch_g = batch_g.to(dev)
                 label = y
                 num_examples = label.shape[0]
                 label = label.to(dev)
+                timer.stage("to_device")
                 if args.loss_regularization:
                     model_output, loss_regularizing_neig, loss_ll = model(batch_g)
                 else:
                     model_output = model(batch_g)
+                timer.stage("forward")
                 preds = model_output.squeeze().float()
                 (
                     loss,
                     losses,
                     loss_E_frac,
                     loss_E_frac_true,
-                ) = model.mod.object_condensation_loss2(
+                ) = mod.object_condensation_loss2(
                     batch_g,
                     model_output,
                     y,
                     frac_clustering_loss=0,
                     q_min=args.qmin,
-                    clust_loss_only=args.clustering_loss_only,
+                    clust_loss_only=clust_loss_only,
+                    add_energy_loss=add_energy_loss,
                     use_average_cc_pos=args.use_average_cc_pos,
                     hgcalloss=args.hgcalloss,
                 )
+                timer.stage("loss")
                 num_batches += 1
                 count += num_examples
                 total_loss += loss * num_examples
@@ -681,32 +945,46 @@ def evaluate_regression(
                                 i_batch=num_batches,
                                 mode="eval" if for_training else "test",
                             )
-                losses_cpu = [
-                    x.detach().to("cpu") if isinstance(x, torch.Tensor) else x
-                    for x in losses
-                ]
-                all_val_losses.append(losses_cpu)
-                all_val_loss.append(loss.detach().to("cpu").item())
+                if logwandb:
+                    # kept on the device, copied to the host once after the loop
+                    all_val_losses.append(
+                        (
+                            torch.stack([losses[i].detach() for i in range(4)]),
+                            losses.pid_true_index,
+                            losses.pid_pred_index,
+                            losses.resolutions_device,
+                        )
+                    )
+                all_val_loss.append(loss.detach())
+                timer.stage("logging")
+                timer.end_step()
                 if steps_per_epoch is not None and num_batches >= steps_per_epoch:
                     break
 
+    log_stage_times(timer, "eval" if for_training else "test", epoch, args)
     if logwandb:
-        pid_true, pid_pred = torch.cat(
-            [torch.tensor(x[7]) for x in all_val_losses]
-        ), torch.cat([torch.tensor(x[8]) for x in all_val_losses])
-        pid_true, pid_pred = pid_true.tolist(), pid_pred.tolist()
+        val_losses = torch.stack([x[0] for x in all_val_losses]).mean(dim=0).tolist()
+        pid_true = torch.cat([x[1] for x in all_val_losses]).tolist()
+        pid_pred = torch.cat([x[2] for x in all_val_losses]).tolist()
         wandb.log(
             {
-                "loss val regression": np.mean(all_val_loss),
-                "loss val lv": np.mean([x[0] for x in all_val_losses]),
-                "loss val beta": np.mean([x[1] for x in all_val_losses]),
-                "loss val E": np.mean([x[2] for x in all_val_losses]),
-                "loss val X": np.mean([x[3] for x in all_val_losses]),
-                "conf_mat_val": wandb.plot.confusion_matrix(
-                    y_true=pid_true, preds=pid_pred, class_names=class_names
+                "loss val regression": torch.stack(all_val_loss).mean().item(),
+                "loss val lv": val_losses[0],
+                "loss val beta": val_losses[1],
+                # only E and X are kept for the validation
+                **regression_term_logs(
+                    val_losses, regression_terms, prefix="loss val "
                 ),
             }
         )  # , step=step)
+        if len(pid_true):
+            wandb.log(
+                {
+                    "conf_mat_val": wandb.plot.confusion_matrix(
+                        y_true=pid_true, preds=pid_pred, class_names=class_names
+                    ),
+                }
+            )
         if clust_loss_only and calc_e_frac_loss:
             wandb.log(
                 {
@@ -714,27 +992,37 @@ def evaluate_regression(
                     "loss e frac true val": loss_E_frac_true,
                 }
             )
-        ks = sorted(list(all_val_losses[0][9].keys()))
+        ks = sorted(list(all_val_losses[0][3].keys()))
         concatenated = {}
         for key in ks:
-            concatenated[key] = np.concatenate([x[9][key] for x in all_val_losses])
+            concatenated[key] = (
+                torch.cat([x[3][key] for x in all_val_losses]).cpu().numpy()
+            )
         tables = {}
         for key in ks:
             tables[key] = concatenated[
                 key
             ]  # wandb.Table(data=[[x] for x in concatenated[key]], columns=[key])
-        wandb.log(
-            {
-                "val " + key: wandb.Histogram(clip_list(tables[key]), num_bins=100)
-                for key in ks
-            }
-        )  # , step=step)
+        # only the computed terms have resolutions
+        if len(ks):
+            wandb.log(
+                {
+                    "val " + key: wandb.Histogram(clip_list(tables[key]), num_bins=100)
+                    for key in ks
+                }
+            )  # , step=step)
 
     time_diff = time.time() - start_time
     _logger.info(
         "Processed %d entries in total (avg. speed %.1f entries/s)"
         % (count, count / time_diff)
     )
+    if for_training and is_distributed():
+        # the validation metric is over the events of all processes (the test
+        # only runs on rank 0)
+        total_loss, count, sum_sqr_err, sum_abs_err = all_reduce_sum(
+            [total_loss, count, sum_sqr_err, sum_abs_err], dev
+        )
 
     if tb_helper:
         tb_mode = "eval" if for_training else "test"
@@ -769,13 +1057,13 @@ def evaluate_regression(
             return total_loss / count, scores, labels, observers
 
 
-def _check_scales_centers(iterator):
+def _check_scales_centers(dataset):
     regress_items = ["part_theta", "part_phi"]
     centers = np.zeros(2)
     scales = np.zeros(2)
     for ii, item in enumerate(regress_items):
-        centers[ii] = iterator._data_config.preprocess_params[item]["center"]
-        scales[ii] = iterator._data_config.preprocess_params[item]["scale"]
+        centers[ii] = dataset.config.preprocess_params[item]["center"]
+        scales[ii] = dataset.config.preprocess_params[item]["scale"]
     return centers, scales
 
 
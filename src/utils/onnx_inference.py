@@ -0,0 +1,54 @@
+"""
+ONNX Runtime (CPU) inference for the graph models exported with `--export-onnx`.
+Only needs numpy and onnxruntime, so it can be used without PyTorch.
+"""
+import numpy as np
+from src.layers.clustering import get_clustering_batch_np
+
+
+class ONNXClusteringSession(object):
+    """
+    Runs a model exported through `get_onnx_model` (inputs: hit features `h` and
+    per-hit event index `batch`; outputs: `output`, `cluster_coords`, `beta`) and
+    clusters the hits of every event.
+    """
+
+    def __init__(self, model_path, num_threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(
+            model_path, sess_options=options, providers=["CPUExecutionProvider"]
+        )
+
+    def run(self, h, batch):
+        """
+        :param h: hit features (n_hits x n_features), float32
+        :param batch: event index of every hit (n_hits,), sorted
+        :return: output, cluster_coords, beta
+        """
+        return self.session.run(
+            ["output", "cluster_coords", "beta"],
+            {
+                "h": np.ascontiguousarray(h, dtype=np.float32),
+                "batch": np.ascontiguousarray(batch, dtype=np.int64),
+            },
+        )
+
+    def cluster(self, h, batch, tbeta=0.1, td=1.0):
+        """
+        Returns the clustering (hit -> index of its condensation point within the
+        event, -1 for unassigned hits) and the betas of all hits.
+        """
+        _, coords, beta = self.run(h, batch)
+        return cluster_events(beta, coords, batch, tbeta=tbeta, td=td), beta
+
+
+def cluster_events(betas, X, batch, tbeta=0.1, td=1.0):
+    """
+    Applies get_clustering_np to every event of a batch, in one call.
+    Assumes batch is sorted.
+    """
+    return get_clustering_batch_np(betas, X, batch, tbeta=tbeta, td=td)
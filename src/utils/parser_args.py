@@ -93,6 +93,19 @@ parser.add_argument(
     default=False,
     help="load the whole dataset (and perform the preprocessing) only once and keep it in memory for the entire run",
 )
+parser.add_argument(
+    "--val-cache",
+    type=str,
+    choices=["none", "memory", "disk"],
+    default="none",
+    help="keep the collated validation batches of the first epoch (in memory, or on disk in --val-cache-dir) and validate on them in the later epochs",
+)
+parser.add_argument(
+    "--val-cache-dir",
+    type=str,
+    default="",
+    help="directory of the validation cache with `--val-cache disk` (default: val_cache next to the model prefix); it is keyed by the data config, the files and the loading options",
+)
 parser.add_argument(
     "--train-val-split",
     type=float,
@@ -233,14 +246,44 @@ parser.add_argument(
     default=0,
     help="number of warm-up steps, only valid for `flat+linear` and `flat+cos` lr schedulers",
 )
+parser.add_argument(
+    "--keep-checkpoints",
+    type=int,
+    default=None,
+    help="keep only the checkpoints of the last N epochs (default: keep all), counting those of the run resumed with --load-epoch; the best epoch is always kept as `{model_prefix}_best_epoch_state.pt`",
+)
+parser.add_argument(
+    "--async-eval",
+    action="store_true",
+    default=False,
+    help="validate in a separate process: training continues with the next epoch while the last one is evaluated, the metrics and the best epoch are logged when they arrive",
+)
+parser.add_argument(
+    "--async-eval-threads",
+    type=int,
+    default=4,
+    help="number of threads of the evaluation process with `--async-eval`",
+)
+parser.add_argument(
+    "--async-eval-device",
+    type=str,
+    default="cpu",
+    help="device of the evaluation process with `--async-eval`, e.g. `cpu` or `cuda:1`",
+)
 parser.add_argument(
     "--load-epoch",
     type=int,
     default=None,
-    help="used to resume interrupted training, load model and optimizer state saved in the `epoch-%d_state.pt` and `epoch-%d_optimizer.pt` files",
+    help="used to resume interrupted training, load model and optimizer state saved in the `epoch-%d_state.pt` and `epoch-%d_training_state.pt` (or `epoch-%d_optimizer.pt`) files; "
+    "of the data loading only the global RNG state is restored, the loaders don't resume their position in the files (neither with --steps-per-epoch, whose workers are persistent)",
 )
 parser.add_argument("--start-lr", type=float, default=5e-3, help="start learning rate")
-parser.add_argument("--batch-size", type=int, default=128, help="batch size")
+parser.add_argument(
+    "--batch-size",
+    type=int,
+    default=128,
+    help="batch size (per process in distributed training)",
+)
 parser.add_argument(
     "--use-amp",
     action="store_true",
@@ -283,6 +326,22 @@ parser.add_argument(
     help="export the PyTorch model to ONNX model and save it at the given path (path must ends w/ .onnx); "
     "needs to set `--data-config`, `--network-config`, and `--model-prefix` (requires the full model path)",
 )
+parser.add_argument(
+    "--quantize",
+    type=str,
+    default=None,
+    choices=["dynamic", "static"],
+    help="run the prediction on the CPU with an INT8 quantized copy of the model and report "
+    "its latency and accuracy w.r.t. the float model; `static` calibrates the activation ranges "
+    "on `--quantize-calibration-batches` batches of the first test file group",
+)
+parser.add_argument(
+    "--quantize-calibration-batches",
+    type=int,
+    default=10,
+    help="number of test batches used to calibrate and evaluate the quantized model "
+    "(at least 2, the first one is a warm-up for the timing)",
+)
 parser.add_argument(
     "--io-test",
     action="store_true",
@@ -308,14 +367,56 @@ parser.add_argument(
     help="do not run training/prediction but only print model information, e.g., FLOPs and number of parameters of a model",
 )
 parser.add_argument(
-    "--profile", action="store_true", default=False, help="run the profiler"
+    "--profile",
+    action="store_true",
+    default=False,
+    help="profile forward, loss and backward on real training batches (CPU) instead of training",
+)
+parser.add_argument(
+    "--stage-timers",
+    type=str,
+    choices=["off", "on", "sync"],
+    default="on",
+    help="per-stage wall-clock times of the training and evaluation steps, reported per epoch; `sync` synchronizes the GPU at every stage boundary to attribute device time exactly (slower)",
+)
+parser.add_argument(
+    "--metrics-log",
+    type=str,
+    default="",
+    help="local file the per-epoch stage times are appended to (one JSON record per line)",
+)
+parser.add_argument(
+    "--profile-batches",
+    type=int,
+    default=10,
+    help="number of batches to profile with `--profile`",
+)
+parser.add_argument(
+    "--profile-trace",
+    type=str,
+    default="/tmp/trace.json",
+    help="path of the Chrome trace written by `--profile`",
 )
 parser.add_argument(
     "--backend",
     type=str,
     choices=["gloo", "nccl", "mpi"],
     default=None,
-    help="backend for distributed training",
+    help="backend for distributed training, started with torchrun (one process per GPU, or on the CPU without --gpus with the gloo backend)",
+)
+parser.add_argument(
+    "--dist-shard",
+    type=str,
+    choices=["files", "entries"],
+    default="files",
+    help="distributed training: every process reads 1/N of the files, or 1/N of the events of every file (if there are fewer files than processes)",
+)
+parser.add_argument(
+    "--lr-scaling",
+    type=str,
+    choices=["none", "linear", "sqrt"],
+    default="none",
+    help="distributed training: scale --start-lr with the number of processes N (linear: N, sqrt: sqrt(N)), since the total batch size is N * --batch-size",
 )
 parser.add_argument(
     "--cross-validation",
@@ -323,6 +424,18 @@ parser.add_argument(
     default=None,
     help="enable k-fold cross validation; input format: `variable_name%k`",
 )
+parser.add_argument(
+    "--cross-validation-store",
+    type=str,
+    default="",
+    help="with `--cross-validation`: decode and preprocess the training files once into an indexed store in this directory (reused while the data config, files and options are the same); every fold trains and validates on its subset of the store",
+)
+parser.add_argument(
+    "--cross-validation-jobs",
+    type=int,
+    default=1,
+    help="with `--cross-validation-store`: number of folds trained at the same time, as separate processes (logging to `{log}.foldN`)",
+)
 parser.add_argument(
     "--log-wandb", action="store_true", default=False, help="use wandb for loging"
 )
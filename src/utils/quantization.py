@@ -0,0 +1,152 @@
+import copy
+import time
+import numpy as np
+import torch
+from sklearn.metrics import adjusted_rand_score
+from src.logger.logger import _logger
+from src.layers.clustering import get_clustering_batch_np
+
+
+def quantizable_modules(model, static=False):
+    """
+    Names of the submodules of `model` (the wrapped `model.mod`) to quantize.
+    Models can list them with a `quantizable_modules(static)` method, otherwise
+    all nn.Linear layers are used. With static, only modules run by the forward
+    can be listed, the others would never be calibrated.
+    """
+    if hasattr(model, "quantizable_modules"):
+        return model.quantizable_modules(static=static)
+    return [
+        name
+        for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear)
+    ]
+
+
+def quantize_model(model, mode="dynamic", calibration_loader=None, num_batches=10):
+    """
+    Returns an INT8 copy of the model for CPU inference; the original model is
+    left untouched.
+    :param model: wrapper model (with the network in `model.mod`)
+    :param mode: "dynamic" (weights in INT8, activations quantized on the fly) or
+        "static" (activations quantized with ranges observed on calibration batches)
+    :param calibration_loader: loader yielding (graph, y), needed for "static"
+    :param num_batches: number of calibration batches
+    """
+    model = copy.deepcopy(model).cpu()
+    model.eval()
+    names = quantizable_modules(model.mod, static=mode == "static")
+    _logger.info("Quantizing (%s) modules: %s" % (mode, ", ".join(names)))
+    if mode == "dynamic":
+        model.mod = torch.ao.quantization.quantize_dynamic(
+            model.mod,
+            {name: torch.ao.quantization.default_dynamic_qconfig for name in names},
+            dtype=torch.qint8,
+        )
+    elif mode == "static":
+        assert calibration_loader is not None, "static quantization needs calibration"
+        qconfig = torch.ao.quantization.get_default_qconfig("fbgemm")
+        for name in names:
+            parent_name, _, attr = name.rpartition(".")
+            parent = model.mod.get_submodule(parent_name) if parent_name else model.mod
+            wrapped = torch.ao.quantization.QuantWrapper(getattr(parent, attr))
+            wrapped.qconfig = qconfig
+            setattr(parent, attr, wrapped)
+        torch.ao.quantization.prepare(model.mod, inplace=True)
+        with torch.no_grad():
+            for i, (batch_g, _) in enumerate(calibration_loader):
+                if i >= num_batches:
+                    break
+                model(batch_g)
+        torch.ao.quantization.convert(model.mod, inplace=True)
+    else:
+        raise ValueError(f"Quantization mode {mode} is not known")
+    return model
+
+
+def _split_outputs(model_output, clust_space_dim, clust_space_norm, clust_loss_only):
+    xj = model_output[:, 0:clust_space_dim]
+    if clust_space_norm == "twonorm":
+        xj = torch.nn.functional.normalize(xj, dim=1)
+    elif clust_space_norm == "tanh":
+        xj = torch.tanh(xj)
+    bj = torch.sigmoid(model_output[:, clust_space_dim])
+    if clust_loss_only:
+        energy_correction = None
+    else:
+        energy_correction = torch.nn.functional.relu(
+            model_output[:, 4 + clust_space_dim]
+        )
+    return xj, bj, energy_correction
+
+
+def compare_quantized(
+    model, model_int8, loader, clust_space_dim, clust_loss_only=True, num_batches=10
+):
+    """
+    Runs the float and the INT8 model on the same CPU batches and reports the
+    forward latency of both, the differences of the cluster space coordinates,
+    betas and energy corrections, and the agreement of the resulting clusterings
+    (adjusted Rand index, per event). The first batch is only a warm-up for
+    the timing, so num_batches must be at least 2.
+    """
+    assert num_batches >= 2, "the comparison needs a warm-up and at least one batch"
+    model = model.cpu()
+    model.eval()
+    model_int8.eval()
+    clust_space_norm = model.mod.clust_space_norm
+    times, times_int8 = [], []
+    diffs = {"coords": [], "beta": [], "energy_correction": []}
+    rand_scores = []
+    with torch.no_grad():
+        for i, (batch_g, _) in enumerate(loader):
+            if i >= num_batches:
+                break
+            start = time.time()
+            out = model(batch_g)
+            times.append(time.time() - start)
+            start = time.time()
+            out_int8 = model_int8(batch_g)
+            times_int8.append(time.time() - start)
+            if i == 0:
+                continue  # warm-up batch, only used for the timing
+            xj, bj, e = _split_outputs(
+                out, clust_space_dim, clust_space_norm, clust_loss_only
+            )
+            xj_q, bj_q, e_q = _split_outputs(
+                out_int8, clust_space_dim, clust_space_norm, clust_loss_only
+            )
+            diffs["coords"].append((xj - xj_q).norm(dim=1).mean().item())
+            diffs["beta"].append((bj - bj_q).abs().mean().item())
+            if e is not None:
+                diffs["energy_correction"].append(
+                    ((e - e_q).abs() / (e.abs() + 1e-7)).mean().item()
+                )
+            n_per_event = batch_g.batch_num_nodes().cpu().numpy()
+            batch = np.repeat(np.arange(len(n_per_event)), n_per_event)
+            clustering = get_clustering_batch_np(bj.numpy(), xj.numpy(), batch)
+            clustering_q = get_clustering_batch_np(bj_q.numpy(), xj_q.numpy(), batch)
+            offsets = np.concatenate([[0], np.cumsum(n_per_event)])
+            for start, end in zip(offsets[:-1], offsets[1:]):
+                rand_scores.append(
+                    adjusted_rand_score(
+                        clustering[start:end], clustering_q[start:end]
+                    )
+                )
+    report = {
+        "latency_ms": 1000 * np.mean(times[1:]),
+        "latency_int8_ms": 1000 * np.mean(times_int8[1:]),
+        "mean_abs_diff_coords": np.mean(diffs["coords"]),
+        "mean_abs_diff_beta": np.mean(diffs["beta"]),
+        "clustering_adjusted_rand_index": np.mean(rand_scores),
+    }
+    if len(diffs["energy_correction"]):
+        report["mean_rel_diff_energy_correction"] = np.mean(
+            diffs["energy_correction"]
+        )
+    report["speedup"] = report["latency_ms"] / report["latency_int8_ms"]
+    _logger.info(
+        "Quantization report:\n%s"
+        % "\n".join("    - %s: %.4f" % (k, v) for k, v in report.items())
+    )
+    return report
@@ -16,6 +16,28 @@ from src.logger.logger import _logger, _configLogger
 from src.dataset.dataset import SimpleIterDataset
 from src.utils.import_tools import import_module
 from src.dataset.functions_graph import graph_batch_func
+from src.dataset.val_cache import CachedLoader, cache_key
+from src.dataset.fold_store import FoldStore, FoldDataset, build_fold_store
+
+
+def dist_world(args):
+    """
+    Rank and number of processes of distributed training (set by torchrun),
+    (0, 1) without --backend
+    """
+    if args.backend is None:
+        return 0, 1
+    return int(os.environ.get("RANK", "0")), int(os.environ.get("WORLD_SIZE", "1"))
+
+
+def shard_range(load_range, rank, world_size):
+    """
+    Part `rank` of `world_size` equal parts of the fractional range of events
+    load_range = (start, end)
+    """
+    start, end = load_range
+    interval = (end - start) / world_size
+    return (start + rank * interval, start + (rank + 1) * interval)
 
 
 def to_filelist(args, mode="train"):
@@ -43,17 +65,22 @@ def to_filelist(args, mode="train"):
     for name, files in file_dict.items():
         file_dict[name] = sorted(files)
 
-    if args.local_rank is not None:
-        if mode == "train":
-            local_world_size = 2  # int(os.environ['LOCAL_WORLD_SIZE'])
-            new_file_dict = {}
-            for name, files in file_dict.items():
-                new_files = files[args.local_rank :: local_world_size]
-                assert len(new_files) > 0
+    rank, world_size = dist_world(args)
+    if world_size > 1 and args.dist_shard == "files":
+        # every process reads its own files, the losses are averaged over the
+        # processes, so the validation files are split as well
+        new_file_dict = {}
+        for name, files in file_dict.items():
+            if len(files) < world_size:
+                raise RuntimeError(
+                    "%d %s files in group %s for %d processes, use --dist-shard entries"
+                    % (len(files), mode, name, world_size)
+                )
+            new_files = files[rank::world_size]
+            if mode == "train":
                 np.random.shuffle(new_files)
-                new_file_dict[name] = new_files
-            file_dict = new_file_dict
-            # print(file_dict)
+            new_file_dict[name] = new_files
+        file_dict = new_file_dict
 
     if args.copy_inputs:
         import tempfile
@@ -85,11 +112,12 @@ def to_filelist(args, mode="train"):
     return file_dict, filelist
 
 
-def train_load(args):
+def _split_files(args):
     """
-    Loads the training data.
-    :param args:
-    :return: train_loader, val_loader, data_config, train_inputs
+    Training and validation files and the range of their events read by this
+    process
+    :return: train_file_dict, train_files, train_range, val_file_dict,
+        val_files, val_range
     """
     train_file_dict, train_files = to_filelist(args, "train")
     if args.data_val:
@@ -99,6 +127,15 @@ def train_load(args):
         val_file_dict, val_files = train_file_dict, train_files
         train_range = (0, args.train_val_split)
         val_range = (args.train_val_split, 1)
+    rank, world_size = dist_world(args)
+    if world_size > 1:
+        if args.steps_per_epoch is None:
+            # otherwise the processes run out of data after different steps
+            raise RuntimeError("Must set --steps-per-epoch for distributed training!")
+        if args.dist_shard == "entries":
+            # every process reads its own part of the events of every file
+            train_range = shard_range(train_range, rank, world_size)
+            val_range = shard_range(val_range, rank, world_size)
     _logger.info(
         "Using %d files for training, range: %s" % (len(train_files), str(train_range))
     )
@@ -120,89 +157,146 @@ def train_load(args):
         args.steps_per_epoch is None or args.steps_per_epoch_val is None
     ):
         raise RuntimeError("Must set --steps-per-epoch when using --in-memory!")
+    return train_file_dict, train_files, train_range, val_file_dict, val_files, val_range
+
+
+def _synthetic_range(args):
     syn_str = args.synthetic_graph_npart_range
-    synthetic = syn_str != ""
-    minp, maxp = (
-        0,
-        0,
-    )
-    if synthetic:
-        minp = int(syn_str.split("-")[0])
-        maxp = int(syn_str.split("-")[1])
+    if syn_str == "":
+        return False, 0, 0
+    return True, int(syn_str.split("-")[0]), int(syn_str.split("-")[1])
 
-    train_data = SimpleIterDataset(
-        train_file_dict,
+
+def _collator(args):
+    if args.class_edges:
+        return graph_batch_func_edges
+    return graph_batch_func
+
+
+def _val_loader(args, val_file_dict, val_files, val_range):
+    """
+    The validation dataset and its loader (cached with --val-cache)
+    """
+    rank, world_size = dist_world(args)
+    synthetic, minp, maxp = _synthetic_range(args)
+    val_data = SimpleIterDataset(
+        val_file_dict,
         args.data_config,
         for_training=True,
         extra_selection=args.extra_selection,
-        remake_weights=not args.no_remake_weights,
-        load_range_and_fraction=(train_range, args.data_fraction),
+        load_range_and_fraction=(val_range, args.data_fraction),
         file_fraction=args.file_fraction,
         fetch_by_files=args.fetch_by_files,
         fetch_step=args.fetch_step,
-        infinity_mode=args.steps_per_epoch is not None,
+        infinity_mode=args.steps_per_epoch_val is not None,
         in_memory=args.in_memory,
         laplace=args.laplace,
         diffs=args.diffs,
         edges=args.class_edges,
-        name="train" + ("" if args.local_rank is None else "_rank%d" % args.local_rank),
-        dataset_cap=args.train_cap,
+        name="val" + ("" if world_size == 1 else "_rank%d" % rank),
+        dataset_cap=args.val_cap,
         n_noise=args.n_noise,
         synthetic=synthetic,
         synthetic_npart_min=minp,
         synthetic_npart_max=maxp,
     )
-    val_data = SimpleIterDataset(
+    val_loader = DataLoader(
+        val_data,
+        batch_size=args.batch_size,
+        drop_last=True,
+        pin_memory=True,
+        collate_fn=_collator(args),
+        num_workers=min(args.num_workers, int(len(val_files) * args.file_fraction)),
+        persistent_workers=args.num_workers > 0
+        and args.steps_per_epoch_val is not None,
+    )
+
+    if args.val_cache != "none":
+        cache_dir = None
+        if args.val_cache == "disk":
+            cache_dir = args.val_cache_dir or os.path.join(
+                os.path.dirname(args.model_prefix), "val_cache"
+            )
+        key = cache_key(
+            args.data_config,
+            val_file_dict,
+            {
+                "range": val_range,
+                "data_fraction": args.data_fraction,
+                "file_fraction": args.file_fraction,
+                "fetch_by_files": args.fetch_by_files,
+                "fetch_step": args.fetch_step,
+                "batch_size": args.batch_size,
+                "steps": args.steps_per_epoch_val,
+                "extra_selection": args.extra_selection,
+                "n_noise": args.n_noise,
+                "cap": args.val_cap,
+                "synthetic": args.synthetic_graph_npart_range,
+                "laplace": args.laplace,
+                "diffs": args.diffs,
+                "edges": args.class_edges,
+            },
+        )
+        val_loader = CachedLoader(
+            val_loader, key, cache_dir=cache_dir, n_steps=args.steps_per_epoch_val
+        )
+
+    return val_loader, val_data
+
+
+def train_load(args):
+    """
+    Loads the training data.
+    :param args:
+    :return: train_loader, val_loader, data_config, train_inputs
+    """
+    (
+        train_file_dict,
+        train_files,
+        train_range,
         val_file_dict,
+        val_files,
+        val_range,
+    ) = _split_files(args)
+    rank, world_size = dist_world(args)
+    synthetic, minp, maxp = _synthetic_range(args)
+
+    train_data = SimpleIterDataset(
+        train_file_dict,
         args.data_config,
         for_training=True,
         extra_selection=args.extra_selection,
-        load_range_and_fraction=(val_range, args.data_fraction),
+        remake_weights=not args.no_remake_weights,
+        load_range_and_fraction=(train_range, args.data_fraction),
         file_fraction=args.file_fraction,
         fetch_by_files=args.fetch_by_files,
         fetch_step=args.fetch_step,
-        infinity_mode=args.steps_per_epoch_val is not None,
+        infinity_mode=args.steps_per_epoch is not None,
         in_memory=args.in_memory,
         laplace=args.laplace,
         diffs=args.diffs,
         edges=args.class_edges,
-        name="val" + ("" if args.local_rank is None else "_rank%d" % args.local_rank),
-        dataset_cap=args.val_cap,
+        name="train" + ("" if world_size == 1 else "_rank%d" % rank),
+        dataset_cap=args.train_cap,
         n_noise=args.n_noise,
         synthetic=synthetic,
         synthetic_npart_min=minp,
         synthetic_npart_max=maxp,
     )
+    val_loader, _ = _val_loader(args, val_file_dict, val_files, val_range)
 
-    if args.class_edges:
-        collator_func = graph_batch_func_edges
-    else:
-        collator_func = graph_batch_func
     # train_data_arg = train_data
-    # val_data_arg = val_data
     # if args.train_cap == 1:
     #    train_data_arg = [next(iter(train_data_arg))]
-    # if args.val_cap == 1:
-    #    val_data_arg = [next(iter(val_data_arg))]
     train_loader = DataLoader(
         train_data,
         batch_size=args.batch_size,
         drop_last=True,
         pin_memory=True,
         num_workers=min(args.num_workers, int(len(train_files) * args.file_fraction)),
-        collate_fn=collator_func,
+        collate_fn=_collator(args),
         persistent_workers=args.num_workers > 0 and args.steps_per_epoch is not None,
     )
-    val_loader = DataLoader(
-        val_data,
-        batch_size=args.batch_size,
-        drop_last=True,
-        pin_memory=True,
-        collate_fn=collator_func,
-        num_workers=min(args.num_workers, int(len(val_files) * args.file_fraction)),
-        persistent_workers=args.num_workers > 0
-        and args.steps_per_epoch_val is not None,
-    )
 
     data_config = train_data.config
     train_input_names = train_data.config.input_names
@@ -211,6 +305,103 @@ def train_load(args):
     return train_loader, val_loader, data_config, train_input_names
 
 
+def val_load(args):
+    """
+    Loads only the validation data of train_load (or fold_load), e.g. for the
+    evaluation process of --async-eval.
+    :param args:
+    :return: val_loader, data_config
+    """
+    if args.fold_store is not None:
+        store = FoldStore(args.fold_store)
+        _, val_rows = _fold_rows(args, store)
+        return _fold_loader(args, store, val_rows, shuffle=False), store.config
+    _, _, _, val_file_dict, val_files, val_range = _split_files(args)
+    val_loader, val_data = _val_loader(args, val_file_dict, val_files, val_range)
+    return val_loader, val_data.config
+
+
+def fold_store_setup(args, var_name, kfold):
+    """
+    Decodes the training files once into the cross-validation store, or reuses
+    the store of the same inputs. Returns its path.
+    """
+    if args.data_val:
+        raise RuntimeError(
+            "--cross-validation-store splits the training files by --train-val-split, --data-val is not supported"
+        )
+    if dist_world(args)[1] > 1:
+        raise RuntimeError("--cross-validation-store does not support distributed training")
+    train_file_dict, train_files = to_filelist(args, "train")
+    # the data config of training, with the preprocessing information
+    data_config = SimpleIterDataset(
+        train_file_dict, args.data_config, for_training=True
+    ).config
+    fold_expr = "%s%%%d" % (var_name, kfold)
+    key = cache_key(
+        args.data_config, train_file_dict, {"fold": fold_expr, "n_noise": args.n_noise}
+    )
+    path = os.path.join(args.cross_validation_store, "cv-" + key)
+    if FoldStore.exists(path):
+        _logger.info("Using the cross-validation store %s" % path)
+    else:
+        _logger.info(
+            "Decoding %d files into the cross-validation store %s"
+            % (len(train_files), path)
+        )
+        build_fold_store(
+            path,
+            train_file_dict,
+            data_config,
+            fold_expr,
+            n_noise=args.n_noise,
+            num_workers=args.num_workers,
+        )
+    return path
+
+
+def _fold_rows(args, store):
+    """
+    Rows of the store used for the training and the validation of args.fold
+    """
+    other_folds = store.fold != args.fold
+    train_rows = np.flatnonzero(other_folds & (store.position < args.train_val_split))
+    val_rows = np.flatnonzero(other_folds & (store.position >= args.train_val_split))
+    _logger.info(
+        "Fold %d: %d events for training, %d for validation (out of %d in %s)"
+        % (args.fold, len(train_rows), len(val_rows), len(store), store.path)
+    )
+    return train_rows, val_rows
+
+
+def _fold_loader(args, store, rows, shuffle):
+    return DataLoader(
+        FoldDataset(store, rows),
+        batch_size=args.batch_size,
+        shuffle=shuffle,
+        drop_last=True,
+        pin_memory=True,
+        num_workers=args.num_workers,
+        collate_fn=graph_batch_func,
+        persistent_workers=args.num_workers > 0,
+    )
+
+
+def fold_load(args):
+    """
+    Loads fold args.fold of the cross-validation store args.fold_store: the
+    events of the other folds, split into training and validation by their
+    position in their input file (--train-val-split).
+    :param args:
+    :return: train_loader, val_loader, data_config, train_inputs
+    """
+    store = FoldStore(args.fold_store)
+    train_rows, val_rows = _fold_rows(args, store)
+    train_loader = _fold_loader(args, store, train_rows, shuffle=True)
+    val_loader = _fold_loader(args, store, val_rows, shuffle=False)
+    return train_loader, val_loader, store.config, store.config.input_names
+
+
 def test_load(args):
     """
     Loads the test data.
@@ -302,10 +493,27 @@ def onnx(args):
     model.eval()
 
     os.makedirs(os.path.dirname(args.export_onnx), exist_ok=True)
-    inputs = tuple(
-        torch.ones(model_info["input_shapes"][k], dtype=torch.float32)
-        for k in model_info["input_names"]
-    )
+    network_module = import_module(args.network_config, name="_network_module")
+    if hasattr(network_module, "get_onnx_model"):
+        # graph models: export a flat (hit features, event index) interface
+        # with the kNN done inside the ONNX graph
+        input_dim = model.mod.input_dim  # width of g.ndata["h"]
+        model, model_info = network_module.get_onnx_model(
+            model, args.clustering_space_dim
+        )
+        model.eval()
+        n_hits_per_event = 300  # the number of hits is a dynamic axis
+        inputs = (
+            torch.randn((2 * n_hits_per_event, input_dim)),
+            torch.arange(2).repeat_interleave(n_hits_per_event),
+        )
+        opset_version = 18  # scatter_reduce with amin/amax
+    else:
+        inputs = tuple(
+            torch.ones(model_info["input_shapes"][k], dtype=torch.float32)
+            for k in model_info["input_names"]
+        )
+        opset_version = 13
     torch.onnx.export(
         model,
         inputs,
@@ -313,7 +521,7 @@ def onnx(args):
         input_names=model_info["input_names"],
         output_names=model_info["output_names"],
         dynamic_axes=model_info.get("dynamic_axes", None),
-        opset_version=13,
+        opset_version=opset_version,
     )
     _logger.info("ONNX model saved to %s", args.export_onnx)
 
@@ -350,49 +558,149 @@ def flops(model, model_info):
     _logger.info("{:<30}  {:<8}".format("Number of parameters: ", params))
 
 
-def profile(args, model, model_info, device):
+def _label_modules(model):
     """
-    Profile.
-    :param model:
-    :param model_info:
-    :return:
+    Wraps the forward of every module defined in this repository (not the
+    torch.nn building blocks) in a profiler range named after its class.
+    Returns the hook handles.
+    """
+    from torch.profiler import record_function
+
+    def pre_hook(module, inputs):
+        scope = record_function("module::" + type(module).__name__)
+        scope.__enter__()
+        module._profile_scopes.append(scope)
+
+    def post_hook(module, inputs, output):
+        module._profile_scopes.pop().__exit__(None, None, None)
+
+    handles = []
+    for module in model.modules():
+        if type(module).__module__.startswith("torch"):
+            continue
+        module._profile_scopes = []
+        handles.append(module.register_forward_pre_hook(pre_hook))
+        handles.append(module.register_forward_hook(post_hook))
+    return handles
+
+
+def _ops_by_label(events, labels):
+    """
+    Self CPU time of the operators, grouped by the innermost labelled range
+    (module, function or stage) they ran in: {label: {op: time (us)}}
+    """
+    grouped = {}
+
+    def visit(event, label):
+        if event.name in labels or event.name.startswith("module::"):
+            label = event.name
+        else:
+            ops = grouped.setdefault(label, {})
+            ops[event.name] = ops.get(event.name, 0) + event.self_cpu_time_total
+        for child in event.cpu_children:
+            visit(child, label)
+
+    for event in events:
+        if event.cpu_parent is None:
+            visit(event, "other")
+    return grouped
+
+
+def profile(args, model, train_loader, loss_terms):
+    """
+    Runs args.profile_batches real batches of the training data through
+    forward, loss and backward under torch.profiler, on the CPU. The batches
+    are loaded and collated in this process, so that loading and collate show
+    up in the profile. Writes a Chrome trace to args.profile_trace and prints
+    the top operators overall and grouped by module / stage (the repository's
+    modules, knn_per_graph, calc_LV_Lbeta, collate, dataloader, backward).
+    :param loss_terms: [clustering loss only, add energy loss], as for training
     """
     import copy
     from torch.profiler import profile, record_function, ProfilerActivity
 
-    model = copy.deepcopy(model)
-    model = model.to(device)
-    model.eval()
+    device = torch.device("cpu")
+    model = copy.deepcopy(model).to(device)
+    model.train()
+    collate_fn = train_loader.collate_fn
 
-    inputs = tuple(
-        torch.ones(
-            (args.batch_size,) + model_info["input_shapes"][k][1:], dtype=torch.float32
-        ).to(device)
-        for k in model_info["input_names"]
-    )
-    for x in inputs:
-        print(x.shape, x.device)
-
-    def trace_handler(p):
-        output = p.key_averages().table(sort_by="self_cuda_time_total", row_limit=50)
-        print(output)
-        p.export_chrome_trace("/tmp/trace_" + str(p.step_num) + ".json")
+    def collate(samples):
+        with record_function("collate"):
+            return collate_fn(samples)
 
-    with profile(
-        activities=[ProfilerActivity.CPU, ProfilerActivity.CUDA],
-        schedule=torch.profiler.schedule(wait=2, warmup=2, active=6, repeat=2),
-        on_trace_ready=trace_handler,
-    ) as p:
-        for idx in range(100):
-            model(*inputs)
-            p.step()
+    loader = DataLoader(
+        train_loader.dataset,
+        batch_size=train_loader.batch_size,
+        drop_last=True,
+        num_workers=0,
+        collate_fn=collate,
+    )
+    iterator = iter(loader)
+
+    def step():
+        with record_function("dataloader"):
+            batch_g, y = next(iterator)
+        with record_function("forward"):
+            model_output = model(batch_g)
+            if args.loss_regularization:
+                model_output = model_output[0]
+        with record_function("loss"):
+            loss = model.mod.object_condensation_loss2(
+                batch_g,
+                model_output,
+                y,
+                clust_loss_only=loss_terms[0],
+                add_energy_loss=loss_terms[1],
+                q_min=args.qmin,
+                frac_clustering_loss=args.frac_cluster_loss,
+                attr_weight=args.L_attractive_weight,
+                repul_weight=args.L_repulsive_weight,
+                fill_loss_weight=args.fill_loss_weight,
+                use_average_cc_pos=args.use_average_cc_pos,
+                hgcalloss=args.hgcalloss,
+            )[0]
+        with record_function("backward"):
+            model.zero_grad(set_to_none=True)
+            loss.backward()
+
+    step()  # warm-up, not profiled
+    handles = _label_modules(model)
+    with profile(activities=[ProfilerActivity.CPU]) as p:
+        for _ in range(args.profile_batches):
+            step()
+    for handle in handles:
+        handle.remove()
+
+    p.export_chrome_trace(args.profile_trace)
+    _logger.info("Chrome trace written to %s" % args.profile_trace)
+    print(p.key_averages().table(sort_by="self_cpu_time_total", row_limit=30))
+    labels = {"collate", "dataloader", "forward", "loss", "backward"}
+    labels |= {"knn_per_graph", "calc_LV_Lbeta"}
+    grouped = _ops_by_label(p.events(), labels)
+    totals = {label: sum(ops.values()) for label, ops in grouped.items()}
+    lines = []
+    for label in sorted(totals, key=totals.get, reverse=True):
+        lines.append(
+            "%-40s %10.1f ms" % (label, totals[label] / 1000 / args.profile_batches)
+        )
+        ops = sorted(grouped[label].items(), key=lambda x: x[1], reverse=True)
+        for name, time_us in ops[:5]:
+            lines.append(
+                "    %-36s %10.1f ms" % (name, time_us / 1000 / args.profile_batches)
+            )
+    _logger.info(
+        "Self CPU time per batch, by module / stage (top 5 operators each):\n%s"
+        % "\n".join(lines)
+    )
 
 
-def optim(args, model, device):
+def optim(args, model, device, training_state=None):
     """
     Optimizer and scheduler.
     :param args:
     :param model:
+    :param training_state: contents of the `_training_state.pt` file of the
+        resumed epoch, if there is one
     :return:
     """
     optimizer_options = {k: ast.literal_eval(v) for k, v in args.optimizer_option}
@@ -493,7 +801,11 @@ def optim(args, model, device):
         else:
             model.load_state_dict(model_state)
         opt_state_file = args.model_prefix + "_epoch-%d_optimizer.pt" % args.load_epoch
-        if os.path.exists(opt_state_file):
+        if training_state is not None:
+            # moved to the devices of the parameters by load_state_dict
+            opt.load_state_dict(training_state["optimizer"])
+        elif os.path.exists(opt_state_file):
+            # checkpoints from before the training state file
             opt_state = torch.load(opt_state_file, map_location=device)
             opt.load_state_dict(opt_state)
         else:
@@ -602,8 +914,6 @@ def model_setup(args, data_config):
     """
     network_module = import_module(args.network_config, name="_network_module")
     network_options = {k: ast.literal_eval(v) for k, v in args.network_option}
-    if args.export_onnx:
-        network_options["for_inference"] = True
     if args.use_amp:
         network_options["use_amp"] = True
     if args.clustering_loss_only: